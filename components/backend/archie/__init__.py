@@ -29,5 +29,5 @@ def get_datadir() -> Path:
     return Path(data_path).expanduser()
 
 
+# created when something's first written there (see Config.save)
 ARCHIE_PATH = get_datadir() / "archie"
-ARCHIE_PATH.mkdir(parents=True, exist_ok=True)
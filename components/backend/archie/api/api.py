@@ -2,8 +2,11 @@ from contextlib import asynccontextmanager
 
 import uvicorn
 from fastapi import FastAPI, Request
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, PlainTextResponse
 
+from archie.utils import metrics
+
+from . import state
 from .routes import router
 
 DEBUG = True
@@ -18,6 +21,7 @@ async def lifespan(app: FastAPI):
 app = FastAPI(title="archie", version="0.0.1", lifespan=lifespan)
 
 app.include_router(router)
+app.include_router(state.router)
 
 
 @app.exception_handler(Exception)
@@ -34,10 +38,17 @@ async def exception_handler(request: Request, exc: Exception):
     )
 
 
-@app.get("/channel/{id}")
-def channel(id: str):
-    return "Hi"
+@app.get("/metrics", response_class=PlainTextResponse)
+def get_metrics():
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
+
+def run(host: str = "127.0.0.1", port: int = 5000, workers: int = 1, reload: bool = False):
+    # standalone server. multiple workers are separate processes, so they can't see a running archiver's state
+    uvicorn.run("archie.api.api:app", host=host, port=port, workers=workers, reload=reload)
 
 
-def run():
-    uvicorn.run("archie.api.api:app", port=5000, reload=DEBUG)
+def serve_in_process(host: str = "127.0.0.1", port: int = 5000):
+    # runs alongside the archiver's threads (blocks, so call it last), sharing its mongo client and in-memory state.
+    # log_config=None sends uvicorn's logs through our rich logging setup
+    uvicorn.Server(uvicorn.Config(app, host=host, port=port, log_config=None)).run()
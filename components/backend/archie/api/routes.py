@@ -1,15 +1,264 @@
-from fastapi import APIRouter, Query
-from pydantic import BaseModel
+import json
+import re
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Any, Callable, Iterator, Literal
+
+from bson import ObjectId
+from bson.errors import InvalidId
+from fastapi import APIRouter, HTTPException, Query, Request
+from fastapi.responses import Response, StreamingResponse
+
+from archie.services.base_mongo import db, find_page
+from archie.services.base_search import search_index
 
 router = APIRouter()
 
+MAX_LIMIT = 1000
+
+FIELD_REGEX = re.compile(r"^[A-Za-z0-9_-]+(\.[A-Za-z0-9_-]+)*$")
+
+
+@dataclass
+class Resource:
+    collection: str
+    id_field: str
+    id_type: Callable[[str], Any]
+    # query param -> (document field, type). each one has a (field, _id) index (see the services' update_indexes) so filtered
+    # pages stay index scans
+    filters: dict[str, tuple[str, Callable[[str], Any]]]
+    # left out unless they're asked for with fields, they can be huge
+    heavy_fields: tuple[str, ...] = ()
+
+
+RESOURCES = {
+    "youtube": {
+        "channels": Resource(
+            "youtube_channels",
+            "channel.id",
+            str,
+            {"status": ("_status", str)},
+            ("video_ids", "playlist_ids"),
+        ),
+        "videos": Resource(
+            "youtube_videos",
+            "video.id",
+            str,
+            {"channel_id": ("video.channel_id", str)},
+            (
+                "video.comments",
+                "video.formats",
+                "video.requested_formats",
+                "video.requested_downloads",
+                "video.automatic_captions",
+                "video.subtitles",
+                "video.heatmap",
+                "video.thumbnails",
+            ),
+        ),
+        "playlists": Resource(
+            "youtube_playlists",
+            "playlist.id",
+            str,
+            {"channel_id": ("playlist.channel_id", str)},
+            ("video_ids",),
+        ),
+        "downloads": Resource("youtube_video_downloads", "video_id", str, {"video_id": ("video_id", str)}),
+    },
+    "soundcloud": {
+        "users": Resource(
+            "soundcloud_users",
+            "user.id",
+            int,
+            {"status": ("_status", str)},
+            ("tracks", "playlists", "track_reposts", "playlist_reposts"),
+        ),
+        "tracks": Resource(
+            "soundcloud_tracks",
+            "track.id",
+            int,
+            {"user_id": ("track.user_id", int)},
+            ("comments", "likers", "reposters", "track.media"),
+        ),
+        "playlists": Resource(
+            "soundcloud_playlists",
+            "playlist.id",
+            int,
+            {"user_id": ("playlist.user_id", int)},
+            ("track_ids",),
+        ),
+        "comments": Resource(
+            "soundcloud_comments",
+            "comment.id",
+            int,
+            {"track_id": ("comment.track_id", int), "user_id": ("user_id", int)},
+        ),
+        "downloads": Resource("soundcloud_track_downloads", "track_id", int, {"track_id": ("track_id", int)}),
+    },
+}
+
+
+def _json_default(value):
+    if isinstance(value, ObjectId):
+        return str(value)
+
+    if isinstance(value, datetime):
+        return value.isoformat()
+
+    raise TypeError(f"can't serialise {type(value).__name__}")
+
+
+def _dumps(value):
+    return json.dumps(value, default=_json_default)
+
+
+def _projection(resource: Resource, fields: str | None) -> dict:
+    if not fields:
+        return {field: 0 for field in resource.heavy_fields}
+
+    projection = {}
+    for field in fields.split(","):
+        if not FIELD_REGEX.match(field):
+            raise HTTPException(400, f"invalid field '{field}'")
+
+        projection[field] = 1
+
+    return projection
+
+
+def _parse(type: Callable[[str], Any], value: str, name: str):
+    try:
+        return type(value)
+    except (ValueError, InvalidId):
+        raise HTTPException(400, f"invalid {name} '{value}'")
+
+
+def _stream_page(docs: Iterator[dict], limit: int) -> Iterator[str]:
+    # written out as documents come back from mongo rather than building the whole page in memory first
+    yield '{"items":['
+
+    next_cursor = None
+    last = None
+    for i, doc in enumerate(docs):
+        if i == limit:
+            # there's at least one more, so there's a next page
+            assert last
+            next_cursor = str(last["_id"])
+            break
+
+        yield ("," if i else "") + _dumps(doc)
+        last = doc
+
+    yield f'],"next_cursor":{_dumps(next_cursor)}}}'
+
 
-class ChannelResponse(BaseModel):
-    test: str
+def _list(resource: Resource, filter: dict, cursor: str | None, limit: int, fields: str | None, order: Literal["asc", "desc"]):
+    after = _parse(ObjectId, cursor, "cursor") if cursor else None
 
+    # one extra to know if there's another page
+    docs = find_page(resource.collection, filter, after, limit + 1, _projection(resource, fields), order == "desc")
+    return StreamingResponse(_stream_page(docs, limit), media_type="application/json")
 
-@router.get("/channel", response_model=ChannelResponse)
-async def get_channel(
-    id: str = Query(..., description="Channel ID"),
+
+def _get(resource: Resource, id: str, fields: str | None):
+    doc = db[resource.collection].find_one({resource.id_field: _parse(resource.id_type, id, "id")}, _projection(resource, fields))
+    if not doc:
+        raise HTTPException(404, "not found")
+
+    return Response(_dumps(doc), media_type="application/json")
+
+
+def _add_routes(service: str, name: str, resource: Resource):
+    filters = ", ".join(resource.filters) or "none"
+
+    @router.get(f"/{service}/{name}", name=f"list {service} {name}", description=f"Filters: {filters}")
+    def list_resource(
+        request: Request,
+        cursor: str | None = Query(None, description="next_cursor from the previous page"),
+        limit: int = Query(100, ge=1, le=MAX_LIMIT),
+        fields: str | None = Query(None, description="Comma separated fields to return, e.g. video.title,video.duration"),
+        order: Literal["asc", "desc"] = "asc",
+    ):
+        filter = {}
+        for param, (field, type) in resource.filters.items():
+            value = request.query_params.get(param)
+            if value is not None:
+                filter[field] = _parse(type, value, param)
+
+        return _list(resource, filter, cursor, limit, fields, order)
+
+    @router.get(f"/{service}/{name}/{{id}}", name=f"get {service} {name}")
+    def get_resource(id: str, fields: str | None = None):
+        return _get(resource, id, fields)
+
+
+for _service, _resources in RESOURCES.items():
+    for _name, _resource in _resources.items():
+        _add_routes(_service, _name, _resource)
+
+
+@router.get("/youtube/videos/{id}/comments")
+def get_video_comments(
+    id: str,
+    cursor: int | None = Query(None, description="next_cursor from the previous page"),
+    limit: int = Query(100, ge=1, le=MAX_LIMIT),
 ):
-    return ChannelResponse(test="hello")
+    # youtube comments live in the video, newest first. new ones get prepended, so positions are counted from the end (the
+    # oldest comment is 0) to keep cursors stable while the video gets rescanned
+    comments = {"$ifNull": ["$video.comments", []]}
+    start = 0 if cursor is None else {"$max": [0, {"$subtract": [{"$size": comments}, cursor]}]}
+
+    pipeline: list[dict] = [
+        {"$match": {"video.id": id}},
+        {"$project": {"_id": 0, "total": {"$size": comments}, "comments": {"$slice": [comments, start, limit]}}},
+    ]
+
+    doc = next(db["youtube_videos"].aggregate(pipeline), None)
+    if not doc:
+        raise HTTPException(404, "not found")
+
+    remaining = (doc["total"] if cursor is None else min(cursor, doc["total"])) - len(doc["comments"])
+    return {"items": doc["comments"], "next_cursor": remaining or None}
+
+
+@router.get("/soundcloud/tracks/{id}/comments")
+def get_track_comments(
+    id: int,
+    cursor: str | None = Query(None, description="next_cursor from the previous page"),
+    limit: int = Query(100, ge=1, le=MAX_LIMIT),
+    fields: str | None = None,
+    order: Literal["asc", "desc"] = "asc",
+):
+    return _list(RESOURCES["soundcloud"]["comments"], {"comment.track_id": id}, cursor, limit, fields, order)
+
+
+def _parse_search_cursor(cursor: str) -> tuple[float, str]:
+    # score:_id of the last result, ids have colons in them too
+    score, _, id = cursor.partition(":")
+    try:
+        return float(score), id
+    except ValueError:
+        raise HTTPException(400, f"invalid cursor '{cursor}'")
+
+
+@router.get("/search")
+def search(
+    q: str = Query(..., min_length=1, description='Words to look for. "quoted phrases" must match exactly, -word excludes'),
+    service: Literal["youtube", "soundcloud"] | None = None,
+    kind: Literal["channel", "user", "video", "track", "playlist", "comment"] | None = None,
+    cursor: str | None = Query(None, description="next_cursor from the previous page"),
+    limit: int = Query(20, ge=1, le=MAX_LIMIT),
+):
+    # best matches first, titles count for more than authors, authors for more than descriptions and comments. item_id is
+    # the id to look the full thing up with, parent_id is what it belongs to (a video's channel, a comment's video/track)
+    after = _parse_search_cursor(cursor) if cursor else None
+
+    # one extra to know if there's another page
+    results = search_index.search(q, service, kind, after, limit + 1)
+
+    next_cursor = None
+    if len(results) > limit:
+        results = results[:limit]
+        next_cursor = f"{results[-1]['score']!r}:{results[-1]['_id']}"
+
+    return Response(_dumps({"items": results, "next_cursor": next_cursor}), media_type="application/json")
@@ -0,0 +1,56 @@
+from fastapi import APIRouter, HTTPException, Query
+from fastapi.responses import PlainTextResponse
+
+from archie.services.base_catalog import file_catalog
+from archie.services.base_cluster import cluster
+from archie.services.base_download import download_scheduler, progress_renderer
+from archie.utils import metrics
+from archie.utils.profiler import profiler
+
+# read-only views of the running archiver's in-memory state. only populated when the api runs inside archie run (--serve)
+router = APIRouter(prefix="/state", tags=["state"])
+
+
+@router.get("/downloads")
+def get_downloads():
+    return {"progress": progress_renderer.snapshot(), **download_scheduler.snapshot()}
+
+
+@router.get("/queues")
+def get_queues():
+    return {"parse": metrics.parse_queue.values(), "active_downloads": metrics.active_downloads.values()}
+
+
+@router.get("/cluster")
+def get_cluster():
+    # every node that's been seen in the last week, and what they're working on
+    return {"nodes": cluster.nodes(), "leases": cluster.leases()}
+
+
+@router.get("/catalog")
+def get_catalog(limit: int = Query(100, ge=1, le=10_000)):
+    # files under this node's download paths, and ones no download points to
+    return {"roots": file_catalog.summary(), "orphans": file_catalog.orphans(limit)}
+
+
+@router.get("/api_cache")
+def get_api_cache():
+    # hit rates of the soundcloud response cache
+    from archie.services.soundcloud import sc
+
+    return {"soundcloud": sc.stats()}
+
+
+@router.get("/slow")
+def get_slow_calls(limit: int = Query(100, ge=1, le=10_000), call: str | None = None):
+    # calls slower than metrics.slow_span_ms, newest first. call filters by prefix, e.g. youtube.db or mongo
+    return {"threshold_ms": metrics.slow_spans.threshold * 1000, "spans": metrics.slow_spans.snapshot(limit, call)}
+
+
+@router.get("/profile", response_class=PlainTextResponse)
+def get_profile():
+    # collapsed stacks so far, when running with --profile
+    if not profiler.running:
+        raise HTTPException(404, "not profiling, start archie with run --profile")
+
+    return profiler.collapsed()
@@ -1,25 +1,31 @@
+import contextlib
+import importlib
+import threading
 import time
 from pathlib import Path
 
 import click
 
-import archie.api.api as api
-from archie.config import CFG_PATH, Entity, load_config
-from archie.services.base_download import rich_progress
-from archie.services.base_service import BaseService
-from archie.services.soundcloud import SoundCloudService
-from archie.services.youtube import YouTubeService
 from archie.utils import utils
 
-# idk
-service_list: list[BaseService] = [
-    YouTubeService(),
-    SoundCloudService(),
-]
+# everything else (config/pydantic, the services and their yt-dlp/soundcloud/mongo clients, the api) is imported inside the
+# commands that need it, so `archie --help` and the config commands start instantly
 
-services = {}
-for service in service_list:
-    services[service.service_name.lower()] = service
+# service name -> (module, class), imported the first time they're needed
+SERVICES = {
+    "youtube": ("archie.services.youtube", "YouTubeService"),
+    "soundcloud": ("archie.services.soundcloud", "SoundCloudService"),
+}
+
+_services: dict = {}
+
+
+def get_service(name: str):
+    if name not in _services:
+        module_name, class_name = SERVICES[name]
+        _services[name] = getattr(importlib.import_module(module_name), class_name)()
+
+    return _services[name]
 
 
 @click.group()
@@ -33,6 +39,7 @@ def create(archive_name):
     """
     Creates a new archive
     """
+    from archie.config import CFG_PATH, load_config
 
     with load_config() as config:
         # check if name is duplicate
@@ -55,6 +62,7 @@ def add_entity(archive_name, entity_name):
     """
     Adds an entity to an archive
     """
+    from archie.config import Entity, load_config
 
     with load_config() as config:
         archive = utils.find(config.archives, lambda archive: archive.name == archive_name)
@@ -84,9 +92,10 @@ def add_entity_account(archive_name, entity_name, service, account):
     """
     Add an account to an entity
     """
+    from archie.config import load_config
 
-    if service not in services:
-        return utils.log(f"Service '{service}' not supported. Supported services: {', '.join(services.keys())}")
+    if service not in SERVICES:
+        return utils.log(f"Service '{service}' not supported. Supported services: {', '.join(SERVICES.keys())}")
 
     with load_config() as config:
         archive = utils.find(config.archives, lambda archive: archive.name == archive_name)
@@ -97,7 +106,7 @@ def add_entity_account(archive_name, entity_name, service, account):
         if not entity:
             return utils.log(f"Entity '{entity_name}' not found.")
 
-        if not entity.add_account(services[service], account):
+        if not entity.add_account(get_service(service), account):
             return utils.log("Account not added")
 
         config.save()
@@ -106,23 +115,102 @@ def add_entity_account(archive_name, entity_name, service, account):
 
 
 @archie.command()
-def run():
+@click.option("--headless", is_flag=True, help="Don't draw download progress, for running as a service.")
+@click.option("--serve", is_flag=True, help="Also serve the api from this process.")
+@click.option("--host", default="127.0.0.1", show_default=True, help="Api host, with --serve.")
+@click.option("--port", default=5000, show_default=True, help="Api port, with --serve.")
+@click.option("--profile", is_flag=True, help="Sample every thread's stack and write them out for flamegraphs.")
+@click.option(
+    "--profile-output", type=click.Path(path_type=Path), help="Where to write the collapsed stacks. [default: archie's data dir]"
+)
+@click.option("--node-name", help="Name of this node when clustering. [default: cluster.node_name, or the hostname]")
+@click.option(
+    "--role", "roles", multiple=True, type=click.Choice(["parse", "download"]), help="Only do this. [default: cluster.roles]"
+)
+@click.option(
+    "--download-path", "download_paths", multiple=True, help="ARCHIVE=PATH, download that archive to PATH on this node."
+)
+def run(headless, serve, host, port, profile, profile_output, node_name, roles, download_paths):
     """
     Runs archives
     """
-    with load_config() as config:
-        with rich_progress:
+    from archie.config import load_config
+    from archie.services.base_catalog import file_catalog
+    from archie.services.base_cluster import cluster
+    from archie.services.base_download import (
+        prepare_temp_downloads,
+        progress_renderer,
+        rich_progress,
+        staging,
+    )
+    from archie.services.base_search import search_index
+    from archie.utils import metrics
+    from archie.utils.profiler import profiler
+
+    with load_config() as config, contextlib.ExitStack() as stack:
+        # only for this run, the config file isn't saved
+        if node_name:
+            config.cluster.node_name = node_name
+        if roles:
+            config.cluster.roles = list(roles)
+        for download_path in download_paths:
+            archive_name, _, path = download_path.partition("=")
+            config.cluster.download_paths[archive_name] = path
+
+        if profile:
+            from archie import ARCHIE_PATH
+
+            output = profile_output or ARCHIE_PATH / "profiles" / f"{time.strftime('%Y%m%d-%H%M%S')}.folded"
+            profiler.start(output, config.metrics.profile_interval_ms)
+            stack.callback(profiler.stop)
+
+        metrics.slow_spans.configure(config.metrics.slow_span_ms, config.metrics.max_slow_spans)
+
+        with contextlib.nullcontext() if headless else rich_progress:
             if len(config.archives) == 0:
                 return utils.log("No archives created, create one using [dim]create [archive name] [channel(s)][/dim]")
 
             for archive in config.archives:
+                archive.downloads.download_path = config.cluster.download_paths.get(archive.name, archive.downloads.download_path)
+
                 if not Path(archive.downloads.download_path).is_absolute():
                     return utils.log(
                         f"The download path '{archive.downloads.download_path}' specified in archive '{archive.name}' does not exist or is invalid. Please add a proper path and try again."
                     )
 
-            for service_name, service in services.items():
-                service.run(config)
+            cluster.configure(config.cluster)
+            cluster.start()
+
+            search_index.configure(config.search)
+            search_index.update_indexes()
+
+            if cluster.has_role("download"):
+                staging.configure(Path(archive.downloads.download_path) for archive in config.archives)
+
+            prepare_temp_downloads(config.downloads.resume_partial)
+
+            if not headless or serve:
+                # the api shows download progress too, so keep track of it even if it isn't drawn
+                progress_renderer.start(draw=not headless)
+
+            if config.metrics.summary_interval_minutes:
+                threading.Thread(
+                    target=metrics.log_summaries, args=(config.metrics.summary_interval_minutes,), daemon=True
+                ).start()
+
+            for service_name in SERVICES:
+                get_service(service_name).run(config)
+
+            # after the services, they register their download collections with it
+            if cluster.has_role("download"):
+                file_catalog.configure(config.catalog)
+                file_catalog.start(config)
+
+            if serve:
+                from archie.api import api
+
+                api.serve_in_process(host, port)
+                return
 
             while True:
                 # Twidles Thumbs
@@ -130,8 +218,17 @@ def run():
 
 
 @archie.command()
-def serve():
-    api.run()
+@click.option("--host", default="127.0.0.1", show_default=True)
+@click.option("--port", default=5000, show_default=True)
+@click.option("--workers", default=1, show_default=True, help="Worker processes, for read-heavy traffic.")
+@click.option("--reload", is_flag=True, help="Reload on code changes, for development.")
+def serve(host, port, workers, reload):
+    """
+    Serves the api on its own. Use run --serve to serve it alongside the archiver
+    """
+    from archie.api import api
+
+    api.run(host, port, workers, reload)
 
 
 if __name__ == "__main__":
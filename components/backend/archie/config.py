@@ -1,6 +1,6 @@
 from contextlib import contextmanager
 from pathlib import Path
-from typing import Iterator, Tuple
+from typing import Iterator, Literal, Tuple
 
 import yaml
 from pydantic import BaseModel
@@ -32,19 +32,125 @@ class SpiderFilterOptions(BaseModel):
     parse_playlists: bool = True
 
 
+class AdaptiveScanOptions(BaseModel):
+    # rescan intervals start at the service's update gap and adapt to how active each account/item is
+    enabled: bool = True
+    # interval is multiplied by this when a rescan finds nothing new
+    backoff: float = 2.0
+    # and by this when something changed
+    activity_factor: float = 0.5
+    # bounds, relative to the update gap
+    min_factor: float = 0.25
+    max_factor: float = 16.0
+
+
 class YouTubeOptions(BaseModel):
     channel_update_gap_hours: int = 24
     playlist_update_gap_hours: int = 24
     video_update_gap_hours: int = 24 * 7
+    # on rescans, comments are only fetched again if the comment count moved by more than this
+    comment_refetch_threshold: int = 0
+    # extra newest comments to fetch on top of the count difference, so we're sure to reach ones we already have
+    comment_fetch_margin: int = 20
+    adaptive: AdaptiveScanOptions = AdaptiveScanOptions()
+    # threads runs yt-dlp in archie's own process. processes runs video extraction and downloads in a pool of worker
+    # processes instead, so they aren't all sharing one cpu core (0 processes means one per core)
+    executor: Literal["threads", "processes"] = "threads"
+    processes: int = 0
 
 
 class SoundCloudOptions(BaseModel):
     user_update_gap_hours: int = 24
     track_update_gap_hours: int = 24 * 7
+    adaptive: AdaptiveScanOptions = AdaptiveScanOptions()
+    # users/tracks/playlists fetched from the api are reused for this long, parsing and downloading tend to ask for the same
+    # ones within minutes of each other. 0 turns the cache off
+    cache_ttl_minutes: int = 30
+    cache_max_entries: int = 20_000
+    # keep the cache in ARCHIE_PATH between restarts
+    cache_persist: bool = False
+
+
+class CacheOptions(BaseModel):
+    # per collection. the lru holds known ids, the bloom filter answers "definitely not stored" for everything else
+    id_cache_max_entries: int = 500_000
+    id_bloom_capacity: int = 5_000_000
+    id_bloom_error_rate: float = 0.01
+
+
+class HistoryOptions(BaseModel):
+    enabled: bool = True
+    # write a full snapshot every n versions, everything in between is stored as a patch
+    snapshot_interval: int = 20
+    # history older than this is thinned out to one version per compact_granularity_hours
+    compact_after_days: int = 90
+    compact_granularity_hours: int = 24
+
+
+class SearchOptions(BaseModel):
+    enabled: bool = True
+    # comments are most of what gets stored, turn this off to keep the index small
+    index_comments: bool = True
+
+
+class MetricsOptions(BaseModel):
+    # log a summary of what's been happening every n minutes, 0 to turn it off. full metrics are at /metrics on the api
+    summary_interval_minutes: float = 5
+    # store/get/api/download/mongo calls slower than this are kept (the latest max_slow_spans of them) for /state/slow
+    slow_span_ms: float = 1000
+    max_slow_spans: int = 500
+    # how often run --profile samples every thread's stack
+    profile_interval_ms: float = 10
 
 
 class DownloadOptions(BaseModel):
     download_path: str = "~/archie-downloads"
+    # with downloads.priority set to archive, archives with a higher weight are downloaded first
+    priority_weight: float = 1.0
+
+
+class DownloadSchedulerOptions(BaseModel):
+    # MB/s shared between every download worker, 0 for no limit
+    max_bandwidth_mb: float = 0
+    # same but per service, e.g. {YouTube: 5}
+    service_bandwidth_mb: dict[str, float] = {}
+    # downloads are paused while free space on a download drive (after reservations) would drop below this
+    min_free_space_gb: float = 10
+    # newest, smallest or archive (by archive priority_weight, newest first within an archive)
+    priority: Literal["newest", "smallest", "archive"] = "newest"
+    # keep partially downloaded files between runs and carry on from where they stopped
+    resume_partial: bool = True
+    # downloads go through stages, each with its own workers: fetching the streams (network), muxing/post-processing them
+    # (ffmpeg, cpu and disk) and moving them into place. youtube only, soundcloud tracks come out of ffmpeg ready to go
+    fetch_workers: int = 5
+    postprocess_workers: int = 2
+    finalize_workers: int = 2
+    # downloads waiting on the next stage. once it's full the stage before it waits
+    stage_queue_size: int = 10
+
+
+class CatalogOptions(BaseModel):
+    # keeps track of every file under the download paths, to find downloads that were deleted/moved and files nothing knows about
+    enabled: bool = True
+    scan_interval_minutes: float = 30
+    # directories listed at once. more helps on network drives and big arrays
+    scan_workers: int = 8
+    # hash new files too (blake2b). reads every file in full, so the first scan takes a while
+    hash_files: bool = False
+
+
+class ClusterOptions(BaseModel):
+    # run several archie processes (on one machine or many) against the same database without them doing the same work
+    enabled: bool = False
+    # defaults to the hostname. downloads remember which node made them, so keep it the same across restarts
+    node_name: str = ""
+    # parse, download or both. e.g. one parser and a downloader on every machine with disks/bandwidth to spare
+    roles: list[Literal["parse", "download"]] = ["parse", "download"]
+    heartbeat_seconds: float = 10
+    # a node's claims on jobs are renewed with its heartbeat, if it dies another node takes them over after this long
+    lease_seconds: float = 120
+    # archive name -> where this node downloads it to, instead of the archive's download_path
+    download_paths: dict[str, str] = {}
 
 
 class SpiderOptions(BaseModel):
@@ -107,11 +213,20 @@ class Config(BaseModel):
     services: ServiceOptions = (
         ServiceOptions()
     )  # TODO: move this back to archive-specific, but it makes things a bit more complicated in queries
+    cache: CacheOptions = CacheOptions()
+    history: HistoryOptions = HistoryOptions()
+    search: SearchOptions = SearchOptions()
+    downloads: DownloadSchedulerOptions = DownloadSchedulerOptions()
+    catalog: CatalogOptions = CatalogOptions()
+    metrics: MetricsOptions = MetricsOptions()
+    cluster: ClusterOptions = ClusterOptions()
 
     def dump(self):
         return self.model_dump()
 
     def save(self, path: Path = CFG_PATH):
+        path.parent.mkdir(parents=True, exist_ok=True)
+
         with path.open("w") as f:
             yaml.dump(self.dump(), f, Dumper=utils.PrettyDumper, sort_keys=False)
 
@@ -0,0 +1,148 @@
+import hashlib
+import math
+import threading
+from collections import OrderedDict
+from typing import Hashable
+
+from archie.utils import utils
+
+from .base_cluster import cluster
+from .base_mongo import db
+
+
+def log(*args, **kwargs):
+    utils.module_log("id cache", "dim", *args, **kwargs)
+
+
+class BloomFilter:
+    def __init__(self, capacity: int, error_rate: float):
+        # standard sizing, see https://en.wikipedia.org/wiki/Bloom_filter#Optimal_number_of_hash_functions
+        self.size = max(8, int(-capacity * math.log(error_rate) / (math.log(2) ** 2)))
+        self.hash_count = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+
+    def _positions(self, key: Hashable):
+        digest = hashlib.blake2b(repr(key).encode(), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+
+        for i in range(self.hash_count):
+            yield (h1 + i * h2) % self.size
+
+    def add(self, key: Hashable):
+        for pos in self._positions(key):
+            self.bits[pos >> 3] |= 1 << (pos & 7)
+
+    def __contains__(self, key: Hashable):
+        return all(self.bits[pos >> 3] & (1 << (pos & 7)) for pos in self._positions(key))
+
+
+class IdCache:
+    """
+    Remembers which ids exist in a collection (and their scan source/status) so ingestion doesn't have to ask mongo every time.
+
+    Known ids live in an lru capped at max_entries. Every id that has ever been seen also goes into a bloom filter, so once the
+    cache has been warmed a bloom miss means the id definitely isn't in the database. Anything else falls back to mongo.
+
+    With clustering on, other nodes insert documents this one never hears about, so bloom misses aren't trusted and unknown
+    ids always go to mongo. Otherwise a document another node stored would look new and get overwritten as a first insert.
+    """
+
+    def __init__(
+        self,
+        collection_name: str,
+        id_field: str,
+        max_entries: int = 500_000,
+        bloom_capacity: int = 5_000_000,
+        bloom_error_rate: float = 0.01,
+    ):
+        self.collection_name = collection_name
+        self.id_field = id_field
+        self.max_entries = max_entries
+
+        self._entries: OrderedDict[Hashable, tuple[str | None, str | None]] = OrderedDict()
+        self._bloom = BloomFilter(bloom_capacity, bloom_error_rate)
+        self._warm = False
+        self._lock = threading.Lock()
+
+    def configure(self, max_entries: int, bloom_capacity: int, bloom_error_rate: float):
+        # starts over with an empty cache, so this has to happen before anything stores documents. otherwise ids set before
+        # it would be missing from the new bloom filter, and once warm that miss would be trusted
+        with self._lock:
+            self.max_entries = max_entries
+            self._bloom = BloomFilter(bloom_capacity, bloom_error_rate)
+            self._entries.clear()
+            self._warm = False
+
+    def warm(self):
+        # stream every id in the collection, only pulling back the fields we need. only ever adds, so it's fine for this to
+        # run alongside ingestion
+        count = 0
+        cursor = db[self.collection_name].find(
+            {}, {"_id": 0, self.id_field: 1, "_scan_source": 1, "_status": 1}, batch_size=10_000
+        )
+
+        for doc in cursor:
+            id = doc
+            for part in self.id_field.split("."):
+                id = id.get(part) if isinstance(id, dict) else None
+
+            if id is None:
+                continue
+
+            self.set(id, doc.get("_scan_source"), doc.get("_status"))
+            count += 1
+
+        with self._lock:
+            self._warm = True
+
+        log(f"warmed {self.collection_name} with {count} ids")
+
+    def contains(self, id: Hashable) -> bool | None:
+        # True if known, False if definitely not in the database, None if we can't tell without asking mongo
+        with self._lock:
+            if id in self._entries:
+                self._entries.move_to_end(id)
+                return True
+
+            # only this node writes to the database if there's no cluster, so only then is the bloom filter the whole story
+            if self._warm and not cluster.enabled and id not in self._bloom:
+                return False
+
+        return None
+
+    def scan_source(self, id: Hashable) -> str | None:
+        with self._lock:
+            entry = self._entries.get(id)
+            return entry[0] if entry else None
+
+    def status(self, id: Hashable) -> str | None:
+        with self._lock:
+            entry = self._entries.get(id)
+            return entry[1] if entry else None
+
+    def exists(self, id: Hashable) -> bool:
+        cached = self.contains(id)
+        if cached is not None:
+            return cached
+
+        doc = db[self.collection_name].find_one({self.id_field: id}, {"_id": 0, "_scan_source": 1, "_status": 1})
+        if doc:
+            self.set(id, doc.get("_scan_source"), doc.get("_status"))
+
+        return doc is not None
+
+    def set(self, id: Hashable, scan_source: str | None, status: str | None = None):
+        with self._lock:
+            self._bloom.add(id)
+
+            self._entries[id] = (scan_source, status)
+            self._entries.move_to_end(id)
+
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, id: Hashable):
+        # still might be in the bloom filter but that only costs a lookup
+        with self._lock:
+            self._entries.pop(id, None)
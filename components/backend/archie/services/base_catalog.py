@@ -0,0 +1,415 @@
+import hashlib
+import os
+import re
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Iterable
+
+from pymongo import DeleteMany, ReplaceOne
+
+from archie.config import TEMP_DL_PATH, CatalogOptions, Config
+from archie.utils import metrics, utils
+
+from .base_cluster import cluster
+from .base_download import STAGING_DIR_NAME
+from .base_mongo import db
+
+
+def log(*args, **kwargs):
+    utils.module_log("catalog", "yellow", *args, **kwargs)
+
+
+BATCH_SIZE = 1000
+
+
+@dataclass
+class ScannedDir:
+    path: str
+    mtime_ns: int
+    subdirs: list[str]
+    # name -> (inode, device, size, mtime_ns). None when the directory hasn't changed since it was last catalogued
+    files: dict[str, tuple[int, int, int, int]] | None
+
+
+@dataclass
+class CatalogChanges:
+    root: str
+    first_scan: bool
+    added: list[dict] = field(default_factory=list)
+    changed: list[dict] = field(default_factory=list)
+    removed: list[dict] = field(default_factory=list)
+    dirs_scanned: int = 0
+    dirs_skipped: int = 0
+
+
+def _scan_dir(path: str, stored: dict | None) -> ScannedDir | None:
+    # a directory's mtime changes whenever something in it is added, removed or renamed, so if it hasn't moved since last
+    # time there's no need to list it again. stat first, anything that changes after that bumps the mtime for next time
+    try:
+        mtime_ns = os.stat(path).st_mtime_ns
+
+        if stored and stored["mtime_ns"] == mtime_ns:
+            return ScannedDir(path, mtime_ns, stored["subdirs"], None)
+
+        subdirs = []
+        files = {}
+        with os.scandir(path) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    # downloads in progress, they're not anywhere yet
+                    if entry.name != STAGING_DIR_NAME:
+                        subdirs.append(entry.name)
+                elif entry.is_file(follow_symlinks=False):
+                    stat = entry.stat(follow_symlinks=False)
+                    files[entry.name] = (stat.st_ino, stat.st_dev, stat.st_size, stat.st_mtime_ns)
+    except (FileNotFoundError, NotADirectoryError):
+        return None
+
+    return ScannedDir(path, mtime_ns, subdirs, files)
+
+
+def _hash_file(path: str) -> str | None:
+    hash = hashlib.blake2b(digest_size=20)
+    try:
+        with open(path, "rb") as f:
+            while chunk := f.read(1024 * 1024):
+                hash.update(chunk)
+    except OSError:
+        return None
+
+    return hash.hexdigest()
+
+
+class FileCatalog:
+    """
+    Every file under the download paths (and the temp downloads), with its inode, size and mtime, in file_catalog.
+
+    Directories are walked in parallel, and ones whose mtime hasn't changed since the last scan aren't listed again, so a
+    rescan costs a stat per directory rather than per file. Whatever was added/removed is then reconciled against the
+    download collections: downloads whose file is gone are removed (or pointed at the same file under another download
+    path, if the archive was moved), and files no download knows about are marked as orphans.
+
+    Files are only noticed through their directory changing. Something rewritten in place keeps its old size and mtime here
+    until a file next to it is added or removed.
+    """
+
+    def __init__(self):
+        self.options = CatalogOptions()
+        self.scanned = threading.Event()
+
+        self._download_collections: list[str] = []
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return self.options.enabled
+
+    def configure(self, options: CatalogOptions):
+        self.options = options
+
+    def track_downloads(self, collection_name: str):
+        # download collections to reconcile with, they need path and relative_video_path fields
+        self._download_collections.append(collection_name)
+
+    def update_indexes(self):
+        db["file_catalog"].create_index([("node", 1), ("dir", 1)])
+        db["file_catalog"].create_index([("node", 1), ("relative", 1)])
+        db["file_catalog"].create_index([("node", 1), ("orphan", 1)], partialFilterExpression={"orphan": True})
+        db["file_catalog_dirs"].create_index([("node", 1), ("root", 1)])
+
+        for collection_name in self._download_collections:
+            db[collection_name].create_index("path")
+            db[collection_name].create_index("relative_video_path")
+
+    def start(self, config: Config):
+        if not self.enabled:
+            self.scanned.set()
+            return
+
+        self.update_indexes()
+
+        # the same drive can be used by several archives
+        roots = sorted({Path(archive.downloads.download_path).expanduser() for archive in config.archives} | {TEMP_DL_PATH})
+        threading.Thread(target=self._run, args=(roots,), name="file catalog", daemon=True).start()
+
+    def _run(self, roots: list[Path]):
+        while True:
+            try:
+                self.scan(roots)
+            except Exception as e:
+                log(f"scan failed: {e}")
+
+            time.sleep(self.options.scan_interval_minutes * 60)
+
+    def _id(self, path: str):
+        # paths are only unique per node, every node catalogs its own drives
+        return f"{cluster.node_name}:{path}"
+
+    @metrics.timed("catalog.scan")
+    def scan(self, roots: Iterable[Path]) -> list[CatalogChanges]:
+        with self._lock:
+            start = time.perf_counter()
+            try:
+                changes = [self._scan_root(root) for root in roots if root.exists()]
+
+                # only once every root is up to date, so a file that moved between two of them is seen in both places
+                self.reconcile([change for change in changes if Path(change.root) != TEMP_DL_PATH])
+            finally:
+                # even if it failed, _check_downloads shouldn't wait forever
+                self.scanned.set()
+
+            for change in changes:
+                for kind in ("added", "changed", "removed"):
+                    metrics.catalog_changes.inc(len(getattr(change, kind)), change=kind)
+
+            log(
+                f"scanned {sum(change.dirs_scanned for change in changes)} changed directories "
+                f"({sum(change.dirs_skipped for change in changes)} unchanged) in {time.perf_counter() - start:.1f}s: "
+                f"{sum(len(change.added) for change in changes)} added, {sum(len(change.changed) for change in changes)} "
+                f"changed, {sum(len(change.removed) for change in changes)} removed"
+            )
+            return changes
+
+    def _walk(self, root: str, stored_dirs: dict[str, dict]) -> dict[str, ScannedDir]:
+        scanned: dict[str, ScannedDir] = {}
+
+        with ThreadPoolExecutor(self.options.scan_workers, thread_name_prefix="catalog") as executor:
+            pending: set[Future] = {executor.submit(_scan_dir, root, stored_dirs.get(root))}
+
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+
+                for future in done:
+                    dir = future.result()
+                    if not dir:
+                        continue  # removed while we were walking
+
+                    scanned[dir.path] = dir
+                    for name in dir.subdirs:
+                        path = os.path.join(dir.path, name)
+                        pending.add(executor.submit(_scan_dir, path, stored_dirs.get(path)))
+
+        return scanned
+
+    def _file_doc(self, root: str, dir: str, name: str, stat: tuple[int, int, int, int]):
+        path = os.path.join(dir, name)
+        inode, device, size, mtime_ns = stat
+
+        return {
+            "_id": self._id(path),
+            "node": cluster.node_name,
+            "root": root,
+            "dir": dir,
+            "path": path,
+            "relative": Path(path).relative_to(root).as_posix(),
+            "inode": inode,
+            "device": device,
+            "size": size,
+            "mtime_ns": mtime_ns,
+        }
+
+    def _scan_root(self, root_path: Path) -> CatalogChanges:
+        root = str(root_path)
+        node = cluster.node_name
+
+        stored_dirs = {doc["path"]: doc for doc in db["file_catalog_dirs"].find({"node": node, "root": root})}
+        scanned = self._walk(root, stored_dirs)
+
+        changes = CatalogChanges(root, first_scan=not stored_dirs)
+        changed_dirs = [dir for dir in scanned.values() if dir.files is not None]
+        removed_dirs = [path for path in stored_dirs if path not in scanned]
+
+        changes.dirs_scanned = len(changed_dirs)
+        changes.dirs_skipped = len(scanned) - len(changed_dirs)
+
+        # only the files in directories that changed are looked at
+        touched = [dir.path for dir in changed_dirs] + removed_dirs
+        stored_files: dict[str, dict[str, dict]] = {}
+        for i in range(0, len(touched), BATCH_SIZE):
+            for doc in db["file_catalog"].find({"node": node, "dir": {"$in": touched[i : i + BATCH_SIZE]}}):
+                stored_files.setdefault(doc["dir"], {})[os.path.basename(doc["path"])] = doc
+
+        for dir in changed_dirs:
+            assert dir.files is not None
+            old_files = stored_files.get(dir.path, {})
+
+            for name, stat in dir.files.items():
+                doc = self._file_doc(root, dir.path, name, stat)
+                old = old_files.get(name)
+
+                if not old:
+                    changes.added.append(doc)
+                elif (old["inode"], old["device"], old["size"], old["mtime_ns"]) != stat:
+                    changes.changed.append(doc)
+
+            changes.removed += [doc for name, doc in old_files.items() if name not in dir.files]
+
+        for path in removed_dirs:
+            changes.removed += stored_files.get(path, {}).values()
+
+        if self.options.hash_files and (changes.added or changes.changed):
+            docs = changes.added + changes.changed
+            with ThreadPoolExecutor(self.options.scan_workers, thread_name_prefix="catalog hash") as executor:
+                for doc, hash in zip(docs, executor.map(_hash_file, [doc["path"] for doc in docs])):
+                    doc["hash"] = hash
+
+        writes: list = [ReplaceOne({"_id": doc["_id"]}, doc, upsert=True) for doc in changes.added + changes.changed]
+        if changes.removed:
+            removed_ids = [doc["_id"] for doc in changes.removed]
+            writes += [
+                DeleteMany({"_id": {"$in": removed_ids[i : i + BATCH_SIZE]}}) for i in range(0, len(removed_ids), BATCH_SIZE)
+            ]
+        self._write("file_catalog", writes)
+
+        dir_writes: list = [
+            ReplaceOne(
+                {"_id": self._id(dir.path)},
+                {"node": node, "root": root, "path": dir.path, "mtime_ns": dir.mtime_ns, "subdirs": dir.subdirs},
+                upsert=True,
+            )
+            for dir in changed_dirs
+        ]
+        if removed_dirs:
+            dir_writes.append(DeleteMany({"_id": {"$in": [self._id(path) for path in removed_dirs]}}))
+        self._write("file_catalog_dirs", dir_writes)
+
+        return changes
+
+    def _write(self, collection_name: str, writes: list):
+        for i in range(0, len(writes), BATCH_SIZE):
+            db[collection_name].bulk_write(writes[i : i + BATCH_SIZE], ordered=False)
+
+    def _downloads_query(self, query: dict):
+        # other nodes' downloads are on their own drives
+        return {**query, "node": cluster.node_name} if cluster.enabled else query
+
+    def reconcile(self, changes: list[CatalogChanges]):
+        added = [doc for change in changes for doc in change.added]
+        removed = [doc for change in changes for doc in change.removed]
+
+        # the first time a root is scanned there's nothing to diff against, downloads under it whose files were deleted
+        # before the catalog existed are only found by looking for them
+        for change in changes:
+            if change.first_scan:
+                removed += self._missing_downloads(change)
+
+        self._reconcile_added(added)
+        self._reconcile_removed(removed)
+
+    def _missing_downloads(self, change: CatalogChanges) -> list[dict]:
+        found = {doc["path"] for doc in change.added}
+        prefix = {"path": {"$regex": f"^{re.escape(change.root.rstrip(os.sep) + os.sep)}"}}
+
+        missing = []
+        for collection_name in self._download_collections:
+            for download in db[collection_name].find(self._downloads_query(prefix), {"path": 1}):
+                if download["path"] not in found:
+                    missing.append(
+                        {"path": download["path"], "relative": Path(download["path"]).relative_to(change.root).as_posix()}
+                    )
+
+        return missing
+
+    def _reconcile_added(self, added: list[dict]):
+        tracked: set[str] = set()
+
+        for collection_name in self._download_collections:
+            for i in range(0, len(added), BATCH_SIZE):
+                paths = [doc["path"] for doc in added[i : i + BATCH_SIZE]]
+                tracked.update(download["path"] for download in db[collection_name].find({"path": {"$in": paths}}, {"path": 1}))
+
+        orphans = []
+        for doc in added:
+            if doc["path"] in tracked or Path(doc["root"]) == TEMP_DL_PATH:
+                continue
+
+            if not self._remap(doc):
+                orphans.append(doc["_id"])
+
+        for i in range(0, len(orphans), BATCH_SIZE):
+            db["file_catalog"].update_many({"_id": {"$in": orphans[i : i + BATCH_SIZE]}}, {"$set": {"orphan": True}})
+
+        metrics.catalog_changes.inc(len(orphans), change="orphaned")
+
+    def _remap(self, doc: dict) -> bool:
+        # a download whose file disappeared from where it was, but turned up at the same place under another download path
+        # (download_path/service/relative_video_path). true if one was found and pointed at this file
+        parts = Path(doc["relative"]).parts
+        if len(parts) < 2:
+            return False
+
+        relative_video_path = str(Path(*parts[1:]))
+        for collection_name in self._download_collections:
+            query = self._downloads_query({"relative_video_path": relative_video_path, "path": {"$ne": doc["path"]}})
+
+            for download in db[collection_name].find(query, {"path": 1}):
+                if Path(download["path"]).parts[-len(parts) :] != parts or os.path.exists(download["path"]):
+                    continue
+
+                log(f"download moved from {download['path']} to {doc['path']}")
+                db[collection_name].update_one({"_id": download["_id"]}, {"$set": {"path": doc["path"]}})
+                metrics.catalog_changes.inc(change="remapped")
+                return True
+
+        return False
+
+    def _reconcile_removed(self, removed: list[dict]):
+        if not removed:
+            return
+
+        for collection_name in self._download_collections:
+            for i in range(0, len(removed), BATCH_SIZE):
+                by_path = {doc["path"]: doc for doc in removed[i : i + BATCH_SIZE]}
+
+                for download in db[collection_name].find(self._downloads_query({"path": {"$in": list(by_path)}})):
+                    # hardlinked copies in other archives are the same file, so carry on using one of those
+                    copy = db["file_catalog"].find_one(
+                        {
+                            "node": cluster.node_name,
+                            "relative": by_path[download["path"]]["relative"],
+                            "path": {"$ne": download["path"]},
+                        }
+                    )
+                    if copy:
+                        log(f"download {download['path']} was deleted, using {copy['path']} instead")
+                        db[collection_name].update_one({"_id": download["_id"]}, {"$set": {"path": copy["path"]}})
+                        db["file_catalog"].update_one({"_id": copy["_id"]}, {"$unset": {"orphan": ""}})
+                        metrics.catalog_changes.inc(change="remapped")
+                        continue
+
+                    log(f"download {download['path']} no longer exists, deleting from db")
+                    db[collection_name].delete_one({"_id": download["_id"]})
+                    metrics.catalog_changes.inc(change="missing")
+
+    def orphans(self, limit: int = 100) -> list[dict]:
+        # files under the download paths that no download points to. downloads that finished after their file was catalogued
+        # are checked for here rather than on every scan
+        orphans = []
+        for doc in db["file_catalog"].find({"node": cluster.node_name, "orphan": True}, {"node": 0}):
+            if any(db[name].count_documents({"path": doc["path"]}, limit=1) for name in self._download_collections):
+                db["file_catalog"].update_one({"_id": doc["_id"]}, {"$unset": {"orphan": ""}})
+                continue
+
+            orphans.append(doc)
+            if len(orphans) == limit:
+                break
+
+        return orphans
+
+    def summary(self) -> list[dict]:
+        return list(
+            db["file_catalog"].aggregate(
+                [
+                    {"$match": {"node": cluster.node_name}},
+                    {"$group": {"_id": "$root", "files": {"$sum": 1}, "bytes": {"$sum": "$size"}}},
+                    {"$project": {"_id": 0, "root": "$_id", "files": 1, "bytes": 1}},
+                    {"$sort": {"root": 1}},
+                ]
+            )
+        )
+
+
+file_catalog = FileCatalog()
@@ -0,0 +1,271 @@
+import os
+import socket
+import threading
+import time
+import uuid
+from datetime import datetime, timedelta, timezone
+from typing import Callable, Hashable, Iterable, Iterator
+
+from pymongo.errors import DuplicateKeyError
+
+from archie.config import ClusterOptions
+from archie.utils import utils
+
+from .base_mongo import db
+
+
+def log(*args, **kwargs):
+    utils.module_log("cluster", "blue", *args, **kwargs)
+
+
+class Cluster:
+    """
+    Lets several archie processes share one database without parsing or downloading the same things.
+
+    Every node keeps a heartbeat document in cluster_nodes. Before working on something, a node claims a lease on it in
+    cluster_leases. Leases are renewed along with the heartbeat. If a node dies, its leases run out after lease_seconds and
+    another node can claim the work. With clustering off there's only one node, so claims always succeed without touching
+    mongo.
+    """
+
+    def __init__(self):
+        self.options = ClusterOptions()
+        self.node_name = socket.gethostname()
+        # unique per process, the name is shared between restarts (and between processes on one machine if you want)
+        self.node_id = f"{self.node_name}:{os.getpid()}:{uuid.uuid4().hex[:6]}"
+
+        self._held: set[str] = set()
+        self._lock = threading.Lock()
+        self._started = False
+        # monotonic time the last heartbeat that got through started at, our leases are good until lease_seconds after it
+        self._last_beat = 0.0
+
+    @property
+    def enabled(self):
+        return self.options.enabled
+
+    def configure(self, options: ClusterOptions):
+        self.options = options
+        self.node_name = options.node_name or socket.gethostname()
+        self.node_id = f"{self.node_name}:{os.getpid()}:{uuid.uuid4().hex[:6]}"
+
+    def has_role(self, role: str):
+        return role in self.options.roles
+
+    @property
+    def lapsed(self):
+        # heartbeats have been failing for long enough that our leases have run out, other nodes are free to take the work
+        return self._started and time.monotonic() - self._last_beat > self.options.lease_seconds
+
+    def start(self):
+        if not self.enabled or self._started:
+            return
+
+        self._started = True
+        self.update_indexes()
+        self._beat()
+
+        threading.Thread(target=self._heartbeat, name="cluster heartbeat", daemon=True).start()
+        log(f"joined as {self.node_id} ({', '.join(self.options.roles)})")
+
+    def update_indexes(self):
+        # mongo deletes leases once they've run out. claim() doesn't rely on it, it's just to stop them piling up
+        db["cluster_leases"].create_index("expires", expireAfterSeconds=0)
+        db["cluster_leases"].create_index([("kind", 1), ("expires", 1)])
+        db["cluster_nodes"].create_index("last_seen", expireAfterSeconds=60 * 60 * 24 * 7)
+
+    def _lease_expiry(self):
+        return datetime.now(timezone.utc) + timedelta(seconds=self.options.lease_seconds)
+
+    def _beat(self):
+        started = time.monotonic()
+
+        with self._lock:
+            held = list(self._held)
+
+        db["cluster_nodes"].update_one(
+            {"_id": self.node_id},
+            {
+                "$set": {
+                    "name": self.node_name,
+                    "host": socket.gethostname(),
+                    "pid": os.getpid(),
+                    "roles": self.options.roles,
+                    "last_seen": datetime.now(timezone.utc),
+                    "leases": len(held),
+                },
+                "$setOnInsert": {"started": datetime.now(timezone.utc)},
+            },
+            upsert=True,
+        )
+
+        if held:
+            db["cluster_leases"].update_many(
+                {"_id": {"$in": held}, "node": self.node_id}, {"$set": {"expires": self._lease_expiry()}}
+            )
+
+        self._last_beat = started
+
+    def _heartbeat(self):
+        while True:
+            time.sleep(self.options.heartbeat_seconds)
+
+            try:
+                self._beat()
+            except Exception as e:
+                # keep trying, leases only run out after lease_seconds
+                log(f"heartbeat failed: {e}")
+
+                if self.lapsed:
+                    with self._lock:
+                        lost = len(self._held)
+                        self._held.clear()
+
+                    if lost:
+                        log(f"no heartbeat for over {self.options.lease_seconds}s, gave up {lost} leases")
+
+    def claim(self, kind: str, id: Hashable) -> bool:
+        # true if this node now holds the lease, either it was free, had run out or was already ours
+        if not self.enabled:
+            return True
+
+        # can't keep a lease alive without heartbeats, so don't take on anything new until they get through again
+        if self.lapsed:
+            return False
+
+        key = f"{kind}:{id}"
+        now = datetime.now(timezone.utc)
+
+        try:
+            # someone else holding a live lease means the filter doesn't match, so the upsert tries to insert and fails
+            db["cluster_leases"].update_one(
+                {"_id": key, "$or": [{"node": self.node_id}, {"expires": {"$lt": now}}]},
+                {
+                    "$set": {
+                        "kind": kind,
+                        "item_id": id,
+                        "node": self.node_id,
+                        "claimed": now,
+                        "expires": self._lease_expiry(),
+                    }
+                },
+                upsert=True,
+            )
+        except DuplicateKeyError:
+            return False
+
+        with self._lock:
+            self._held.add(key)
+
+        return True
+
+    def claim_fresh(self, kind: str, id: Hashable, collection_name: str, doc: dict, field: str = "_scan_time") -> bool:
+        """
+        Claims a queued document, as long as nobody has dealt with it since it was read.
+
+        Queues are read in batches, so by the time a node gets to a document another node might have already parsed it and
+        released the lease. If the document's field (when it was last scanned) changed, the document is skipped.
+        """
+
+        if not self.enabled:
+            return True
+
+        if not self.claim(kind, id):
+            return False
+
+        if not db[collection_name].count_documents({"_id": doc["_id"], field: doc.get(field)}, limit=1):
+            self.release(kind, id)
+            return False
+
+        return True
+
+    def claim_each(
+        self,
+        kind: str,
+        docs: Iterable[dict],
+        get_id: Callable[[dict], Hashable],
+        collection_name: str | None = None,
+        field: str = "_scan_time",
+    ) -> Iterator[dict]:
+        # the docs this node managed to claim (see claim_fresh when collection_name is set), each one's lease is held until
+        # the next one is asked for
+        for doc in docs:
+            id = get_id(doc)
+            if not (self.claim_fresh(kind, id, collection_name, doc, field) if collection_name else self.claim(kind, id)):
+                continue
+
+            try:
+                yield doc
+            finally:
+                self.release(kind, id)
+
+    def claim_batches(
+        self,
+        kind: str,
+        docs: Iterable[dict],
+        get_id: Callable[[dict], Hashable],
+        size: int,
+        collection_name: str | None = None,
+        field: str = "_scan_time",
+    ) -> Iterator[list[dict]]:
+        # like claim_each, but hands over up to size claimed docs at a time (e.g. to fetch them all in one api call). the
+        # whole batch's leases are held until the next batch is asked for
+        batch: list[tuple[Hashable, dict]] = []
+        for doc in docs:
+            id = get_id(doc)
+            if not (self.claim_fresh(kind, id, collection_name, doc, field) if collection_name else self.claim(kind, id)):
+                continue
+
+            batch.append((id, doc))
+            if len(batch) >= size:
+                yield from self._hand_over(kind, batch)
+                batch = []
+
+        if batch:
+            yield from self._hand_over(kind, batch)
+
+    def _hand_over(self, kind: str, batch: list[tuple[Hashable, dict]]) -> Iterator[list[dict]]:
+        try:
+            yield [doc for id, doc in batch]
+        finally:
+            for id, doc in batch:
+                self.release(kind, id)
+
+    def release(self, kind: str, id: Hashable):
+        if not self.enabled:
+            return
+
+        key = f"{kind}:{id}"
+        with self._lock:
+            self._held.discard(key)
+
+        db["cluster_leases"].delete_one({"_id": key, "node": self.node_id})
+
+    def claimed_ids(self, kind: str) -> list:
+        # everything of kind that a node (including this one) is working on right now
+        if not self.enabled:
+            return []
+
+        return db["cluster_leases"].distinct("item_id", {"kind": kind, "expires": {"$gte": datetime.now(timezone.utc)}})
+
+    def leases(self) -> list[dict]:
+        # live ones, expired ones might not have been cleaned up yet
+        return list(
+            db["cluster_leases"].find(
+                {"expires": {"$gte": datetime.now(timezone.utc)}}, {"_id": 0}, sort=[("kind", 1), ("claimed", 1)]
+            )
+        )
+
+    def nodes(self) -> list[dict]:
+        alive_after = datetime.now(timezone.utc) - timedelta(seconds=self.options.lease_seconds)
+
+        nodes = []
+        for node in db["cluster_nodes"].find({}, sort=[("name", 1)]):
+            node["node_id"] = node.pop("_id")
+            node["alive"] = node["last_seen"] >= alive_after
+            nodes.append(node)
+
+        return nodes
+
+
+cluster = Cluster()
@@ -1,11 +1,20 @@
+import errno
+import os
 import shutil
+import threading
+import time
+from collections import deque
+from datetime import datetime, timezone
 from pathlib import Path
+from typing import Hashable, Iterable
 
+from pymongo import ReturnDocument
 from rich.panel import Panel
 from rich.progress import (
     BarColumn,
     DownloadColumn,
     Progress,
+    TaskID,
     TaskProgressColumn,
     TextColumn,
     TimeRemainingColumn,
@@ -13,8 +22,11 @@ from rich.progress import (
 from rich.table import Column
 
 from archie import console
-from archie.config import TEMP_DL_PATH, ArchiveConfig
-from archie.utils import utils
+from archie.config import TEMP_DL_PATH, ArchiveConfig, Config, DownloadSchedulerOptions
+from archie.utils import metrics, utils
+
+from .base_cluster import cluster
+from .base_mongo import db
 
 
 def log(*args, **kwargs):
@@ -37,16 +49,497 @@ rich_progress = MyProgress(
     DownloadColumn(table_column=Column(width=15)),
     console=console,
     expand=True,
+    # drawn by ProgressRenderer instead
+    auto_refresh=False,
     # disable=True,
 )
 
+
+class ProgressRenderer:
+    """
+    Download threads push progress events onto a deque (appends are atomic so there's no lock to fight over), and a single
+    thread applies them to rich_progress refresh_per_second times a second. Updates for the same download in between renders
+    are coalesced, only the latest one gets drawn.
+
+    The latest state of each download is also kept for the api (see snapshot), which works without drawing anything. Until
+    start is called (e.g. when running headless without the api) events are dropped straight away.
+    """
+
+    def __init__(self, refresh_per_second: float = 4):
+        self.refresh_per_second = refresh_per_second
+        self.enabled = False
+        self.draw = True
+
+        self._events: deque[tuple[str, Hashable, dict | tuple]] = deque()
+        self._tasks: dict[Hashable, TaskID] = {}
+        self._state: dict[Hashable, dict] = {}
+        self._state_lock = threading.Lock()
+
+    def start(self, draw: bool = True):
+        self.enabled = True
+        self.draw = draw
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def snapshot(self) -> list[dict]:
+        with self._state_lock:
+            return [dict(state) for state in self._state.values()]
+
+    def add(self, key: Hashable, start: bool = False, total: float | None = 0, **fields):
+        if self.enabled:
+            self._events.append(("add", key, {"start": start, "total": total, **fields}))
+
+    def update(self, key: Hashable, completed: float | None, total: float | None):
+        if self.enabled:
+            self._events.append(("update", key, (completed, total)))
+
+    def remove(self, key: Hashable):
+        if self.enabled:
+            self._events.append(("remove", key, ()))
+
+    def _render(self):
+        updates: dict[Hashable, tuple] = {}
+
+        while self._events:
+            op, key, data = self._events.popleft()
+
+            if op == "update":
+                updates[key] = data
+            elif op == "add":
+                assert isinstance(data, dict)
+                with self._state_lock:
+                    self._state[key] = {**{name: value for name, value in data.items() if name != "start"}, "completed": 0}
+
+                if self.draw:
+                    self._tasks[key] = rich_progress.add_task("download", **data)
+            elif op == "remove":
+                updates.pop(key, None)
+                with self._state_lock:
+                    self._state.pop(key, None)
+
+                task_id = self._tasks.pop(key, None)
+                if task_id is not None:
+                    rich_progress.remove_task(task_id)
+
+        with self._state_lock:
+            for key, (completed, total) in updates.items():
+                if key in self._state:
+                    self._state[key].update(completed=completed, total=total)
+
+        if not self.draw:
+            return
+
+        for key, (completed, total) in updates.items():
+            task_id = self._tasks.get(key)
+            if task_id is None:
+                continue
+
+            rich_progress.start_task(task_id)
+            rich_progress.update(task_id, completed=completed, total=total)
+
+        rich_progress.refresh()
+
+    def _run(self):
+        while True:
+            self._render()
+            time.sleep(1 / self.refresh_per_second)
+
+
+progress_renderer = ProgressRenderer()
+
 # TODO: move more of the code here from youtube, give generic methods for stuff
 
-# remove temp downloads (for safety, resuming causes issues sometimes)
-if TEMP_DL_PATH.exists():
-    shutil.rmtree(TEMP_DL_PATH)
+# every download gets its own folder in a staging root, tracked in download_jobs so partial downloads can be picked up after a
+# restart. this is the one downloads go to when there's no better place (see Staging)
+JOBS_PATH = TEMP_DL_PATH / "jobs"
+
+# staging roots on other drives live next to the downloads, in a folder with this name
+STAGING_DIR_NAME = ".archie-staging"
+
+# how much gets copied at a time when a download has to be copied into place
+COPY_CHUNK_SIZE = 16 * 1024**2
+
+
+class Staging:
+    """
+    Where downloads are written to while they're in progress.
+
+    Moving a finished download into place is a rename if it's on the same filesystem, but a full copy of the file if it isn't,
+    which is what happens with TEMP_DL_PATH under ARCHIE_PATH and the downloads on another drive. So every drive with a
+    download path on it gets its own staging root, next to the first download path on it, and downloads are staged on the
+    drive they'll end up on. Drives are told apart by device id, TEMP_DL_PATH is used for the one it's already on.
+    """
+
+    def __init__(self):
+        self._roots: dict[int, Path] = {}
+
+    def configure(self, download_paths: Iterable[Path]):
+        self._roots = {}
+
+        TEMP_DL_PATH.mkdir(parents=True, exist_ok=True)
+        temp_device = _get_device(TEMP_DL_PATH)
+
+        for path in download_paths:
+            try:
+                path = path.expanduser()
+                path.mkdir(parents=True, exist_ok=True)
+
+                device = _get_device(path)
+                if device == temp_device or device in self._roots:
+                    continue
+
+                root = path / STAGING_DIR_NAME
+                root.mkdir(exist_ok=True)
+            except OSError as e:
+                # e.g. read only, downloads going there get copied from TEMP_DL_PATH like before
+                log(f"can't stage downloads next to {path}, using {TEMP_DL_PATH} ({e})")
+                continue
+
+            self._roots[device] = root
+
+    def roots(self) -> list[Path]:
+        return [TEMP_DL_PATH, *self._roots.values()]
+
+    def root_for(self, destination: Path) -> Path:
+        return self._roots.get(_get_device(destination), TEMP_DL_PATH)
+
+
+staging = Staging()
+
+
+def _job_name(service_name: str, item_id):
+    # the job's folder name
+    return f"{service_name.lower()}-{item_id}"
+
+
+def _job_id(service_name: str, item_id):
+    # job folders are on each node's own drives, so with clustering on every node has its own jobs
+    name = _job_name(service_name, item_id)
+    return f"{cluster.node_name}:{name}" if cluster.enabled else name
+
+
+def _node_jobs() -> dict:
+    # filter for this node's jobs
+    return {"node": cluster.node_name} if cluster.enabled else {}
+
+
+def _job_path(name: str, job: dict | None) -> Path:
+    # jobs from before staging roots existed don't have a dir, they're all in JOBS_PATH
+    return Path(job["dir"]) if job and job.get("dir") else JOBS_PATH / name
+
+
+def _remove(path: Path):
+    shutil.rmtree(path) if path.is_dir() else path.unlink()
+
+
+def prepare_temp_downloads(resume: bool):
+    # called once on startup, before any downloads start and after staging is configured
+    jobs = db["download_jobs"]
+
+    if not resume:
+        for root in staging.roots():
+            if root.exists():
+                shutil.rmtree(root)
+
+        jobs.delete_many(_node_jobs())
+
+    job_dirs: set[Path] = set()
+    for root in staging.roots():
+        jobs_path = root / "jobs"
+        jobs_path.mkdir(parents=True, exist_ok=True)
+
+        # anything that isn't a job folder is from before jobs existed, those can't be trusted
+        for path in root.iterdir():
+            if path != jobs_path:
+                _remove(path)
+
+        job_dirs.update(jobs_path.iterdir())
+
+    # only this node's, other nodes' jobs are on their own drives
+    known_jobs = {_job_path(job["_id"], job): job["_id"] for job in jobs.find(_node_jobs(), {"dir": 1})}
+    for path in job_dirs - known_jobs.keys():
+        _remove(path)
+
+    # and jobs whose files are gone have nothing to resume
+    jobs.delete_many({"_id": {"$in": [job_id for path, job_id in known_jobs.items() if path not in job_dirs]}})
+
+    resumable = len(job_dirs & known_jobs.keys())
+    if resumable:
+        log(f"found {resumable} partial downloads to resume")
+
+
+def get_job_dir(service_name: str, item_id, destination: Path | None = None) -> Path:
+    # destination is where the download will be moved to once it's done, so it can be staged on the same drive. a job that
+    # already exists keeps its folder, wherever that is
+    job_id = _job_id(service_name, item_id)
+    name = _job_name(service_name, item_id)
+    root = staging.root_for(destination) if destination else TEMP_DL_PATH
+
+    job = db["download_jobs"].find_one_and_update(
+        {"_id": job_id},
+        {
+            "$setOnInsert": {
+                "service": service_name,
+                "item_id": item_id,
+                "node": cluster.node_name,
+                "started": datetime.now(timezone.utc),
+                "dir": str(root / "jobs" / name),
+            },
+            "$set": {"updated": datetime.now(timezone.utc)},
+        },
+        upsert=True,
+        return_document=ReturnDocument.AFTER,
+    )
+
+    path = _job_path(name, job)
+    path.mkdir(parents=True, exist_ok=True)
+    return path
+
+
+def check_job_format(service_name: str, item_id, format_id: str) -> bool:
+    # called once the format is picked, right before downloading. partial files are only any use if it's the same format
+    # as last time, otherwise they're thrown away. returns whether there was anything to resume.
+    # file names have to include .f<format_id>. for this to work (see youtube's outtmpl), anything else in the job folder
+    # (like the thumbnail, which is written before this is called) is kept
+    job_id = _job_id(service_name, item_id)
+
+    job = db["download_jobs"].find_one_and_update({"_id": job_id}, {"$set": {"format_id": format_id}})
+    path = _job_path(_job_name(service_name, item_id), job)
+    if not path.exists():
+        return False
+
+    old_format_id = job.get("format_id") if job else None
+    if old_format_id not in (None, format_id):
+        stale = [file for file in path.rglob("*") if file.is_file() and f".f{old_format_id}." in file.name]
+        if stale:
+            log(f"format changed from {old_format_id} to {format_id}, discarding partial download ({job_id})")
+
+        for file in stale:
+            file.unlink(missing_ok=True)
+
+    return any(_is_partial(file, format_id) for file in path.rglob("*"))
+
+
+def _is_partial(file: Path, format_id: str):
+    # an unfinished download of the format, or one of its streams that hasn't been merged yet
+    marker = f".f{format_id}."
+    return (
+        marker in file.name
+        and file.is_file()
+        and (file.name.endswith((".part", ".ytdl")) or "-Frag" in file.name or f"{marker}f" in file.name)
+    )
+
+
+def finish_job(service_name: str, item_id):
+    job_id = _job_id(service_name, item_id)
+
+    job = db["download_jobs"].find_one_and_delete({"_id": job_id})
+    shutil.rmtree(_job_path(_job_name(service_name, item_id), job), ignore_errors=True)
+
+
+def finalize_file(source: Path, destination: Path):
+    """
+    Moves a finished download into place. That's a rename when it was staged on the same drive, otherwise it's copied to a
+    temporary name next to the destination, synced, and renamed over it, so there's never a half written file at the
+    destination path even if archie dies halfway through.
+    """
+
+    size = source.stat().st_size
+
+    try:
+        os.rename(source, destination)
+        metrics.finalize_bytes.inc(size, method="rename")
+        return
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+
+    part_path = destination.with_name(destination.name + ".part-archie")
+    try:
+        with open(source, "rb") as src, open(part_path, "wb") as dst:
+            while chunk := src.read(COPY_CHUNK_SIZE):
+                dst.write(chunk)
+
+            dst.flush()
+            os.fsync(dst.fileno())
+
+        shutil.copystat(source, part_path)
+        os.replace(part_path, destination)
+    except BaseException:
+        part_path.unlink(missing_ok=True)
+        raise
+
+    source.unlink()
+    metrics.finalize_bytes.inc(size, method="copy")
+
+
+class DownloadJob:
+    def __init__(self, service_name: str, size: int, devices: set[int]):
+        self.service_name = service_name
+        self.size = size
+        self.devices = devices
+        self.params: dict = {"ratelimit": None}
+        # false once it's done with the network, it keeps its disk reservation but stops taking up bandwidth
+        self.transferring = True
+        # false once finished, its reservation's been given back
+        self.active = True
+
+    def bind(self, params: dict):
+        # yt-dlp reads ratelimit from its params dict on every chunk, so once bound rebalancing applies to running downloads too
+        params["ratelimit"] = self.params["ratelimit"]
+        self.params = params
+
+
+def _existing_parent(path: Path):
+    # the download folder might not exist yet, use whatever drive it'll end up on
+    path = path.expanduser().absolute()
+    while not path.exists() and path != path.parent:
+        path = path.parent
+
+    return path
+
+
+def _get_device(path: Path):
+    return _existing_parent(path).stat().st_dev
+
+
+class DownloadScheduler:
+    """
+    Shares bandwidth and disk space between the download workers of every service.
+
+    Running downloads split the bandwidth caps evenly (the total one and their service's one, whichever is lower). Before a
+    download starts its estimated size is reserved on the drives it'll be written to, and it only starts if the free space
+    left after every reservation stays above the watermark.
+    """
+
+    def __init__(self):
+        self.options = DownloadSchedulerOptions()
+        self.paused = False
+
+        self._jobs: list[DownloadJob] = []
+        self._reserved: dict[int, int] = {}
+        self._lock = threading.Lock()
+
+    def configure(self, options: DownloadSchedulerOptions):
+        with self._lock:
+            self.options = options
+            self._rebalance()
+
+    def _free_space(self, path: Path):
+        return shutil.disk_usage(_existing_parent(path)).free - self._reserved.get(_get_device(path), 0)
+
+    def _has_space(self, paths: Iterable[Path], size: int):
+        watermark = self.options.min_free_space_gb * 1024**3
+        has_space = all(self._free_space(path) - size >= watermark for path in paths)
+
+        if has_space == self.paused:
+            self.paused = not has_space
+            log("download drives are low on space, pausing downloads" if self.paused else "resuming downloads")
+
+        return has_space
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {
+                "paused": self.paused,
+                "jobs": [
+                    {
+                        "service": job.service_name,
+                        "reserved_bytes": job.size,
+                        "ratelimit": job.params.get("ratelimit"),
+                        "transferring": job.transferring,
+                    }
+                    for job in self._jobs
+                ],
+            }
+
+    def has_space(self, paths: Iterable[Path] = ()):
+        with self._lock:
+            return self._has_space([*paths, *staging.roots()], 0)
+
+    def start(self, service_name: str, size: int, paths: Iterable[Path]) -> DownloadJob | None:
+        # returns None if there isn't room for the download right now
+        # the download's written to its staging root first, which is only the same drive if staging could be set up there
+        paths = [*paths, *(staging.root_for(path) for path in paths)] or [TEMP_DL_PATH]
+
+        with self._lock:
+            if not self._has_space(paths, size):
+                return None
+
+            job = DownloadJob(service_name, size, {_get_device(path) for path in paths})
+            self._reserve(job)
+            self._rebalance()
+
+            return job
+
+    def end_transfer(self, job: DownloadJob):
+        # the download's still going (post-processing), but its bandwidth share can go to the others
+        with self._lock:
+            if not job.transferring:
+                return
+
+            job.transferring = False
+            job.params["ratelimit"] = None
+            self._rebalance()
+
+    def finish(self, job: DownloadJob):
+        # safe to call more than once, so failure paths can always call it
+        with self._lock:
+            if not job.active:
+                return
+
+            job.transferring = False
+            self._release(job)
+            self._rebalance()
+
+    # the only places a job's reservation, and its place in the active downloads count, are added and taken away
+
+    def _reserve(self, job: DownloadJob):
+        for device in job.devices:
+            self._reserved[device] = self._reserved.get(device, 0) + job.size
+
+        self._jobs.append(job)
+        metrics.active_downloads.inc(service=job.service_name.lower())
+
+    def _release(self, job: DownloadJob):
+        job.active = False
+
+        for device in job.devices:
+            self._reserved[device] -= job.size
+
+        self._jobs.remove(job)
+        metrics.active_downloads.dec(service=job.service_name.lower())
+
+    def _rebalance(self):
+        jobs = [job for job in self._jobs if job.transferring]
+
+        service_counts: dict[str, int] = {}
+        for job in jobs:
+            service_counts[job.service_name] = service_counts.get(job.service_name, 0) + 1
+
+        for job in jobs:
+            limits = []
+            if self.options.max_bandwidth_mb:
+                limits.append(self.options.max_bandwidth_mb / len(jobs))
+
+            service_limit = self.options.service_bandwidth_mb.get(job.service_name)
+            if service_limit:
+                limits.append(service_limit / service_counts[job.service_name])
+
+            job.params["ratelimit"] = int(min(limits) * 1024**2) if limits else None
+
+    def download_groups(self, config: Config, service_name: str) -> list[list | None]:
+        # the owners to look for downloads from, in order. None means anyone
+        if self.options.priority != "archive":
+            return [None]
+
+        archives = sorted(config.archives, key=lambda archive: archive.downloads.priority_weight, reverse=True)
+        return [
+            [account.id for entity in archive.entities for account in entity.accounts if account.service == service_name]
+            for archive in archives
+        ]
+
 
-TEMP_DL_PATH.mkdir(parents=True, exist_ok=True)
+download_scheduler = DownloadScheduler()
 
 
 def copy_download(
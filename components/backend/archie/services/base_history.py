@@ -0,0 +1,338 @@
+import copy
+import hashlib
+import json
+from datetime import datetime, timedelta, timezone
+from typing import Any, Iterable
+
+from bson import ObjectId
+from pymongo import ASCENDING, DESCENDING
+from pymongo.errors import BulkWriteError
+
+from archie.utils import utils
+
+from .base_mongo import db
+
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+DUPLICATE_KEY = 11000
+RECORD_ATTEMPTS = 5
+
+
+def log(*args, **kwargs):
+    utils.module_log("history", "dim", *args, **kwargs)
+
+
+def _escape(key: str):
+    return str(key).replace("~", "~0").replace("/", "~1")
+
+
+def _unescape(key: str):
+    return key.replace("~1", "/").replace("~0", "~")
+
+
+def content_hash(doc: Any) -> str:
+    # key order isn't stable between what's fetched and what's read back from mongo, so sort them
+    data = json.dumps(doc, sort_keys=True, default=str, separators=(",", ":"))
+    return hashlib.blake2b(data.encode(), digest_size=16).hexdigest()
+
+
+def make_patch(old: Any, new: Any, path: str = "") -> list[dict]:
+    # json-patch style ops (add/remove/replace). lists are only diffed when appended to, otherwise they're replaced
+    if type(old) is not type(new):
+        return [{"op": "replace", "path": path, "value": new}]
+
+    if isinstance(old, dict):
+        ops = []
+        for key, value in new.items():
+            key_path = f"{path}/{_escape(key)}"
+            if key not in old:
+                ops.append({"op": "add", "path": key_path, "value": value})
+            else:
+                ops += make_patch(old[key], value, key_path)
+
+        for key in old:
+            if key not in new:
+                ops.append({"op": "remove", "path": f"{path}/{_escape(key)}"})
+
+        return ops
+
+    if isinstance(old, list) and len(new) > len(old) and new[: len(old)] == old:
+        return [{"op": "add", "path": f"{path}/-", "value": value} for value in new[len(old) :]]
+
+    if old != new:
+        return [{"op": "replace", "path": path, "value": new}]
+
+    return []
+
+
+def apply_patch(doc: Any, ops: Iterable[dict]) -> Any:
+    for op in ops:
+        if op["path"] == "":
+            doc = copy.deepcopy(op["value"])
+            continue
+
+        *parents, last = [_unescape(part) for part in op["path"].split("/")[1:]]
+
+        target = doc
+        for part in parents:
+            target = target[int(part)] if isinstance(target, list) else target[part]
+
+        if isinstance(target, list):
+            if last == "-":
+                target.append(copy.deepcopy(op["value"]))
+            elif op["op"] == "remove":
+                del target[int(last)]
+            else:
+                target[int(last)] = copy.deepcopy(op["value"])
+        elif op["op"] == "remove":
+            del target[last]
+        else:
+            target[last] = copy.deepcopy(op["value"])
+
+    return doc
+
+
+class History:
+    """
+    Append-only version history for one kind of document.
+
+    Each entity's history is a chain of entries: a full snapshot, followed by patches against the previous version. A new
+    snapshot is written every snapshot_interval versions so reconstructing never has to replay more than that many patches.
+    Nothing is written until a document actually changes, so unchanged entities cost nothing.
+    """
+
+    def __init__(self, collection_name: str, source_collection: str, field: str, ignored_keys: Iterable[str] = ()):
+        self.collection_name = collection_name
+        # where the live documents are, e.g. youtube_videos / video (with the id at video.id)
+        self.source_collection = source_collection
+        self.field = field
+        self.ignored_keys = set(ignored_keys)
+
+        self.enabled = True
+        self.snapshot_interval = 20
+
+    def configure(self, enabled: bool, snapshot_interval: int):
+        self.enabled = enabled
+        self.snapshot_interval = max(1, snapshot_interval)
+
+    def update_indexes(self):
+        db[self.collection_name].create_index([("entity_id", ASCENDING), ("version", ASCENDING)], unique=True)
+        db[self.collection_name].create_index([("entity_id", ASCENDING), ("time", ASCENDING)])
+
+    def _strip(self, doc: dict):
+        return {key: value for key, value in doc.items() if key not in self.ignored_keys}
+
+    def _entry(self, entity_id, version: int, base_version: int, time: datetime, hash: str, doc: dict | None = None, ops=None):
+        # hash is of the document as of this version, so the next change can tell whether it carries on from here
+        entry = {"entity_id": entity_id, "version": version, "base_version": base_version, "time": time, "hash": hash}
+        if doc is not None:
+            entry["snapshot"] = doc
+        else:
+            entry["patch"] = ops
+
+        return entry
+
+    def _rebuild(self, entity_id, last: dict) -> dict | None:
+        # the document as of last, for entries written before they had a hash
+        collection = db[self.collection_name]
+
+        snapshot = collection.find_one({"entity_id": entity_id, "version": last["base_version"], "snapshot": {"$exists": True}})
+        if not snapshot:
+            return None
+
+        patches = collection.find(
+            {"entity_id": entity_id, "version": {"$gt": last["base_version"], "$lte": last["version"]}},
+            {"patch": 1},
+            sort=[("version", ASCENDING)],
+        )
+
+        doc = snapshot["snapshot"]
+        for entry in patches:
+            doc = apply_patch(doc, entry["patch"])
+
+        return doc
+
+    def _continues(self, entity_id, last: dict, previous: dict):
+        if "hash" in last:
+            return last["hash"] == content_hash(previous)
+
+        return self._rebuild(entity_id, last) == previous
+
+    def record(self, entity_id, previous: dict, previous_time: datetime, current: dict, time: datetime) -> bool:
+        """
+        Records the change from previous to current, returns whether anything (that we care about) changed.
+        """
+
+        previous = self._strip(previous)
+        current = self._strip(current)
+
+        ops = make_patch(previous, current)
+        if not ops:
+            return False
+
+        if not self.enabled:
+            return True
+
+        # another thread or node recording the same entity can take the version we picked (it's unique per entity), in which
+        # case read the chain again and go after theirs
+        for attempt in range(RECORD_ATTEMPTS):
+            try:
+                self._insert_change(entity_id, previous, previous_time, current, time, ops)
+                return True
+            except BulkWriteError as e:
+                duplicate = all(error.get("code") == DUPLICATE_KEY for error in e.details.get("writeErrors", []))
+                if not duplicate or attempt == RECORD_ATTEMPTS - 1:
+                    raise
+
+        return True
+
+    def _insert_change(self, entity_id, previous: dict, previous_time: datetime, current: dict, time: datetime, ops: list):
+        collection = db[self.collection_name]
+        last = collection.find_one(
+            {"entity_id": entity_id},
+            {"version": 1, "base_version": 1, "hash": 1},
+            sort=[("version", DESCENDING)],
+        )
+
+        entries = []
+        current_hash = content_hash(current)
+
+        # chain is missing or doesn't end at the version we're diffing against (e.g. history was disabled for a while),
+        # start a new base from the previous version. rescans that didn't change anything don't write history, so this goes
+        # by what the last version looked like rather than when it was scanned
+        if not last or not self._continues(entity_id, last, previous):
+            version = last["version"] + 1 if last else 0
+            entries.append(self._entry(entity_id, version, version, previous_time, content_hash(previous), doc=previous))
+            last = {"version": version, "base_version": version}
+
+        version = last["version"] + 1
+        if version - last["base_version"] >= self.snapshot_interval:
+            entries.append(self._entry(entity_id, version, version, time, current_hash, doc=current))
+        else:
+            entries.append(self._entry(entity_id, version, last["base_version"], time, current_hash, ops=ops))
+
+        collection.insert_many(entries, ordered=True)
+
+    def as_of(self, entity_id, time: datetime) -> dict | None:
+        """
+        Reconstructs the document as it was at the given time, or None if we don't know what it looked like back then.
+        """
+
+        collection = db[self.collection_name]
+
+        snapshot = collection.find_one(
+            {"entity_id": entity_id, "time": {"$lte": time}, "snapshot": {"$exists": True}},
+            sort=[("version", DESCENDING)],
+        )
+        if not snapshot:
+            if collection.find_one({"entity_id": entity_id}, {"_id": 1}):
+                return None  # history starts after the requested time
+
+            # never changed since we started tracking it, so the live version is the answer, as long as we'd already seen it
+            # by then. documents are created by upserts so their _id says when that was
+            live = db[self.source_collection].find_one({f"{self.field}.id": entity_id}, {self.field: 1})
+            if not live:
+                return None
+
+            if isinstance(live["_id"], ObjectId) and time < live["_id"].generation_time:
+                return None
+
+            return self._strip(live[self.field])
+
+        patches = collection.find(
+            {
+                "entity_id": entity_id,
+                "base_version": snapshot["version"],
+                "version": {"$gt": snapshot["version"]},
+                "time": {"$lte": time},
+            },
+            {"patch": 1},
+            sort=[("version", ASCENDING)],
+        )
+
+        doc = snapshot["snapshot"]
+        for entry in patches:
+            doc = apply_patch(doc, entry["patch"])
+
+        return doc
+
+    def versions(self, entity_id) -> list[tuple[datetime, dict]]:
+        doc: dict | None = None
+        versions = []
+
+        for entry in db[self.collection_name].find({"entity_id": entity_id}, sort=[("version", ASCENDING)]):
+            doc = entry["snapshot"] if "snapshot" in entry else apply_patch(copy.deepcopy(doc), entry["patch"])
+            versions.append((entry["time"], doc))
+
+        return versions
+
+    def compact(self, older_than: datetime, granularity: timedelta):
+        """
+        Thins out history older than older_than so only the last version in each granularity bucket is kept, then rewrites
+        those entities' chains.
+        """
+
+        collection = db[self.collection_name]
+
+        # only entities with more than one version in some old bucket need rewriting
+        bucket_ms = max(1, int(granularity.total_seconds() * 1000))
+        pipeline: list[dict] = [
+            {"$match": {"time": {"$lt": older_than}}},
+            {
+                "$group": {
+                    "_id": {
+                        "entity_id": "$entity_id",
+                        "bucket": {"$floor": {"$divide": [{"$subtract": ["$time", EPOCH]}, bucket_ms]}},
+                    },
+                    "count": {"$sum": 1},
+                }
+            },
+            {"$match": {"count": {"$gt": 1}}},
+            {"$group": {"_id": "$_id.entity_id"}},
+        ]
+
+        compacted = 0
+        for group in collection.aggregate(pipeline, allowDiskUse=True):
+            entity_id = group["_id"]
+
+            kept: dict[Any, tuple[datetime, dict]] = {}
+            for time, doc in self.versions(entity_id):
+                key = int((time - EPOCH).total_seconds() * 1000) // bucket_ms if time < older_than else (time,)
+                kept[key] = (time, doc)  # later versions in the same bucket win
+
+            last = collection.find_one({"entity_id": entity_id}, {"version": 1}, sort=[("version", DESCENDING)])
+            if not last:
+                continue
+
+            # the new chain goes after the old one and the old one is only deleted once it's written, so nothing's lost if
+            # archie dies in between. a record() that lands in the meantime takes the version we wanted, so this entity is
+            # left for next time
+            first_version = last["version"] + 1
+            entries = []
+
+            previous = None
+            base_version = first_version
+            for version, (time, doc) in enumerate(kept.values(), first_version):
+                hash = content_hash(doc)
+                if previous is None or version - base_version >= self.snapshot_interval:
+                    base_version = version
+                    entries.append(self._entry(entity_id, version, version, time, hash, doc=doc))
+                else:
+                    entries.append(self._entry(entity_id, version, base_version, time, hash, ops=make_patch(previous, doc)))
+
+                previous = doc
+
+            try:
+                collection.insert_many(entries, ordered=True)
+            except BulkWriteError as e:
+                inserted = e.details.get("nInserted", 0)
+                collection.delete_many(
+                    {"entity_id": entity_id, "version": {"$gte": first_version, "$lt": first_version + inserted}}
+                )
+                continue
+
+            collection.delete_many({"entity_id": entity_id, "version": {"$lt": first_version}})
+            compacted += 1
+
+        if compacted:
+            log(f"compacted history for {compacted} entities in {self.collection_name}")
@@ -1,5 +1,201 @@
-from pymongo import MongoClient
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Iterable, Iterator, cast
 
-# TODO: store in config(?)
-client: MongoClient = MongoClient("localhost", 27017, tz_aware=True)
-db = client.get_database("archie")
+from pymongo import MongoClient, monitoring
+from pymongo.database import Database
+
+from archie.utils import metrics, utils
+
+
+class CommandMetrics(monitoring.CommandListener):
+    # times every command sent to mongo, by command and collection
+    def __init__(self):
+        self._collections: dict[int, str] = {}
+        self._lock = threading.Lock()
+
+    def started(self, event: monitoring.CommandStartedEvent):
+        # getMore's value is the cursor id, the collection's in its own field
+        collection = event.command.get("collection" if event.command_name == "getMore" else event.command_name)
+        with self._lock:
+            self._collections[event.request_id] = collection if isinstance(collection, str) else ""
+
+    def _finish(self, event, error: bool):
+        with self._lock:
+            collection = self._collections.pop(event.request_id, "")
+
+        duration = event.duration_micros / 1_000_000
+        metrics.mongo_duration.observe(duration, command=event.command_name, collection=collection)
+        metrics.slow_spans.record(
+            f"mongo.{event.command_name}", time.perf_counter() - duration, duration, error, collection=collection
+        )
+        return collection
+
+    def succeeded(self, event: monitoring.CommandSucceededEvent):
+        self._finish(event, False)
+
+    def failed(self, event: monitoring.CommandFailedEvent):
+        collection = self._finish(event, True)
+        metrics.mongo_errors.inc(command=event.command_name, collection=collection)
+
+
+def _connect():
+    # TODO: store in config(?)
+    return MongoClient("localhost", 27017, tz_aware=True, event_listeners=[CommandMetrics()])
+
+
+# created on first use, so commands that never touch mongo don't start its connection threads
+client = cast(MongoClient, utils.Lazy(_connect))
+db = cast(Database, utils.Lazy(lambda: client.get_database("archie")))
+
+
+def use_client(new_client: MongoClient, database_name: str = "archie"):
+    # swaps in another client/database before anything touches them (the benchmark uses this for its throwaway database)
+    cast(utils.Lazy, client).set(new_client)
+    cast(utils.Lazy, db).set(new_client.get_database(database_name))
+
+
+def diff_update(previous: dict | None, document: dict, set_fields: Iterable[str] = ()) -> dict:
+    """
+    Builds an update that turns previous into document, only touching top-level fields that actually changed.
+
+    Lists that were only appended/prepended to become a $push, and fields listed in set_fields (id lists where order doesn't
+    matter) that only gained items become an $addToSet. Non-underscore fields missing from document are unset so this behaves
+    like a replace, underscore fields are left alone since they can be owned by other writers.
+    """
+
+    if previous is None:
+        return {"$set": document}
+
+    update: dict[str, dict[str, Any]] = {}
+
+    def add(op: str, key: str, value: Any):
+        update.setdefault(op, {})[key] = value
+
+    for key, value in document.items():
+        if key not in previous:
+            add("$set", key, value)
+            continue
+
+        old = previous[key]
+        if old == value:
+            continue
+
+        if isinstance(old, list) and isinstance(value, list) and len(value) > len(old):
+            if value[: len(old)] == old:
+                add("$push", key, {"$each": value[len(old) :]})
+                continue
+
+            if value[len(value) - len(old) :] == old:
+                add("$push", key, {"$each": value[: len(value) - len(old)], "$position": 0})
+                continue
+
+            if key in set_fields:
+                try:
+                    old_set = set(old)
+                    if old_set.issubset(value):
+                        add("$addToSet", key, {"$each": [item for item in value if item not in old_set]})
+                        continue
+                except TypeError:
+                    pass  # unhashable, just set it
+
+        add("$set", key, value)
+
+    for key in previous:
+        if key not in document and not key.startswith("_"):
+            add("$unset", key, "")
+
+    return update
+
+
+def upsert(collection_name: str, filter: dict, previous: dict | None, document: dict, set_fields: Iterable[str] = ()):
+    update = diff_update(previous, document, set_fields)
+    if update:
+        db[collection_name].update_one(filter, update, upsert=True)
+
+
+def iterate_batches(
+    collection_name: str,
+    match: dict,
+    checkpoint_name: str,
+    batch_size: int = 100,
+    pipeline: Iterable[dict] = (),
+    keep: Callable[[dict], bool] | None = None,
+    per_node: bool = True,
+) -> Iterator[dict]:
+    """
+    Walks the documents matching match in _id order, batch_size at a time, without holding a cursor open.
+
+    The position is saved in queue_checkpoints after every batch (and wherever we stopped, if the caller stops early), so if
+    we're restarted halfway through we carry on from there. After a crash that can mean going over up to one batch again.
+    The next batch is fetched in the background while the current one is being worked through. Extra pipeline stages run on
+    each batch after the limit, so they shouldn't drop documents - use keep to filter instead.
+
+    With clustering on, every node walks the queue itself (claiming what it works on) so each keeps its own checkpoint,
+    otherwise they'd move each other's position past documents they haven't got to. Work that only one node does at a time
+    under a lease can pass per_node=False, so whoever picks it up next carries on from the same place.
+    """
+
+    # base_cluster imports this module
+    from .base_cluster import cluster
+
+    if per_node and cluster.enabled:
+        checkpoint_name = f"{checkpoint_name}:{cluster.node_name}"
+
+    checkpoints = db["queue_checkpoints"]
+
+    def fetch(after):
+        query = match if after is None else {"$and": [match, {"_id": {"$gt": after}}]}
+        return list(db[collection_name].aggregate([{"$match": query}, {"$sort": {"_id": 1}}, {"$limit": batch_size}, *pipeline]))
+
+    def save(last_id):
+        checkpoints.update_one({"_id": checkpoint_name}, {"$set": {"last_id": last_id}}, upsert=True)
+
+    checkpoint = checkpoints.find_one({"_id": checkpoint_name})
+    saved = done = checkpoint["last_id"] if checkpoint else None
+
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        next_batch = executor.submit(fetch, saved)
+
+        try:
+            while True:
+                batch = next_batch.result()
+                if not batch:
+                    # finished a full pass, start from the beginning next time
+                    checkpoints.delete_one({"_id": checkpoint_name})
+                    saved = done
+                    return
+
+                next_batch = executor.submit(fetch, batch[-1]["_id"])
+
+                for doc in batch:
+                    if keep and not keep(doc):
+                        continue
+
+                    yield doc
+
+                    done = doc["_id"]
+
+                done = saved = batch[-1]["_id"]
+                save(saved)
+        finally:
+            # stopped partway through a batch (closed early or the caller raised), keep what was finished
+            if done != saved:
+                save(done)
+
+
+def find_page(
+    collection_name: str,
+    filter: dict,
+    after: Any = None,
+    limit: int = 100,
+    projection: dict | None = None,
+    descending: bool = False,
+):
+    # keyset pagination on _id, carrying on after the last _id of the previous page. with an index on (filter fields, _id)
+    # every page is a single index range scan no matter how deep into the collection it is, unlike skip
+    if after is not None:
+        filter = {**filter, "_id": {"$lt" if descending else "$gt": after}}
+
+    return db[collection_name].find(filter, projection, sort=[("_id", -1 if descending else 1)], limit=limit)
@@ -0,0 +1,55 @@
+import queue
+import threading
+from typing import Any, Callable
+
+from archie.utils import metrics, utils
+
+
+def log(*args, **kwargs):
+    utils.module_log("pipeline", "dim", *args, **kwargs)
+
+
+class Stage:
+    """
+    One step of a download after the network part is done (muxing, moving into place...), run by its own worker threads off
+    its own queue.
+
+    The queue is bounded, so put() blocks once it's full - if ffmpeg can't keep up, fetch workers stop picking up new
+    downloads instead of filling the drive with unmerged streams. The handler owns the item from then on, including cleaning
+    up after itself if it fails; exceptions are only logged here.
+    """
+
+    def __init__(self, service: str, name: str, handler: Callable[[Any], None], workers: int, queue_size: int):
+        self.service = service
+        self.name = name
+        self.handler = handler
+        self.workers = workers
+
+        self._queue: queue.Queue = queue.Queue(queue_size)
+        self._busy = 0
+        self._lock = threading.Lock()
+
+        metrics.pipeline_queue.set_function(self._queue.qsize, service=service, stage=name)
+        metrics.pipeline_busy.set_function(lambda: self._busy, service=service, stage=name)
+
+    def start(self):
+        for i in range(self.workers):
+            threading.Thread(target=self._work, name=f"{self.service} {self.name}", daemon=True).start()
+
+    def put(self, item: Any):
+        self._queue.put(item)
+
+    def _work(self):
+        while True:
+            item = self._queue.get()
+
+            with self._lock:
+                self._busy += 1
+
+            try:
+                self.handler(item)
+            except Exception as e:
+                log(f"{self.service} {self.name} failed: {e}")
+            finally:
+                with self._lock:
+                    self._busy -= 1
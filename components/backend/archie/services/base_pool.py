@@ -0,0 +1,67 @@
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Callable
+
+from archie.utils import utils
+
+from .base_download import progress_renderer
+
+
+def log(*args, **kwargs):
+    utils.module_log("workers", "cyan", *args, **kwargs)
+
+
+class WorkerPool:
+    """
+    Worker processes for the CPU-heavy parts of a service (yt-dlp's extraction, format picking and post-processing), which
+    otherwise fight every other thread in archie for the GIL.
+
+    Whatever runs here has to be a module-level function and everything passed in or out gets pickled, so keep results to
+    plain data. Downloads report progress by putting (key, completed, total) on progress, and read their rate limit from a
+    shared dict (see shared_params) since the scheduler can't reach into another process's yt-dlp params.
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self.processes = 0
+
+        self._executor: ProcessPoolExecutor | None = None
+        self._manager: Any = None
+        self.progress: Any = None
+
+    @property
+    def running(self):
+        return self._executor is not None
+
+    def start(self, processes: int = 0):
+        self.processes = processes or os.cpu_count() or 1
+
+        # spawn, not fork. forking copies a process that already has mongo and http threads running, and whatever locks
+        # they held at the time stay locked forever in the child
+        context = multiprocessing.get_context("spawn")
+
+        self._manager = context.Manager()
+        self.progress = self._manager.Queue()
+        self._executor = ProcessPoolExecutor(self.processes, mp_context=context)
+
+        threading.Thread(target=self._forward_progress, name=f"{self.name} progress", daemon=True).start()
+        log(f"started {self.processes} {self.name} worker processes")
+
+    def _forward_progress(self):
+        while True:
+            try:
+                key, completed, total = self.progress.get()
+            except (EOFError, OSError):
+                return  # manager went away, we're shutting down
+
+            progress_renderer.update(key, completed, total)
+
+    def shared_params(self) -> dict:
+        # a dict both sides can see, DownloadJob.bind() works on it the same as on yt-dlp's own params
+        return self._manager.dict()
+
+    def run(self, fn: Callable, *args):
+        assert self._executor, "worker pool isn't running"
+        return self._executor.submit(fn, *args).result()
@@ -0,0 +1,131 @@
+from datetime import datetime, timedelta, timezone
+from typing import Any, Iterable
+
+from pymongo import UpdateOne
+
+from archie.config import AdaptiveScanOptions
+
+from .base_mongo import db
+
+
+def _get_path(doc: dict, path: str) -> Any:
+    value: Any = doc
+    for part in path.split("."):
+        if not isinstance(value, dict):
+            return None
+
+        value = value.get(part)
+
+    return value
+
+
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+
+def next_scan_time(db_doc: dict | None, gap_hours: float) -> datetime:
+    if not db_doc or db_doc["_scan_source"] != "full":
+        return EPOCH  # due now
+
+    # documents scanned before adaptive scheduling existed don't have _next_scan yet
+    next_scan = db_doc.get("_next_scan")
+    if next_scan is not None:
+        return next_scan
+
+    return db_doc["_scan_time"] + timedelta(hours=gap_hours)
+
+
+def due_query(min_update_time: datetime) -> dict:
+    # documents due for a rescan, plus anything that hasn't been fully scanned yet
+    return {
+        "$or": [
+            {"_scan_source": {"$ne": "full"}},
+            {"_next_scan": {"$lt": datetime.now(timezone.utc)}},
+            {"_next_scan": {"$exists": False}, "_scan_time": {"$lt": min_update_time}},
+        ]
+    }
+
+
+class RescanPolicy:
+    """
+    Works out when a fully scanned document should be scanned again.
+
+    Every rescan that finds no activity (none of activity_fields changed) multiplies the interval by backoff, and every rescan
+    that does multiplies it by activity_factor, clamped to [gap * min_factor, gap * max_factor].
+    """
+
+    def __init__(self, gap_hours: float, options: AdaptiveScanOptions, activity_fields: Iterable[str]):
+        self.gap_hours = gap_hours
+        self.options = options
+        self.activity_fields = tuple(activity_fields)
+
+    def is_active(self, previous: dict, current: dict):
+        return any(_get_path(previous, field) != _get_path(current, field) for field in self.activity_fields)
+
+    def schedule(self, previous: dict | None, current: dict) -> dict:
+        interval = self.gap_hours
+
+        if self.options.enabled and previous and previous.get("_scan_source") == "full":
+            interval = previous.get("_scan_interval", self.gap_hours)
+            interval *= self.options.activity_factor if self.is_active(previous, current) else self.options.backoff
+            interval = min(max(interval, self.gap_hours * self.options.min_factor), self.gap_hours * self.options.max_factor)
+
+        return {
+            "_scan_interval": interval,
+            "_next_scan": current["_scan_time"] + timedelta(hours=interval),
+        }
+
+
+class AccountQueue:
+    """
+    The configured accounts for a service, mirrored into their own collection along with when they're next due.
+
+    This way picking the accounts that need parsing is a single indexed query rather than a lookup per account.
+    """
+
+    def __init__(self, collection_name: str, source_collection: str, field: str):
+        self.collection_name = collection_name
+        # where the account documents are, e.g. youtube_channels / channel (with the id at channel.id)
+        self.source_collection = source_collection
+        self.field = field
+
+    def update_indexes(self):
+        db[self.collection_name].create_index("_next_scan")
+
+    def sync(self, account_ids: list, gap_hours: float):
+        collection = db[self.collection_name]
+        collection.delete_many({"_id": {"$nin": account_ids}})
+
+        if not account_ids:
+            return
+
+        db_accounts = {
+            doc[self.field]["id"]: doc
+            for doc in db[self.source_collection].find(
+                {f"{self.field}.id": {"$in": account_ids}},
+                {f"{self.field}.id": 1, "_scan_source": 1, "_scan_time": 1, "_next_scan": 1},
+            )
+        }
+
+        collection.bulk_write(
+            [
+                UpdateOne(
+                    {"_id": account_id},
+                    {"$set": {"_next_scan": next_scan_time(db_accounts.get(account_id), gap_hours)}},
+                    upsert=True,
+                )
+                for account_id in account_ids
+            ]
+        )
+
+    def get_due(self, account_ids: list):
+        return db[self.collection_name].find(
+            {
+                "_id": {"$in": account_ids},
+                "_next_scan": {"$lte": datetime.now(timezone.utc)},
+            },
+            sort=[("_next_scan", 1)],
+        )
+
+    def set_next_scan(self, account_id, next_scan: datetime):
+        # no upsert, this only does anything for configured accounts
+        db[self.collection_name].update_one({"_id": account_id}, {"$set": {"_next_scan": next_scan}})
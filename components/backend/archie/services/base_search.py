@@ -0,0 +1,114 @@
+from datetime import datetime, timezone
+from typing import Any, Callable, Iterable
+
+from pymongo import ReplaceOne
+
+from archie.config import SearchOptions
+from archie.utils import utils
+
+from .base_mongo import db, iterate_batches
+
+
+def log(*args, **kwargs):
+    utils.module_log("search", "green", *args, **kwargs)
+
+
+def search_entry(service: str, kind: str, id: Any, title: str | None, body: str | None, author: str | None, parent: Any = None):
+    return {
+        "_id": f"{service}:{kind}:{id}",
+        "service": service,
+        "kind": kind,
+        "item_id": id,
+        "parent_id": parent,
+        "title": title or "",
+        "author": author or "",
+        "body": body or "",
+    }
+
+
+class SearchIndex:
+    """
+    One small document per searchable thing (channel, user, video, track, playlist, comment) in search_index, with a mongo
+    text index over its title, author and body.
+
+    Everything lives in one collection since mongo only allows one text index per collection, and searching across services
+    means one query. The store functions keep it up to date as they go, only writing entries that changed since the stored
+    version. Whatever was stored before the index existed is added by backfill().
+    """
+
+    def __init__(self, collection_name: str = "search_index"):
+        self.collection_name = collection_name
+        self.options = SearchOptions()
+
+    @property
+    def enabled(self):
+        return self.options.enabled
+
+    def configure(self, options: SearchOptions):
+        self.options = options
+
+    def update_indexes(self):
+        db[self.collection_name].create_index(
+            [("title", "text"), ("author", "text"), ("body", "text")],
+            name="search_text",
+            weights={"title": 10, "author": 5, "body": 1},
+            # titles are in every language under the sun, so no stemming or stop words
+            default_language="none",
+            language_override="_language",
+        )
+        db[self.collection_name].create_index("parent_id")
+
+    def update(self, entries: Iterable[dict], previous: Iterable[dict] = ()):
+        # previous is what was indexed for the version that's being replaced, anything that didn't change isn't written
+        if not self.enabled:
+            return
+
+        old = {entry["_id"]: entry for entry in previous}
+
+        writes = [ReplaceOne({"_id": entry["_id"]}, entry, upsert=True) for entry in entries if old.get(entry["_id"]) != entry]
+        if writes:
+            db[self.collection_name].bulk_write(writes, ordered=False)
+
+    def backfill(self, collection_name: str, get_entries: Callable[[dict], list[dict]], pipeline: Iterable[dict] = ()):
+        # indexes everything in collection_name once. resumable, and done for good once it's been through the whole thing
+        if not self.enabled or db["search_backfills"].count_documents({"_id": collection_name}, limit=1):
+            return
+
+        log(f"indexing existing {collection_name}")
+
+        count = 0
+        # only run by whichever node holds the backfill lease, so they can share a checkpoint
+        for doc in iterate_batches(collection_name, {}, f"search_backfill:{collection_name}", 500, pipeline, per_node=False):
+            self.update(get_entries(doc))
+            count += 1
+
+        db["search_backfills"].insert_one({"_id": collection_name, "finished": datetime.now(timezone.utc), "count": count})
+        log(f"indexed {count} existing {collection_name}")
+
+    def search(
+        self,
+        query: str,
+        service: str | None = None,
+        kind: str | None = None,
+        after: tuple[float, str] | None = None,
+        limit: int = 20,
+    ) -> list[dict]:
+        # best matches first. after is the (score, _id) of the last result of the previous page
+        match: dict = {"$text": {"$search": query}}
+        if service:
+            match["service"] = service
+        if kind:
+            match["kind"] = kind
+
+        pipeline: list[dict] = [{"$match": match}, {"$addFields": {"score": {"$meta": "textScore"}}}]
+
+        if after:
+            score, id = after
+            pipeline.append({"$match": {"$or": [{"score": {"$lt": score}}, {"score": score, "_id": {"$gt": id}}]}})
+
+        pipeline += [{"$sort": {"score": -1, "_id": 1}}, {"$limit": limit}]
+
+        return list(db[self.collection_name].aggregate(pipeline))
+
+
+search_index = SearchIndex()
@@ -7,14 +7,19 @@ from typing import Set, cast
 from soundcloud import SoundCloud
 
 from archie.config import Config
-from archie.services.base_download import copy_download
+from archie.services.base_catalog import file_catalog
+from archie.services.base_cluster import cluster
+from archie.services.base_download import copy_download, download_scheduler
+from archie.services.base_schedule import RescanPolicy
 from archie.services.base_service import BaseService
-from archie.utils import utils
+from archie.utils import metrics, utils
 
 from . import database as db
-from .download import download_track
+from .client import TRACKS_BATCH_SIZE, CachedSoundCloud
+from .download import download_track, get_estimated_size
 
-sc = SoundCloud()
+# every call is timed, see metrics. creating the client fetches a client id, so that waits until it's first used
+sc = CachedSoundCloud(utils.Lazy(lambda: metrics.Instrumented(SoundCloud(), "soundcloud")))
 
 # TODO: a lot of this is the same as youtube, figure out how to generalise
 # TODO: multithreaded parsing? generalise thread locks? i don't think there's a rate limit?
@@ -46,36 +51,50 @@ class SoundCloudService(BaseService):
         return user.id
 
     def run(self, config: Config):
+        db.configure_history(config.history)
+        db.configure_caches(config.cache)
+        download_scheduler.configure(config.downloads)
+        sc.configure(config.services.soundcloud)
+
+        if sc.persist:
+            threading.Thread(target=sc.save_forever, daemon=True).start()
+
         threading.Thread(target=self._background, daemon=True).start()
-        threading.Thread(target=self._check_downloads, args=(config,), daemon=True).start()
-        threading.Thread(target=self._parse, args=(config,), daemon=True).start()
+        threading.Thread(target=db.warm_caches, daemon=True).start()
+
+        if cluster.has_role("parse"):
+            threading.Thread(target=self._backfill_owner_status, daemon=True).start()
+            threading.Thread(target=self._backfill_search, daemon=True).start()
+            threading.Thread(target=self._compact_history, args=(config,), daemon=True).start()
+            threading.Thread(target=self._parse, args=(config,), daemon=True).start()
+
+        if cluster.has_role("download"):
+            threading.Thread(target=self._check_downloads, args=(config,), daemon=True).start()
 
-        for i in range(5):
-            threading.Thread(target=self._download_tracks, args=(config,), daemon=True).start()
+            for i in range(config.downloads.fetch_workers):
+                threading.Thread(target=self._download_tracks, args=(config,), daemon=True).start()
 
     def _background(self):
         while True:
             db.update_indexes()
             time.sleep(10)
 
-    def __parse_users(self, config: Config):
-        user_min_update_time = datetime.now(timezone.utc) - timedelta(hours=config.services.soundcloud.user_update_gap_hours)
+    def _parse_users(self, config: Config, account_ids: list[int]):
+        options = config.services.soundcloud
+        rescan = RescanPolicy(options.user_update_gap_hours, options.adaptive, db.USER_ACTIVITY_FIELDS)
 
-        for account, entity, archive in config.get_accounts(self.service_name):
-            db_user = db.get_user(account.id)
-            if db_user:
-                # TODO: move this stuff into aggregation?
-                if db_user["_scan_source"] == "full" and db_user["_scan_time"] > user_min_update_time:
-                    continue
+        # only the accounts that are actually due come back, so this is one query when there's nothing to do
+        for db_account in cluster.claim_each(
+            "soundcloud.user", db.get_accounts_to_parse(account_ids), lambda doc: doc["_id"], "soundcloud_accounts", "_next_scan"
+        ):
+            account_id = db_account["_id"]
+            log(f"parsing user ({account_id})")
 
-                log(f"updating user {db_user['user']['username']} ({account.id})")
-            else:
-                log(f"parsing user ({account.id})")
-
-            user = sc.get_user(cast(int, account.id))
+            user = sc.get_user(account_id)
             if not user:
                 # TODO: handle
-                log(f"failed to parse user ({account.id})")
+                log(f"failed to parse user ({account_id})")
+                metrics.parse_failures.inc(service="soundcloud", kind="user")
                 continue
 
             tracks = list(sc.get_user_tracks(user.id, limit=80000))
@@ -83,40 +102,91 @@ class SoundCloudService(BaseService):
             links = sc.get_user_links(user.urn)
             reposts = list(sc.get_user_reposts(user.id, limit=80000))
 
-            db.store_user(user, "full", "accepted", tracks, playlists, links, reposts)
+            db.store_user(user, "full", "accepted", tracks, playlists, links, reposts, rescan=rescan)
+            metrics.items_parsed.inc(service="soundcloud", kind="user")
             log(f"parsed user {user.username} ({user.id})")
 
-    def __parse_tracks(self, config: Config):
-        track_min_update_time = datetime.now(timezone.utc) - timedelta(hours=config.services.soundcloud.track_update_gap_hours)
-
-        for db_track in db.get_track_to_parse(track_min_update_time):
-            track_id = db_track["track"]["id"]
+    def _parse_tracks(self, config: Config):
+        options = config.services.soundcloud
+        track_min_update_time = datetime.now(timezone.utc) - timedelta(hours=options.track_update_gap_hours)
+        rescan = RescanPolicy(options.track_update_gap_hours, options.adaptive, db.TRACK_ACTIVITY_FIELDS)
+
+        for batch in cluster.claim_batches(
+            "soundcloud.track",
+            db.get_track_to_parse(track_min_update_time),
+            lambda doc: doc["track"]["id"],
+            TRACKS_BATCH_SIZE,
+            "soundcloud_tracks",
+        ):
+            # fetched in one go once they're claimed, so nodes don't fetch each other's tracks. get_track finds them cached
+            sc.prefetch_tracks(doc["track"]["id"] for doc in batch)
+
+            for db_track in batch:
+                self._parse_track(db_track, rescan)
+
+    def _parse_track(self, db_track: dict, rescan: RescanPolicy):
+        track_id = db_track["track"]["id"]
+
+        log(f"parsing track ({track_id})")
+        track = sc.get_track(track_id)
+        if not track:
+            # failed to dl, edge case, store it in db
+            db.store_track_error(db_track["track"]["id"], "get_track fail")
+            metrics.parse_failures.inc(service="soundcloud", kind="track")
+            return
+
+        albums = list(sc.get_track_albums(track_id, limit=80000))
+        comments = list(sc.get_track_comments(track_id, limit=80000))
+        likers = list(sc.get_track_likers(track_id, limit=80000))
+        reposters = list(sc.get_track_reposters(track_id, limit=80000))
+        playlists = list(sc.get_track_playlists(track_id, limit=80000))
+
+        db.store_track(track, "full", albums, comments, likers, reposters, playlists, rescan=rescan)
+        metrics.items_parsed.inc(service="soundcloud", kind="track")
+        log(f"parsed {track.user.username} - {track.title} ({track_id})")
 
-            log(f"parsing track ({track_id})")
-            track = sc.get_track(track_id)
-            if not track:
-                # failed to dl, edge case, store it in db
-                db.store_track_error(db_track["track"]["id"], "get_track fail")
-                continue
+    def _parse(self, config: Config):
+        account_ids = [cast(int, account.id) for account, entity, archive in config.get_accounts(self.service_name)]
+        db.sync_accounts(account_ids, config.services.soundcloud.user_update_gap_hours)
 
-            albums = list(sc.get_track_albums(track_id, limit=80000))
-            comments = list(sc.get_track_comments(track_id, limit=80000))
-            likers = list(sc.get_track_likers(track_id, limit=80000))
-            reposters = list(sc.get_track_reposters(track_id, limit=80000))
-            playlists = list(sc.get_track_playlists(track_id, limit=80000))
+        while True:
+            self._parse_users(config, account_ids)
+            self._parse_tracks(config)
 
-            db.store_track(track, "full", albums, comments, likers, reposters, playlists)
-            log(f"parsed {track.user.username} - {track.title} ({track_id})")
+            time.sleep(1)
 
-    def _parse(self, config: Config):
+    def _backfill_owner_status(self):
+        # only one node needs to do this
+        if cluster.claim("soundcloud.maintenance", "backfill_owner_status"):
+            try:
+                db.backfill_owner_status()
+            finally:
+                cluster.release("soundcloud.maintenance", "backfill_owner_status")
+
+    def _backfill_search(self):
+        # whatever was stored before the search index existed
+        if cluster.claim("soundcloud.maintenance", "backfill_search"):
+            try:
+                db.backfill_search()
+            finally:
+                cluster.release("soundcloud.maintenance", "backfill_search")
+
+    def _compact_history(self, config: Config):
         while True:
-            self.__parse_users(config)
-            self.__parse_tracks(config)
+            if cluster.claim("soundcloud.maintenance", "compact_history"):
+                try:
+                    db.compact_history(config.history)
+                finally:
+                    cluster.release("soundcloud.maintenance", "compact_history")
 
-            time.sleep(1)
+            time.sleep(60 * 60 * 24)
 
     def _check_downloads(self, config: Config):
-        for download in db.get_downloads():
+        # deleted and moved downloads are mostly dealt with by the catalog's first scan, this is just a fallback for them
+        file_catalog.scanned.wait()
+
+        # other nodes' downloads are on their disks, leave them to check their own
+        for download in db.get_downloads(cluster.node_name if cluster.enabled else None):
             track_id = download["track_id"]
             path = Path(download["path"])
 
@@ -142,10 +212,33 @@ class SoundCloudService(BaseService):
             for archive in track_archives:
                 copy_download(self.service_name, path, download["relative_video_path"], archive)
 
+    def _get_next_download(self, config: Config):
+        skip_ids = list(self._current_downloads.union(cluster.claimed_ids("soundcloud.download")))
+
+        for user_ids in download_scheduler.download_groups(config, self.service_name):
+            while track := db.get_undownloaded_track(skip_ids, download_scheduler.options.priority, user_ids):
+                if cluster.claim("soundcloud.download", track["track"]["id"]):
+                    return track
+
+                # another node got there first
+                skip_ids.append(track["track"]["id"])
+
+        return None
+
+    def __release_download(self, track_id: int):
+        with self._current_downloads_lock:
+            self._current_downloads.remove(track_id)
+
+        cluster.release("soundcloud.download", track_id)
+
     def _download_tracks(self, config: Config):  # TODO: some of this can be generalised most likely
         while True:
-            with self._current_downloads_lock:  # todo should this be looping over archives first idk
-                track = db.get_undownloaded_track(list(self._current_downloads))
+            if not download_scheduler.has_space():
+                time.sleep(10)
+                continue
+
+            with self._current_downloads_lock:
+                track = self._get_next_download(config)
 
                 if track:
                     self._current_downloads.add(track["track"]["id"])
@@ -174,22 +267,42 @@ class SoundCloudService(BaseService):
 
             assert sc_user and sc_track, "TODO: fix this"
 
-            download_data = download_track(sc_user, sc_track, download_path)
+            # scdl streams through ffmpeg so there's no way to throttle it, but it still counts towards everyone else's share
+            job = download_scheduler.start(self.service_name, get_estimated_size(track["track"]), [download_path])
+            if not job:
+                # not enough space for this one right now, leave it for later
+                self.__release_download(track["track"]["id"])
 
-            with self._current_downloads_lock:
-                self._current_downloads.remove(track["track"]["id"])
+                time.sleep(10)
+                continue
+
+            start = time.perf_counter()
+            try:
+                download_data = download_track(sc_user, sc_track, download_path)
+
+                # stored before letting go of it, otherwise another worker could pick it up again in between
+                if download_data:
+                    db.store_download(
+                        track["track"]["id"],
+                        download_data.path,
+                        download_data.video_relative_path,
+                        download_data.wave,
+                        cluster.node_name,
+                    )
+            finally:
+                download_scheduler.finish(job)
+                self.__release_download(track["track"]["id"])
 
             if not download_data:
+                metrics.download_failures.inc(service="soundcloud")
+
                 # download somehow failed 5 times, skip it
                 # todo: actually skip it, right now it'll just try to download it again
                 continue
 
-            db.store_download(
-                track["track"]["id"],
-                download_data.path,
-                download_data.video_relative_path,
-                download_data.wave,
-            )
+            metrics.downloads.inc(service="soundcloud")
+            metrics.download_bytes.inc(download_data.path.stat().st_size, service="soundcloud")
+            metrics.download_duration.observe(time.perf_counter() - start, service="soundcloud")
 
             for other_archive in user_archives[1:]:
                 copy_download(self.service_name, download_data.path, download_data.video_relative_path, other_archive)
@@ -0,0 +1,247 @@
+import os
+import pickle
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+from typing import Any, Callable, Hashable, Iterable
+
+from soundcloud import BasicAlbumPlaylist, BasicTrack, User, WebProfile
+
+from archie import ARCHIE_PATH
+from archie.config import SoundCloudOptions
+from archie.utils import metrics, utils
+
+CACHE_PATH = ARCHIE_PATH / "soundcloud-cache.pickle"
+
+# the most ids /tracks takes at once
+TRACKS_BATCH_SIZE = 50
+
+
+def log(*args, **kwargs):
+    utils.module_log("soundcloud cache", "orange3", *args, **kwargs)
+
+
+class ResponseCache:
+    # api responses by (call, *args), dropped once they're older than ttl or once there's more than max_entries of them
+
+    def __init__(self, max_entries: int = 20_000, ttl: float = 30 * 60):
+        self.max_entries = max_entries
+        self.ttl = ttl
+
+        self._entries: OrderedDict[Hashable, tuple[Any, float]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key: Hashable) -> tuple[bool, Any]:
+        # (found, value)
+        with self._lock:
+            entry = self._entries.get(key)
+            if not entry:
+                return False, None
+
+            value, expires = entry
+            if expires < time.time():
+                del self._entries[key]
+                return False, None
+
+            self._entries.move_to_end(key)
+            return True, value
+
+    def put(self, key: Hashable, value: Any, expires: float | None = None):
+        with self._lock:
+            self._entries[key] = (value, expires or time.time() + self.ttl)
+            self._entries.move_to_end(key)
+
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, key: Hashable):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def items(self) -> list[tuple[Hashable, tuple[Any, float]]]:
+        with self._lock:
+            return list(self._entries.items())
+
+
+class CachedSoundCloud:
+    """
+    Wraps the api client, remembering single user/track/playlist lookups for a while. The same user gets asked for by
+    get_account_url_from_id, when parsing it and again when downloading its tracks, and tracks are fetched for parsing and
+    then again for downloading.
+
+    Concurrent calls for the same thing are coalesced, only one of them goes to the api and the rest wait for its answer.
+    Tracks can be prefetched up to TRACKS_BATCH_SIZE at a time, get_track then finds them in the cache. None (not found or
+    the api failing) is never cached. Paginated lists (comments, likers...) aren't cached at all, they're only fetched once
+    per parse anyway and rescans are meant to see them fresh. Everything else is passed straight through to the client.
+    """
+
+    def __init__(self, client: Any):
+        self.client = client
+        self.persist = False
+
+        self._cache = ResponseCache()
+        self._in_flight: dict[Hashable, Future] = {}
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return self._cache.ttl > 0
+
+    def __getattr__(self, name: str):
+        return getattr(self.client, name)
+
+    def configure(self, options: SoundCloudOptions):
+        self._cache = ResponseCache(options.cache_max_entries, options.cache_ttl_minutes * 60)
+        self.persist = options.cache_persist and self.enabled
+
+        if self.persist:
+            self.load()
+
+    def _cached(self, call: str, fn: Callable, *args):
+        key = (call, *args)
+
+        found, value = self._cache.get(key)
+        if found:
+            metrics.api_cache.inc(call=call, result="hit")
+            return value
+
+        with self._lock:
+            # it might have been fetched (or started being fetched) since the lookup above
+            found, value = self._cache.get(key)
+            future = self._in_flight.get(key)
+
+            if not found and not future:
+                future = self._in_flight[key] = Future()
+                leader = True
+            else:
+                leader = False
+
+        if found:
+            metrics.api_cache.inc(call=call, result="hit")
+            return value
+
+        assert future
+        if not leader:
+            metrics.api_cache.inc(call=call, result="coalesced")
+            return future.result()
+
+        metrics.api_cache.inc(call=call, result="miss")
+        try:
+            value = fn(*args)
+            if value is not None and self.enabled:
+                self._cache.put(key, value)
+
+            future.set_result(value)
+            return value
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                del self._in_flight[key]
+
+    def get_user(self, user_id: int) -> User | None:
+        return self._cached("get_user", self.client.get_user, user_id)
+
+    def get_user_by_username(self, username: str) -> User | None:
+        user = self._cached("get_user_by_username", self.client.get_user_by_username, username)
+        if user and self.enabled:
+            self._cache.put(("get_user", user.id), user)
+
+        return user
+
+    def get_user_links(self, user_urn: str) -> list[WebProfile]:
+        return self._cached("get_user_links", self.client.get_user_links, user_urn)
+
+    def get_track(self, track_id: int) -> BasicTrack | None:
+        return self._cached("get_track", self.client.get_track, track_id)
+
+    def get_playlist(self, playlist_id: int) -> BasicAlbumPlaylist | None:
+        return self._cached("get_playlist", self.client.get_playlist, playlist_id)
+
+    def get_tracks(self, track_ids: Iterable[int]) -> list[BasicTrack]:
+        # whichever of them exist, cached ones aren't fetched again
+        track_ids = list(track_ids)
+        self.prefetch_tracks(track_ids)
+
+        tracks = []
+        for track_id in track_ids:
+            found, track = self._cache.get(("get_track", track_id))
+            if not found:
+                # caching's off or it was dropped in the meantime
+                track = self.get_track(track_id)
+
+            if track:
+                tracks.append(track)
+
+        return tracks
+
+    def prefetch_tracks(self, track_ids: Iterable[int]):
+        if not self.enabled:
+            return
+
+        missing = [track_id for track_id in dict.fromkeys(track_ids) if not self._cache.get(("get_track", track_id))[0]]
+
+        for i in range(0, len(missing), TRACKS_BATCH_SIZE):
+            batch = missing[i : i + TRACKS_BATCH_SIZE]
+
+            try:
+                tracks = self.client.get_tracks(batch) or []
+            except Exception as e:
+                # only an optimisation, get_track fetches them one by one instead
+                log(f"prefetching {len(batch)} tracks failed: {e}")
+                continue
+
+            # ones that don't come back (deleted, private) are left for get_track to find out about
+            for track in tracks:
+                self._cache.put(("get_track", track.id), track)
+
+            metrics.api_cache.inc(len(batch), call="get_track", result="prefetched")
+
+    def stats(self) -> dict:
+        calls = {}
+        for call in ("get_user", "get_user_by_username", "get_user_links", "get_track", "get_playlist"):
+            counts = {result: metrics.api_cache.total(call=call, result=result) for result in ("hit", "miss", "coalesced")}
+            lookups = sum(counts.values())
+
+            calls[call] = {**counts, "hit_rate": (counts["hit"] + counts["coalesced"]) / lookups if lookups else None}
+
+        return {"entries": len(self._cache), "ttl_seconds": self._cache.ttl, "calls": calls}
+
+    def load(self):
+        try:
+            with open(CACHE_PATH, "rb") as f:
+                entries = pickle.load(f)
+        except FileNotFoundError:
+            return
+        except Exception as e:
+            # e.g. written by a different version of the soundcloud library, it's only a cache
+            log(f"couldn't load {CACHE_PATH}, starting empty ({e})")
+            return
+
+        now = time.time()
+        for key, (value, expires) in entries:
+            if expires > now:
+                self._cache.put(key, value, expires)
+
+        log(f"loaded {len(self._cache)} cached responses")
+
+    def save(self):
+        temp_path = CACHE_PATH.with_suffix(".tmp")
+        with open(temp_path, "wb") as f:
+            pickle.dump(self._cache.items(), f)
+
+        os.replace(temp_path, CACHE_PATH)
+
+    def save_forever(self, interval: float = 5 * 60):
+        while True:
+            time.sleep(interval)
+
+            try:
+                self.save()
+            except Exception as e:
+                log(f"couldn't save {CACHE_PATH}: {e}")
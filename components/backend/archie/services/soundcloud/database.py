@@ -1,15 +1,186 @@
 from dataclasses import asdict
-from datetime import datetime, timezone
+from datetime import datetime, timedelta, timezone
 from pathlib import Path
 from typing import Literal
 
 import soundcloud
 
-from ..base_mongo import db
+from archie.config import CacheOptions, HistoryOptions
+from archie.utils import metrics
 
+from ..base_cache import IdCache
+from ..base_catalog import file_catalog
+from ..base_history import History
+from ..base_mongo import db, iterate_batches, upsert
+from ..base_schedule import AccountQueue, RescanPolicy, due_query
+from ..base_search import search_entry, search_index
 
+user_cache = IdCache("soundcloud_users", "user.id")
+track_cache = IdCache("soundcloud_tracks", "track.id")
+playlist_cache = IdCache("soundcloud_playlists", "playlist.id")
+
+accounts = AccountQueue("soundcloud_accounts", "soundcloud_users", "user")
+
+file_catalog.track_downloads("soundcloud_track_downloads")
+
+# backlog of things that have been found but never properly parsed
+metrics.parse_queue.set_function(
+    lambda: db["soundcloud_tracks"].count_documents({"_owner_status": "accepted", "_scan_source": {"$ne": "full"}}),
+    service="soundcloud",
+    kind="track",
+)
+
+# what counts as activity when deciding how soon to rescan something
+USER_ACTIVITY_FIELDS = ("tracks", "playlists", "track_reposts", "playlist_reposts")
+TRACK_ACTIVITY_FIELDS = ("track.title", "track.description", "track.comment_count", "reposters", "albums", "playlists")
+
+user_history = History("soundcloud_user_history", "soundcloud_users", "user")
+# track_authorization changes on every fetch
+track_history = History("soundcloud_track_history", "soundcloud_tracks", "track", ignored_keys=("track_authorization",))
+
+
+def _user_search_entries(db_user: dict | None) -> list[dict]:
+    if not db_user:
+        return []
+
+    user = db_user["user"]
+    return [search_entry("soundcloud", "user", user["id"], user.get("username"), user.get("description"), user.get("full_name"))]
+
+
+# tracks, playlists and comments only store their user's id, so the username is passed in separately
+def _track_search_entries(db_track: dict | None, username: str | None) -> list[dict]:
+    if not db_track or db_track.get("is_mini") or "title" not in db_track["track"]:
+        return []
+
+    track = db_track["track"]
+    return [
+        search_entry(
+            "soundcloud", "track", track["id"], track.get("title"), track.get("description"), username, track.get("user_id")
+        )
+    ]
+
+
+def _playlist_search_entries(db_playlist: dict | None, username: str | None) -> list[dict]:
+    if not db_playlist:
+        return []
+
+    playlist = db_playlist["playlist"]
+    return [
+        search_entry(
+            "soundcloud",
+            "playlist",
+            playlist["id"],
+            playlist.get("title"),
+            playlist.get("description"),
+            username,
+            playlist.get("user_id"),
+        )
+    ]
+
+
+def _comment_search_entries(db_comment: dict | None, username: str | None) -> list[dict]:
+    if not db_comment or not search_index.options.index_comments:
+        return []
+
+    comment = db_comment["comment"]
+    return [search_entry("soundcloud", "comment", comment["id"], None, comment.get("body"), username, comment.get("track_id"))]
+
+
+def _with_username(user_id_field: str) -> list[dict]:
+    # for backfilling, looks up each document's username from soundcloud_users into _username
+    return [
+        {"$lookup": {"from": "soundcloud_users", "localField": user_id_field, "foreignField": "user.id", "as": "_user"}},
+        {"$addFields": {"_username": {"$arrayElemAt": ["$_user.user.username", 0]}}},
+        {"$project": {"_user": 0}},
+    ]
+
+
+def backfill_search():
+    search_index.backfill("soundcloud_users", _user_search_entries)
+    search_index.backfill(
+        "soundcloud_tracks", lambda doc: _track_search_entries(doc, doc.get("_username")), _with_username("track.user_id")
+    )
+    search_index.backfill(
+        "soundcloud_playlists",
+        lambda doc: _playlist_search_entries(doc, doc.get("_username")),
+        _with_username("playlist.user_id"),
+    )
+    search_index.backfill(
+        "soundcloud_comments", lambda doc: _comment_search_entries(doc, doc.get("_username")), _with_username("user_id")
+    )
+
+
+def configure_caches(options: CacheOptions):
+    # before any thread that stores things starts, see IdCache.configure
+    for cache in (user_cache, track_cache, playlist_cache):
+        cache.configure(options.id_cache_max_entries, options.id_bloom_capacity, options.id_bloom_error_rate)
+
+
+def warm_caches():
+    for cache in (user_cache, track_cache, playlist_cache):
+        cache.warm()
+
+
+def configure_history(options: HistoryOptions):
+    for history in (user_history, track_history):
+        history.configure(options.enabled, options.snapshot_interval)
+
+
+def compact_history(options: HistoryOptions):
+    older_than = datetime.now(timezone.utc) - timedelta(days=options.compact_after_days)
+
+    for history in (user_history, track_history):
+        history.compact(older_than, timedelta(hours=options.compact_granularity_hours))
+
+
+@metrics.timed("soundcloud.db.get_user")
 def get_user(user_id):
-    return db["soundcloud_users"].find_one({"user.id": user_id})
+    db_user = db["soundcloud_users"].find_one({"user.id": user_id})
+    if db_user:
+        user_cache.set(user_id, db_user["_scan_source"], db_user["_status"])
+
+    return db_user
+
+
+def get_user_status(user_id: int | None) -> str | None:
+    if user_id is None or user_cache.contains(user_id) is False:
+        return None
+
+    status = user_cache.status(user_id)
+    if status:
+        return status
+
+    db_user = db["soundcloud_users"].find_one({"user.id": user_id}, {"_scan_source": 1, "_status": 1})
+    if not db_user:
+        return None
+
+    user_cache.set(user_id, db_user["_scan_source"], db_user["_status"])
+    return db_user["_status"]
+
+
+def _fan_out_user_status(user_id: int, status: str):
+    # tracks keep a copy of their user's status so the queue queries don't need a $lookup
+    db["soundcloud_tracks"].update_many(
+        {"track.user_id": user_id, "_owner_status": {"$ne": status}},
+        {"$set": {"_owner_status": status}},
+    )
+
+
+def set_user_status(user_id: int, status: "UserStatus"):
+    if not db["soundcloud_users"].update_one({"user.id": user_id}, {"$set": {"_status": status}}).matched_count:
+        return
+
+    user_cache.invalidate(user_id)
+    _fan_out_user_status(user_id, status)
+
+
+def backfill_owner_status():
+    # tracks stored before _owner_status existed
+    for user_id in db["soundcloud_tracks"].distinct("track.user_id", {"_owner_status": {"$exists": False}}):
+        db["soundcloud_tracks"].update_many(
+            {"track.user_id": user_id, "_owner_status": {"$exists": False}},
+            {"$set": {"_owner_status": get_user_status(user_id)}},
+        )
 
 
 # TODO: these do not need to be vars anymore move them back into param types
@@ -23,8 +194,23 @@ def update_indexes():
     db["soundcloud_playlists"].create_index("playlist.id", unique=True)
     db["soundcloud_comments"].create_index("comment.id", unique=True)
     db["soundcloud_track_downloads"].create_index("track_id")
-
-
+    db["soundcloud_users"].create_index("_next_scan")
+    db["soundcloud_users"].create_index([("_status", 1), ("_id", 1)])
+    db["soundcloud_playlists"].create_index([("playlist.user_id", 1), ("_id", 1)])
+    db["soundcloud_comments"].create_index([("comment.track_id", 1), ("_id", 1)])
+    db["soundcloud_comments"].create_index([("user_id", 1), ("_id", 1)])
+    db["soundcloud_tracks"].create_index("_next_scan")
+    db["soundcloud_tracks"].create_index([("track.user_id", 1), ("_id", 1)])
+    db["soundcloud_tracks"].create_index([("_owner_status", 1), ("_id", 1)])
+    db["soundcloud_tracks"].create_index([("_scan_source", 1), ("track.created_at", -1)])
+    db["soundcloud_tracks"].create_index([("_scan_source", 1), ("track.full_duration", 1)])
+    accounts.update_indexes()
+
+    for history in (user_history, track_history):
+        history.update_indexes()
+
+
+@metrics.timed("soundcloud.db.store_user")
 def store_user(
     user: soundcloud.User,
     scan_source: UserScanSource,
@@ -33,15 +219,20 @@ def store_user(
     playlists: list[soundcloud.BasicAlbumPlaylist] = [],
     links: list[soundcloud.WebProfile] = [],
     reposts: list[soundcloud.RepostItem] = [],
+    rescan: RescanPolicy | None = None,
 ):
-    existing_db_user = get_user(user.id)
+    # already have a full scan stored, no point asking mongo
+    if scan_source != "full" and user_cache.scan_source(user.id) == "full":
+        return
+
+    existing_db_user = get_user(user.id) if user_cache.contains(user.id) is not False else None
     # check to see if the user has already been added, and has been scanned fully.
     # if we're about to replace it with a partial scan then return.
     # TODO: could potentially update the user component only, since it might have changed, but i'd rather keep it simple for now
     if existing_db_user and existing_db_user["_scan_source"] == "full" and scan_source != "full":
         return
 
-    db_user = {
+    db_user: dict = {
         "_scan_time": datetime.now(timezone.utc),
         "_scan_source": scan_source,
         "_status": status if not existing_db_user else existing_db_user["_status"],
@@ -55,7 +246,7 @@ def store_user(
 
     for track in tracks:
         db_user["tracks"].append(track.id)
-        store_track(track, "user")
+        store_track(track, "user", owner_status=db_user["_status"])
 
     for playlist in playlists:
         db_user["playlists"].append(playlist.id)
@@ -68,7 +259,7 @@ def store_user(
         repost["user_id"] = _repost.user.id
 
         # store user if new
-        if _repost.user.id != user.id and not get_user(_repost.user.id):
+        if _repost.user.id != user.id and not user_cache.exists(_repost.user.id):
             store_user(_repost.user, "repost", "queued")
 
         if type(_repost) is soundcloud.TrackStreamRepostItem:
@@ -86,10 +277,46 @@ def store_user(
 
             store_playlist(_repost.playlist)
 
-    if not db["soundcloud_users"].find_one_and_replace({"user.id": user.id}, db_user):
-        db["soundcloud_users"].insert_one(db_user)
+    if existing_db_user and existing_db_user["_scan_source"] == "full" and scan_source == "full":
+        user_history.record(
+            user.id, existing_db_user["user"], existing_db_user["_scan_time"], db_user["user"], db_user["_scan_time"]
+        )
+
+    if scan_source == "full" and rescan:
+        db_user.update(rescan.schedule(existing_db_user, db_user))
+        accounts.set_next_scan(user.id, db_user["_next_scan"])
+
+    upsert("soundcloud_users", {"user.id": user.id}, existing_db_user, db_user, set_fields=("tracks", "playlists"))
+    search_index.update(_user_search_entries(db_user), _user_search_entries(existing_db_user))
+
+    user_cache.set(user.id, scan_source, db_user["_status"])
+
+    if not existing_db_user:
+        # might have picked up some of their tracks before we knew about them
+        _fan_out_user_status(user.id, db_user["_status"])
+
+
+def get_user_as_of(user_id: int, time: datetime) -> dict | None:
+    return user_history.as_of(user_id, time)
 
 
+def get_track_as_of(track_id: int, time: datetime) -> dict | None:
+    return track_history.as_of(track_id, time)
+
+
+def sync_accounts(account_ids: list[int], gap_hours: float):
+    accounts.sync(account_ids, gap_hours)
+
+    # configured accounts are always accepted, even if we came across them some other way first
+    for db_user in db["soundcloud_users"].find({"user.id": {"$in": account_ids}, "_status": {"$ne": "accepted"}}, {"user.id": 1}):
+        set_user_status(db_user["user"]["id"], "accepted")
+
+
+def get_accounts_to_parse(account_ids: list[int]):
+    return accounts.get_due(account_ids)
+
+
+@metrics.timed("soundcloud.db.store_track_error")
 def store_track_error(track_id: int, error_msg: str):
     scan_time = datetime.now(timezone.utc)
 
@@ -99,25 +326,25 @@ def store_track_error(track_id: int, error_msg: str):
         "error": error_msg,
     }
 
-    if not db["soundcloud_tracks"].find_one_and_update(
-        {"track.id": track_id},
-        {"$set": db_track_fail},
-    ):
-        db["soundcloud_tracks"].insert_one(
-            {
-                **db_track_fail,
-                "track": {"id": track_id},
-            }
-        )
+    # upserting seeds track.id from the filter
+    db["soundcloud_tracks"].update_one({"track.id": track_id}, {"$set": db_track_fail}, upsert=True)
+
+    track_cache.set(track_id, "full")
 
 
+@metrics.timed("soundcloud.db.get_track")
 def get_track(track_id: int):
-    return db["soundcloud_tracks"].find_one({"track.id": track_id})
+    db_track = db["soundcloud_tracks"].find_one({"track.id": track_id})
+    if db_track:
+        track_cache.set(track_id, db_track["_scan_source"])
+
+    return db_track
 
 
 TrackScanSource = Literal["full", "user", "repost", "playlist"]
 
 
+@metrics.timed("soundcloud.db.store_track")
 def store_track(
     track: soundcloud.BasicTrack | soundcloud.MiniTrack,
     scan_source: TrackScanSource,
@@ -126,16 +353,25 @@ def store_track(
     likers: list[soundcloud.User] = [],
     reposters: list[soundcloud.User] = [],
     playlists: list[soundcloud.BasicAlbumPlaylist] = [],
+    rescan: RescanPolicy | None = None,
+    owner_status: str | None = None,
 ):
     is_mini = type(track) is soundcloud.MiniTrack
 
-    existing_db_track = get_track(track.id)
+    if scan_source != "full" and track_cache.scan_source(track.id) == "full":
+        return
+
+    existing_db_track = get_track(track.id) if track_cache.contains(track.id) is not False else None
     # check to see if the track has already been added, and has been scanned fully.
     # if we're about to replace it with a partial scan then return.
     # TODO: could potentially update the track component only, since it might have changed, but i'd rather keep it simple for now
     if existing_db_track and existing_db_track["_scan_source"] == "full" and scan_source != "full":
         return
 
+    # mini tracks are just an id, don't let them replace anything we already know (like who the track belongs to)
+    if is_mini and existing_db_track:
+        return
+
     db_track: dict = {
         "_scan_time": datetime.now(timezone.utc),
         "_scan_source": scan_source,
@@ -148,28 +384,34 @@ def store_track(
         del db_track["track"]["user"]  # type: ignore
         store_user(track.user, "track", "queued")
 
+    # mini tracks don't say who they belong to
+    db_track["_owner_status"] = owner_status or get_user_status(getattr(track, "user_id", None))
+
     db_track["albums"] = []
     for album in albums:
         db_track["albums"].append(album.id)
         store_playlist(album)
 
+    # one query for all of them rather than one per comment
+    existing_db_comments = get_comments([comment.id for comment in comments])
+
     db_track["comments"] = []
     for comment in comments:
         db_track["comments"].append(comment.id)
-        store_comment(comment)
+        store_comment(comment, existing_db_comments.get(comment.id))
 
     db_track["likers"] = []
     for liker in likers:
         db_track["likers"].append(liker.id)
 
-        if liker.id != track.user_id and not get_user(liker.id):
+        if liker.id != track.user_id and not user_cache.exists(liker.id):
             store_user(liker, "like", "queued")
 
     db_track["reposters"] = []
     for reposter in reposters:
         db_track["reposters"].append(reposter.id)
 
-        if reposter.id != track.user_id and not get_user(reposter.id):
+        if reposter.id != track.user_id and not user_cache.exists(reposter.id):
             store_user(reposter, "repost", "queued")
 
     db_track["playlists"] = []
@@ -177,8 +419,33 @@ def store_track(
         db_track["playlists"].append(playlist.id)
         store_playlist(playlist)
 
-    if not db["soundcloud_tracks"].find_one_and_replace({"track.id": track.id}, db_track):
-        db["soundcloud_tracks"].insert_one(db_track)
+    # error entries don't have anything worth versioning
+    if (
+        existing_db_track
+        and existing_db_track["_scan_source"] == "full"
+        and scan_source == "full"
+        and "error" not in existing_db_track
+    ):
+        track_history.record(
+            track.id, existing_db_track["track"], existing_db_track["_scan_time"], db_track["track"], db_track["_scan_time"]
+        )
+
+    if scan_source == "full" and rescan:
+        db_track.update(rescan.schedule(existing_db_track, db_track))
+
+    upsert(
+        "soundcloud_tracks",
+        {"track.id": track.id},
+        existing_db_track,
+        db_track,
+        set_fields=("albums", "comments", "likers", "reposters", "playlists"),
+    )
+
+    # a username change alone doesn't get reindexed here, it's picked up next time the track itself changes
+    username = None if is_mini else track.user.username  # type: ignore
+    search_index.update(_track_search_entries(db_track, username), _track_search_entries(existing_db_track, username))
+
+    track_cache.set(track.id, scan_source)
 
     # store(
     #     key,
@@ -194,7 +461,8 @@ def store_track(
     # )
 
 
-def store_comment(comment: soundcloud.BasicComment):
+@metrics.timed("soundcloud.db.store_comment")
+def store_comment(comment: soundcloud.BasicComment, existing_db_comment: dict | None):
     db_comment = {
         "_scan_time": datetime.now(timezone.utc),
         "comment": asdict(comment),
@@ -205,82 +473,101 @@ def store_comment(comment: soundcloud.BasicComment):
 
     store_user(comment.user, "comment", "queued")
 
-    if not db["soundcloud_comments"].find_one_and_replace({"comment.id": comment.id}, db_comment):
-        db["soundcloud_comments"].insert_one(db_comment)
+    upsert("soundcloud_comments", {"comment.id": comment.id}, existing_db_comment, db_comment)
+    search_index.update(
+        _comment_search_entries(db_comment, comment.user.username),
+        _comment_search_entries(existing_db_comment, comment.user.username),
+    )
 
 
+@metrics.timed("soundcloud.db.store_playlist")
 def store_playlist(playlist: soundcloud.BasicAlbumPlaylist):
-    existing_db_playlist = db["soundcloud_playlists"].find_one({"playlist.id": playlist.id})
-    if existing_db_playlist:
-        return
+    existing_db_playlist = get_playlist(playlist.id) if playlist_cache.contains(playlist.id) is not False else None
 
     db_playlist = {"_scan_time": datetime.now(timezone.utc), "playlist": asdict(playlist), "track_ids": []}
 
     del db_playlist["playlist"]["user"]  # type: ignore
     store_user(playlist.user, "playlist", "queued")
 
+    # tracks already in the playlist were stored along with it
+    known_track_ids = set(existing_db_playlist["track_ids"]) if existing_db_playlist else set()
+
     del db_playlist["playlist"]["tracks"]  # type: ignore
     db_playlist["track_ids"] = []
     for track in playlist.tracks:
         db_playlist["track_ids"].append(track.id)  # type: ignore
-        store_track(track, "playlist")
+        if track.id not in known_track_ids:
+            store_track(track, "playlist")
+
+    upsert("soundcloud_playlists", {"playlist.id": playlist.id}, existing_db_playlist, db_playlist)
+    search_index.update(
+        _playlist_search_entries(db_playlist, playlist.user.username),
+        _playlist_search_entries(existing_db_playlist, playlist.user.username),
+    )
+
+    playlist_cache.set(playlist.id, None)
+
+
+@metrics.timed("soundcloud.db.get_playlist")
+def get_playlist(playlist_id: int):
+    db_playlist = db["soundcloud_playlists"].find_one({"playlist.id": playlist_id})
+    if db_playlist:
+        playlist_cache.set(playlist_id, None)
 
-    if not db["soundcloud_playlists"].find_one_and_replace({"playlist.id": playlist.id}, db_playlist):
-        db["soundcloud_playlists"].insert_one(db_playlist)
+    return db_playlist
+
+
+@metrics.timed("soundcloud.db.get_comments")
+def get_comments(comment_ids: list[int]) -> dict[int, dict]:
+    if not comment_ids:
+        return {}
+
+    return {
+        db_comment["comment"]["id"]: db_comment
+        for db_comment in db["soundcloud_comments"].find({"comment.id": {"$in": comment_ids}})
+    }
 
 
 def get_track_to_parse(min_update_time: datetime):
-    pipeline = [
+    return iterate_batches(
+        "soundcloud_tracks",
         {
-            "$match": {
-                "error": {
-                    "$exists": False,
-                }
-            }
+            "error": {
+                "$exists": False,
+            },
+            "_owner_status": "accepted",
+            **due_query(min_update_time),
         },
-        {
-            "$match": {
-                "$or": [
-                    {
-                        "_scan_source": {
-                            "$ne": "full",
-                        },
-                    },
-                    {
-                        "_scan_time": {
-                            "$lt": min_update_time,
-                        }
-                    },
-                ]
-            }
-        },
-        {
-            "$lookup": {
-                "from": "soundcloud_users",
-                "localField": "track.user_id",
-                "foreignField": "user.id",
-                "as": "user_info",
-            }
-        },
-        {
-            "$match": {
-                "user_info._status": "accepted",
-            }
-        },
-    ]
+        "soundcloud_tracks_to_parse",
+    )
+
+
+# there's no size before downloading, duration is close enough since the bitrates are all similar
+DOWNLOAD_SORTS = {
+    "newest": {"track.created_at": -1},
+    "smallest": {"track.full_duration": 1},
+    "archive": {"track.created_at": -1},
+}
+
 
-    return db["soundcloud_tracks"].aggregate(pipeline)
+@metrics.timed("soundcloud.db.get_undownloaded_track")
+def get_undownloaded_track(skip_ids: list[int], priority: str = "newest", user_ids: list | None = None):
+    match: dict = {
+        "_scan_source": "full",
+        "track.id": {
+            "$nin": skip_ids,
+        },
+    }
 
+    if user_ids is not None:
+        match["track.user_id"] = {"$in": user_ids}
 
-def get_undownloaded_track(skip_ids: list[int]):
     pipeline = [
         {
-            "$match": {
-                "_scan_source": "full",
-                "track.id": {
-                    "$nin": skip_ids,
-                },
-            }
+            "$match": match,
+        },
+        {
+            "$sort": DOWNLOAD_SORTS[priority],
         },
         {
             "$lookup": {
@@ -312,7 +599,8 @@ def get_undownloaded_track(skip_ids: list[int]):
     return next(res, None)
 
 
-def store_download(track_id: int, path: Path, relative_video_path: Path, wave: str):
+@metrics.timed("soundcloud.db.store_download")
+def store_download(track_id: int, path: Path, relative_video_path: Path, wave: str, node: str | None = None):
     db["soundcloud_track_downloads"].insert_one(
         {
             "_download_time": datetime.now(timezone.utc),
@@ -320,12 +608,16 @@ def store_download(track_id: int, path: Path, relative_video_path: Path, wave: s
             "path": str(path),
             "relative_video_path": str(relative_video_path),
             "wave": wave,
+            "node": node,
         }
     )
 
 
-def get_downloads():
-    for download in db["soundcloud_track_downloads"].find():
+def get_downloads(node: str | None = None):
+    # node: only the ones that node downloaded (older downloads don't say where they came from, so they're left out)
+    query = {"node": node} if node else {}
+
+    for download in db["soundcloud_track_downloads"].find(query):
         yield download
 
 
@@ -4,14 +4,12 @@ from dataclasses import dataclass
 from pathlib import Path
 
 import soundcloud
-from rich.progress import TaskID
 from scdl import scdl
 
-import archie.config as cfg
 import archie.services.soundcloud as sc  # love circular import
-from archie.utils import utils
+from archie.utils import metrics, utils
 
-from ..base_download import rich_progress
+from ..base_download import finalize_file, finish_job, get_job_dir, progress_renderer
 
 scdl.logger.propagate = False  # Shut up
 logger = logging.getLogger("rich")
@@ -21,6 +19,14 @@ def log(self, *args, **kwargs):
     utils.module_log("soundcloud downloads", "dark_orange3", *args, **kwargs)
 
 
+# bytes per second to reserve per track. transcodings are usually 128-160kbps, this leaves some headroom
+RESERVED_BYTES_PER_SECOND = 256 * 1024 // 8
+
+
+def get_estimated_size(track: dict) -> int:
+    return track.get("full_duration", 0) // 1000 * RESERVED_BYTES_PER_SECOND
+
+
 @dataclass
 class DownloadedTrack:
     path: Path
@@ -28,6 +34,7 @@ class DownloadedTrack:
     wave: str
 
 
+@metrics.timed("soundcloud.download_track")
 def download_track(user: soundcloud.User, track: soundcloud.BasicTrack, download_folder: Path) -> DownloadedTrack | None:
     start_progress(user, track)
 
@@ -60,7 +67,7 @@ def download_track(user: soundcloud.User, track: soundcloud.BasicTrack, download
             )
 
         relative_path = str(user.id) / Path(f"{track.id}.{wave_id}{ext}")
-        temp_track_path = cfg.TEMP_DL_PATH / relative_path
+        temp_track_path = get_job_dir("SoundCloud", track.id, download_folder) / relative_path
 
         # TODO: check if already downloaded?
 
@@ -97,41 +104,30 @@ def download_track(user: soundcloud.User, track: soundcloud.BasicTrack, download
         else:
             # move completed download
             final_path.parent.mkdir(parents=True, exist_ok=True)
-            shutil.move(temp_track_path, final_path)
+            finalize_file(temp_track_path, final_path)
 
         return DownloadedTrack(final_path, relative_path, wave_id)
     except Exception as e:
         utils.log(e)
         return None
     finally:
+        # the whole track is written in one go, so there's never anything worth resuming
+        finish_job("SoundCloud", track.id)
         finish_progress(track)
 
 
-class ProgressBar:
-    task_id: TaskID
-
-    def __init__(self, user: soundcloud.User, track: soundcloud.BasicTrack):
-        self.task_id = rich_progress.add_task(
-            "download",
-            service="soundcloud",
-            author=user.username,
-            title=track.title,
-            duration=track.duration / 1000,
-            start=True,
-            total=None,
-        )
-
-    def __del__(self):
-        rich_progress.remove_task(self.task_id)
-
-
-progresses: dict[int, ProgressBar] = dict()
-
-
 def start_progress(user: soundcloud.User, track: soundcloud.BasicTrack):
-    progresses[track.id] = ProgressBar(user, track)
+    progress_renderer.add(
+        ("soundcloud", track.id),
+        service="soundcloud",
+        id=track.id,
+        author=user.username,
+        title=track.title,
+        duration=track.duration / 1000,
+        start=True,
+        total=None,
+    )
 
 
 def finish_progress(track: soundcloud.BasicTrack):
-    if track.id in progresses:
-        del progresses[track.id]
+    progress_renderer.remove(("soundcloud", track.id))
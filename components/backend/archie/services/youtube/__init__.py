@@ -1,14 +1,20 @@
 import threading
 import time
+from dataclasses import dataclass
 from datetime import datetime, timedelta, timezone
 from pathlib import Path
 from typing import Set, cast
 
-from archie.config import Config
-from archie.services.base_download import copy_download
+from archie.config import ArchiveConfig, Config
+from archie.services.base_catalog import file_catalog
+from archie.services.base_cluster import cluster
+from archie.services.base_download import DownloadJob, copy_download, download_scheduler
+from archie.services.base_pipeline import Stage
+from archie.services.base_pool import WorkerPool
+from archie.services.base_schedule import RescanPolicy
 from archie.services.base_service import BaseService
-from archie.services.youtube.api import YouTubeAPI
-from archie.utils import utils
+from archie.services.youtube.api import YouTubeAPI, get_estimated_size
+from archie.utils import metrics, utils
 
 from . import database as db
 
@@ -20,6 +26,19 @@ def log(*args, **kwargs):
     utils.module_log("youtube", "red", *args, **kwargs)
 
 
+@dataclass
+class PendingDownload:
+    # a download on its way through the stages. the lease on the video and the scheduler job are held until it's finalized
+    video: dict
+    channel: dict
+    archives: list[ArchiveConfig]
+    download_path: Path
+    job: DownloadJob
+    start: float
+    fetched: dict | None = None
+    result: dict | None = None
+
+
 class YouTubeService(BaseService):
     api = YouTubeAPI()
 
@@ -38,27 +57,83 @@ class YouTubeService(BaseService):
         return self.api.get_channel_id_from_url(link)
 
     def run(self, config: Config):
+        db.configure_history(config.history)
+        db.configure_caches(config.cache)
+        download_scheduler.configure(config.downloads)
+
+        if config.services.youtube.executor == "processes":
+            self.api.pool = WorkerPool("youtube")
+            self.api.pool.start(config.services.youtube.processes)
+
         threading.Thread(target=self._background, daemon=True).start()
-        threading.Thread(target=self._check_downloads, args=(config,), daemon=True).start()
-        threading.Thread(target=self._parse, args=(config,), daemon=True).start()
+        threading.Thread(target=db.warm_caches, daemon=True).start()
+
+        if cluster.has_role("parse"):
+            threading.Thread(target=self._backfill_owner_status, daemon=True).start()
+            threading.Thread(target=self._backfill_search, daemon=True).start()
+            threading.Thread(target=self._compact_history, args=(config,), daemon=True).start()
+            threading.Thread(target=self._parse, args=(config,), daemon=True).start()
 
-        for i in range(5):
-            threading.Thread(target=self._download_videos, args=(config,), daemon=True).start()
+        if cluster.has_role("download"):
+            threading.Thread(target=self._check_downloads, args=(config,), daemon=True).start()
+
+            options = config.downloads
+            self._postprocess_stage = Stage(
+                "youtube", "postprocess", self._postprocess, options.postprocess_workers, options.stage_queue_size
+            )
+            self._finalize_stage = Stage(
+                "youtube", "finalize", self._finalize, options.finalize_workers, options.stage_queue_size
+            )
+            self._postprocess_stage.start()
+            self._finalize_stage.start()
+
+            for i in range(options.fetch_workers):
+                threading.Thread(target=self._download_videos, args=(config,), daemon=True).start()
 
     def _background(self):
         while True:
             db.update_indexes()
             time.sleep(10)
 
+    def _backfill_owner_status(self):
+        # only one node needs to do this
+        if cluster.claim("youtube.maintenance", "backfill_owner_status"):
+            try:
+                db.backfill_owner_status()
+            finally:
+                cluster.release("youtube.maintenance", "backfill_owner_status")
+
+    def _backfill_search(self):
+        # whatever was stored before the search index existed
+        if cluster.claim("youtube.maintenance", "backfill_search"):
+            try:
+                db.backfill_search()
+            finally:
+                cluster.release("youtube.maintenance", "backfill_search")
+
+    def _compact_history(self, config: Config):
+        while True:
+            if cluster.claim("youtube.maintenance", "compact_history"):
+                try:
+                    db.compact_history(config.history)
+                finally:
+                    cluster.release("youtube.maintenance", "compact_history")
+
+            time.sleep(60 * 60 * 24)
+
     def _check_downloads(self, config: Config):
-        for download in db.get_downloads():
+        # deleted and moved downloads are mostly dealt with by the catalog's first scan, this is just a fallback for them
+        file_catalog.scanned.wait()
+
+        # other nodes' downloads are on their disks, leave them to check their own
+        for download in db.get_downloads(cluster.node_name if cluster.enabled else None):
             video_id = download["video_id"]
             path = Path(download["path"])
 
             # remove deleted downloads
             if not path.exists():
                 log(f"download for video '{video_id}' no longer exists, deleting from db")
-                db.remove_download(video_id)
+                db.remove_download(download["_id"])
                 continue
 
             # check if the video exists everywhere it should
@@ -69,10 +144,34 @@ class YouTubeService(BaseService):
             for archive in video_archives:
                 copy_download(self.service_name, path, download["relative_video_path"], archive)
 
+    def _get_next_download(self, config: Config):
+        skip_ids = list(self._current_downloads.union(self._fail_list, cluster.claimed_ids("youtube.download")))
+
+        for channel_ids in download_scheduler.download_groups(config, self.service_name):
+            while video := db.get_undownloaded_video(skip_ids, download_scheduler.options.priority, channel_ids):
+                if cluster.claim("youtube.download", video["video"]["id"]):
+                    return video
+
+                # another node got there first
+                skip_ids.append(video["video"]["id"])
+
+        return None
+
+    def __release_download(self, video_id: str):
+        with self._current_downloads_lock:
+            self._current_downloads.remove(video_id)
+
+        cluster.release("youtube.download", video_id)
+
     def _download_videos(self, config: Config):  # TODO: some of this can be generalised most likely
+        # the fetch stage. once the streams are down the download goes on to _postprocess and this picks up the next one
         while True:
-            with self._current_downloads_lock:  # TODO: should this be looping over archives first idk
-                video = db.get_undownloaded_video(list(self._current_downloads.union(self._fail_list)))
+            if not download_scheduler.has_space():
+                time.sleep(10)
+                continue
+
+            with self._current_downloads_lock:
+                video = self._get_next_download(config)
 
                 if video:
                     video_data = video["video"]
@@ -91,107 +190,220 @@ class YouTubeService(BaseService):
 
             assert len(video_archives) > 0  # todo: i know this will fail at some point i have to code the logic for it
 
-            archive = video_archives[0]
-
             log(f"downloading video {video_data['title']} ({video_data['id']})")
 
-            download_path = Path(archive.downloads.download_path).expanduser() / self.service_name
+            download_path = Path(video_archives[0].downloads.download_path).expanduser() / self.service_name
 
-            downloaded_video_data = self.api.download(channel_data, video_data, download_path)
+            job = download_scheduler.start(self.service_name, get_estimated_size(video_data), [download_path])
+            if not job:
+                # not enough space for this one right now, leave it for later
+                self.__release_download(video_data["id"])
 
-            with self._current_downloads_lock:
-                self._current_downloads.remove(video_data["id"])
+                time.sleep(10)
+                continue
+
+            download = PendingDownload(video_data, channel_data, video_archives, download_path, job, time.perf_counter())
 
-            if not downloaded_video_data:
-                # download somehow failed 5 times, skip it
-                self._fail_list.add(video_data["id"])
-                # todo: actually skip it properly
+            try:
+                download.fetched = self.api.fetch(channel_data, video_data, download_path, job)
+            except Exception as e:
+                # this is a plain thread rather than a Stage worker, nothing would start it again
+                log(f"fetching {video_data['id']} failed: {e}")
+                self.__fail_download(download)
                 continue
 
+            if not download.fetched:
+                self.__fail_download(download)
+                continue
+
+            download_scheduler.end_transfer(job)
+            self._postprocess_stage.put(download)
+
+    def _postprocess(self, download: "PendingDownload"):
+        try:
+            assert download.fetched
+            download.result = self.api.postprocess(download.video, download.fetched)
+        except Exception:
+            self.__fail_download(download)
+            raise
+
+        if not download.result:
+            return self.__fail_download(download)
+
+        self._finalize_stage.put(download)
+
+    def _finalize(self, download: "PendingDownload"):
+        video_data = download.video
+
+        try:
+            assert download.fetched and download.result
+            downloaded_video_data = self.api.finalize(video_data, download.fetched, download.result, download.download_path)
+
+            # stored before letting go of it, otherwise another worker could pick it up again in between
             db.store_download(
                 video_data["id"],
                 downloaded_video_data.path,
                 downloaded_video_data.video_relative_path,
                 downloaded_video_data.format,
+                cluster.node_name,
+            )
+        except Exception:
+            self.__fail_download(download)
+            raise
+
+        download_scheduler.finish(download.job)
+        self.__release_download(video_data["id"])
+
+        metrics.downloads.inc(service="youtube")
+        metrics.download_bytes.inc(downloaded_video_data.path.stat().st_size, service="youtube")
+        metrics.download_duration.observe(time.perf_counter() - download.start, service="youtube")
+
+        for other_archive in download.archives[1:]:
+            copy_download(
+                self.service_name,
+                downloaded_video_data.path,
+                downloaded_video_data.video_relative_path,
+                other_archive,
             )
 
-            for other_archive in video_archives[1:]:
-                copy_download(
-                    self.service_name,
-                    downloaded_video_data.path,
-                    downloaded_video_data.video_relative_path,
-                    other_archive,
-                )
+        log(f"finished downloading {video_data['title']} (format {downloaded_video_data.format})")
 
-            log(f"finished downloading {video_data['title']} (format {downloaded_video_data.format})")
+    def __fail_download(self, download: "PendingDownload"):
+        download_scheduler.finish(download.job)
+        self.__release_download(download.video["id"])
 
-    def __parse_channels(self, config: Config):  # TODO: some of this can be generalised most likely
-        channel_min_update_time = datetime.now(timezone.utc) - timedelta(hours=config.services.youtube.channel_update_gap_hours)
+        metrics.download_failures.inc(service="youtube")
 
-        for account, entity, archive in config.get_accounts(self.service_name):
-            # todo: check status accepted here
+        # skipped from now on (until a restart) after a single failure
+        self._fail_list.add(download.video["id"])
+        # todo: actually skip it properly
 
-            # check if already parsed
-            db_channel = db.get_channel(cast(str, account.id))
-            if db_channel:
-                # TODO: move this stuff into aggregation?
-                if db_channel["_scan_source"] == "full" and db_channel["_scan_time"] > channel_min_update_time:
-                    continue
+    def _parse_channels(self, config: Config, account_ids: list[str]):  # TODO: some of this can be generalised most likely
+        options = config.services.youtube
+        rescan = RescanPolicy(options.channel_update_gap_hours, options.adaptive, db.CHANNEL_ACTIVITY_FIELDS)
 
-                log(f"updating channel {db_channel['channel']['channel']} ({account.id})")
-            else:
-                log(f"parsing channel ({account.id})")
+        # only the accounts that are actually due come back, so this is one query when there's nothing to do
+        for db_account in cluster.claim_each(
+            "youtube.channel", db.get_accounts_to_parse(account_ids), lambda doc: doc["_id"], "youtube_accounts", "_next_scan"
+        ):
+            account_id = db_account["_id"]
+            log(f"parsing channel ({account_id})")
 
-            res = self.api.get_channel_and_videos(account.id)
+            res = self.api.get_channel_and_videos(account_id)
             if res is None:
                 # failed to parse channel, probably deleted or something TODO: more handling
+                metrics.parse_failures.inc(service="youtube", kind="channel")
                 continue
 
             channel, channel_videos = res
-            channel_playlists = self.api.get_channel_playlists(account.id)
+            channel_playlists = self.api.get_channel_playlists(account_id)
 
             for video in channel_videos:  # videos don't have it anymore? bandaid fix todo: look into this
                 video["channel_id"] = channel["id"]
 
-            db.store_channel(channel, channel_videos, channel_playlists, "full", "accepted")
+            db.store_channel(channel, channel_videos, channel_playlists, "full", "accepted", rescan=rescan)
+            metrics.items_parsed.inc(service="youtube", kind="channel")
 
-            log(f"parsed channel {channel['channel']} ({account.id})")
+            log(f"parsed channel {channel['channel']} ({account_id})")
 
-    def __parse_playlists(self, config: Config):
+    def _parse_playlists(self, config: Config):
         playlist_min_update_time = datetime.now(timezone.utc) - timedelta(hours=config.services.youtube.playlist_update_gap_hours)
 
-        for db_playlist in db.get_playlist_to_parse(playlist_min_update_time):
+        for db_playlist in cluster.claim_each(
+            "youtube.playlist",
+            db.get_playlist_to_parse(playlist_min_update_time),
+            lambda doc: doc["playlist"]["id"],
+            "youtube_playlists",
+        ):
             log(f"parsing playlist ({db_playlist['playlist']['id']})")
 
             # TODO: just parse the first page of the playlist to get the "Last updated" date, and check that to see if it's worth parsing the whole thing. if no videos were added/removed then no point. unless videos were made unprivate..
             playlist, videos = self.api.get_playlist(db_playlist["playlist"]["id"])
 
             db.store_playlist(playlist, videos, "full", "queued")
+            metrics.items_parsed.inc(service="youtube", kind="playlist")
 
             log(f"parsed playlist {playlist['title']} - {len(videos)} videos ({playlist['id']})")
 
-    def __parse_videos(self, config: Config):
-        video_min_update_time = datetime.now(timezone.utc) - timedelta(hours=config.services.youtube.video_update_gap_hours)
-
-        for db_video in db.get_video_to_parse(video_min_update_time):
+    def __get_video_data(self, config: Config, db_video: dict):
+        # (video, error, comment count as of when the comments were last fetched in full or caught up to)
+        video_id = db_video["video"]["id"]
+
+        # never been fully scanned, get everything
+        if db_video["_scan_source"] != "full" or "comments" not in db_video["video"]:
+            video, error = self.api.get_video_data(video_id)
+            return video, error, video.get("comment_count") if video else None
+
+        # rescan. get the metadata first and only bother with comments if the count changed
+        video, error = self.api.get_video_data(video_id, get_comments=False)
+        if not video:
+            return video, error, None
+
+        known_comments = db_video["video"]["comments"] or []
+        # compared against the count when comments were last fetched, not the last scan's, otherwise small changes never add
+        # up to the threshold
+        fetched_count = db_video.get("_comments_count", db_video["video"].get("comment_count"))
+        new_count = video.get("comment_count")
+
+        if fetched_count is not None and new_count is not None:
+            if abs(new_count - fetched_count) <= config.services.youtube.comment_refetch_threshold:
+                video["comments"] = known_comments
+                return video, None, fetched_count
+
+            # fetch newest first, enough to overlap with the comments we already have
+            max_comments = max(new_count - fetched_count, 0) + config.services.youtube.comment_fetch_margin
+            recent_video, _ = self.api.get_video_data(video_id, max_comments=max_comments)
+
+            if recent_video and recent_video.get("comments") is not None:
+                known_ids = {comment["id"] for comment in known_comments}
+                new_comments = [comment for comment in recent_video["comments"] if comment["id"] not in known_ids]
+
+                if len(new_comments) < len(recent_video["comments"]):
+                    # reached comments we already have, everything older is already stored
+                    recent_video["comments"] = new_comments + known_comments
+                    return recent_video, None, recent_video.get("comment_count")
+
+        # no counts to go on or the newest comments didn't reach known ones, just get them all again
+        log(f"refetching all comments ({video_id})")
+        full_video, _ = self.api.get_video_data(video_id)
+        if full_video:
+            return full_video, None, full_video.get("comment_count")
+
+        # keep what's archived rather than storing the video without its comments
+        video["comments"] = known_comments
+        return video, None, fetched_count
+
+    def _parse_videos(self, config: Config):
+        options = config.services.youtube
+        video_min_update_time = datetime.now(timezone.utc) - timedelta(hours=options.video_update_gap_hours)
+        rescan = RescanPolicy(options.video_update_gap_hours, options.adaptive, db.VIDEO_ACTIVITY_FIELDS)
+
+        for db_video in cluster.claim_each(
+            "youtube.video", db.get_video_to_parse(video_min_update_time), lambda doc: doc["video"]["id"], "youtube_videos"
+        ):
             log(f"parsing video ({db_video['video']['id']})")
 
-            video, error = self.api.get_video_data(db_video["video"]["id"])
+            video, error, comments_count = self.__get_video_data(config, db_video)
             if not video and error:
                 # failed to dl, edge case, store it in db
                 db.store_video_error(db_video["video"]["id"], error)
+                metrics.parse_failures.inc(service="youtube", kind="video")
                 continue
 
             assert video  # Dumb mypy
 
-            db.store_video(video, "full")
+            db.store_video(video, "full", rescan=rescan, comments_count=comments_count)
+            metrics.items_parsed.inc(service="youtube", kind="video")
 
             log(f"parsed video {video['title']} ({video['id']})")
 
     def _parse(self, config: Config):
+        account_ids = [cast(str, account.id) for account, entity, archive in config.get_accounts(self.service_name)]
+        db.sync_accounts(account_ids, config.services.youtube.channel_update_gap_hours)
+
         while True:
-            self.__parse_channels(config)
-            self.__parse_playlists(config)
-            self.__parse_videos(config)
+            self._parse_channels(config, account_ids)
+            self._parse_playlists(config)
+            self._parse_videos(config)
 
             time.sleep(1)
@@ -1,14 +1,24 @@
 import json
-import shutil
+import re
+import threading
+import time
+from collections import OrderedDict
 from dataclasses import dataclass
 from pathlib import Path
 from typing import Tuple
 
 import yt_dlp  # type: ignore
 
-import archie.config as cfg
-from archie.utils import utils
+from archie.utils import metrics, utils
 
+from ..base_download import (
+    DownloadJob,
+    check_job_format,
+    finalize_file,
+    finish_job,
+    get_job_dir,
+)
+from ..base_pool import WorkerPool
 from ._filter import filter_video
 from .download import finish_progress, progress_hooks, start_progress
 
@@ -22,6 +32,189 @@ class DownloadedVideo:
     format: str
 
 
+# stream urls are signed with an expiry time (usually ~6 hours after extraction)
+EXPIRE_REGEX = re.compile(r"[?&/]expire[=/](\d+)")
+
+# don't reuse urls that are about to expire, a long download would die halfway through
+FORMAT_EXPIRY_MARGIN = 60 * 30
+
+
+def get_formats_expiry(info: dict) -> float | None:
+    # returns when the first of the info's stream urls expires, or None if it doesn't have any usable formats
+    expiries = []
+
+    for format in info.get("formats") or []:
+        for key in ("url", "manifest_url", "fragment_base_url"):
+            match = EXPIRE_REGEX.search(format.get(key) or "")
+            if match:
+                expiries.append(int(match.group(1)))
+                break
+
+    return min(expiries) if expiries else None
+
+
+def get_estimated_size(info: dict) -> int:
+    # bytes, from the sizes yt-dlp reported for the formats it picked. 0 if it doesn't know
+    size = info.get("filesize") or info.get("filesize_approx")
+    if not size:
+        size = sum(format.get("filesize") or format.get("filesize_approx") or 0 for format in info.get("requested_formats") or [])
+
+    return int(size)
+
+
+def is_expired_error(e: yt_dlp.utils.DownloadError | str):
+    return any(msg in str(e) for msg in ("HTTP Error 403", "HTTP Error 410", "expired"))
+
+
+class FormatCache:
+    # recently extracted info dicts (minus comments), so downloads don't have to extract them again
+
+    def __init__(self, max_entries: int = 256):
+        self.max_entries = max_entries
+        self._entries: OrderedDict[str, tuple[dict, float]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def put(self, info: dict):
+        expiry = get_formats_expiry(info)
+        if expiry is None:
+            return
+
+        info = {key: value for key, value in info.items() if key != "comments"}
+
+        with self._lock:
+            self._entries[info["id"]] = (info, expiry)
+            self._entries.move_to_end(info["id"])
+
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def get(self, video_id: str) -> dict | None:
+        with self._lock:
+            entry = self._entries.get(video_id)
+            if not entry:
+                return None
+
+            info, expiry = entry
+            if expiry - FORMAT_EXPIRY_MARGIN < time.time():
+                del self._entries[video_id]
+                return None
+
+            return info
+
+    def invalidate(self, video_id: str):
+        with self._lock:
+            self._entries.pop(video_id, None)
+
+
+class CheckPartialFormat(yt_dlp.postprocessor.PostProcessor):
+    # runs once yt-dlp has picked the formats, before it starts (or carries on) downloading them
+    def run(self, info):
+        if check_job_format("YouTube", info["id"], info["format_id"]):
+            self.to_screen(f"resuming partial download of {info['id']} (format {info['format_id']})")
+
+        return [], info
+
+
+class WorkerProgress:
+    # progress hook for downloads running in a worker process. progress goes back over the pool's queue, and the rate limit
+    # is copied over from the shared params (yt-dlp reads it from its own params on every chunk)
+    def __init__(self, params: dict, progress, shared_params: dict):
+        self.params = params
+        self.progress = progress
+        self.shared_params = shared_params
+        self._last_update = 0.0
+
+    def __call__(self, data):
+        if data["status"] != "downloading":
+            return
+
+        # hooks run on every chunk, both of these are a round trip to the manager process
+        now = time.monotonic()
+        if now - self._last_update < 0.25:
+            return
+
+        self._last_update = now
+        self.params["ratelimit"] = self.shared_params.get("ratelimit")
+        self.progress.put(
+            (
+                ("youtube", data["info_dict"]["id"]),
+                data.get("downloaded_bytes"),
+                data.get("total_bytes") or data.get("total_bytes_estimate"),
+            )
+        )
+
+
+def extract_video(video_link: str, ydl_opts: dict, sanitize: bool = False) -> Tuple[dict | None, str | None]:
+    # the yt-dlp part of get_video_data, runs in a worker process when there's a pool. errors come back as just the message,
+    # the exception itself holds a traceback which doesn't pickle. sanitizing turns the info into plain json types
+    with yt_dlp.YoutubeDL(ydl_opts) as yt:
+        try:
+            data = yt.extract_info(video_link, download=False)
+            return (yt.sanitize_info(data) if sanitize else data), None
+        except yt_dlp.utils.DownloadError as e:
+            return None, e.msg
+
+
+class FetchOnlyYoutubeDL(yt_dlp.YoutubeDL):
+    # stops once the streams (and thumbnail) are downloaded. merging them and running the postprocessors is left for
+    # postprocess_video, so the network worker can move on to the next download while ffmpeg does its thing
+    fetched: dict | None = None
+
+    def post_process(self, filename, info, files_to_move=None):
+        self.fetched = {"filename": filename, "info": info, "files_to_move": files_to_move or {}}
+        info["filepath"] = filename
+        return info
+
+
+def fetch_video(
+    video_link: str, ydl_opts: dict, info: dict | None, worker_progress: tuple | None = None
+) -> Tuple[dict | None, str | None]:
+    # the network part of a download, runs in a worker process when there's a pool. returns what postprocess_video needs
+    if worker_progress:
+        ydl_opts["progress_hooks"] = [WorkerProgress(ydl_opts, *worker_progress)]
+
+    with FetchOnlyYoutubeDL(ydl_opts) as yt:
+        # in a worker this opens the worker's own mongo connection, for the job's format
+        yt.add_post_processor(CheckPartialFormat(), when="before_dl")
+
+        try:
+            if info:
+                # skips extraction entirely, just picks formats from the info we already have
+                yt.process_ie_result(yt.sanitize_info(info), download=True)
+            else:
+                yt.extract_info(video_link, download=True)
+        except yt_dlp.utils.DownloadError as e:
+            return None, e.msg
+
+        if not yt.fetched:
+            return None, "nothing was downloaded"
+
+        # the merger/fixups yt-dlp queued up are tied to this YoutubeDL, they're recreated from their names afterwards
+        fetched_info = yt.fetched["info"]
+        postprocessors = [type(pp).__name__ for pp in fetched_info.pop("__postprocessors", None) or []]
+
+        return {
+            "filename": yt.fetched["filename"],
+            "info": yt.sanitize_info(fetched_info),
+            "files_to_move": yt.fetched["files_to_move"],
+            "postprocessors": postprocessors,
+        }, None
+
+
+def postprocess_video(fetched: dict, ydl_opts: dict) -> Tuple[dict | None, str | None]:
+    # merges the fetched streams and runs the postprocessors, runs in a worker process when there's a pool
+    with yt_dlp.YoutubeDL(ydl_opts) as yt:
+        info = fetched["info"]
+        info["__postprocessors"] = [getattr(yt_dlp.postprocessor, name)(yt) for name in fetched["postprocessors"]]
+
+        try:
+            info = yt.post_process(fetched["filename"], info, fetched["files_to_move"])
+        except yt_dlp.utils.YoutubeDLError as e:
+            return None, e.msg
+
+        return {"filepath": info["filepath"], "format_id": info["format_id"]}, None
+
+
 def debug_write_yt(yt, data, filename):
     with open(f"{filename}.json", "w") as out_file:
         out_file.write(json.dumps(yt.sanitize_info(data)))
@@ -34,6 +227,9 @@ def debug_write(data, filename):
 
 class YouTubeAPI:
     in_spider = False
+    format_cache = FormatCache()
+    # extraction and downloads run in here when youtube.executor is processes, see YouTubeService.run
+    pool: WorkerPool | None = None
 
     def _log(self, *args, **kwargs):
         if not self.in_spider:
@@ -41,6 +237,7 @@ class YouTubeAPI:
         else:
             utils.module_log("youtube api (spider)", "magenta", *args, **kwargs)
 
+    @metrics.timed("youtube.get_channel_id_from_url")
     def get_channel_id_from_url(self, account_link: str) -> str | None:
         ydl_opts = {
             "extract_flat": True,
@@ -57,6 +254,7 @@ class YouTubeAPI:
 
         return f"https://youtube.com/channel/{account_id}"
 
+    @metrics.timed("youtube.get_channel_and_videos")
     def get_channel_and_videos(self, account_id, from_spider: bool = False) -> Tuple[dict, list] | None:
         ydl_opts = {
             "extract_flat": True,  # don't parse individual videos, just get the data available from the /videos page
@@ -92,28 +290,46 @@ class YouTubeAPI:
                     else:
                         raise e
 
-    def get_video_data(self, video_id: str, spider: bool = False) -> Tuple[dict, None] | Tuple[None, yt_dlp.utils.YoutubeDLError]:
-        # gets all info and commenters for a video
+    @metrics.timed("youtube.get_video_data")
+    def get_video_data(
+        self, video_id: str, spider: bool = False, get_comments: bool = True, max_comments: int | None = None
+    ) -> Tuple[dict, None] | Tuple[None, yt_dlp.utils.YoutubeDLError]:
+        # gets all info and commenters for a video. if max_comments is set only that many of the newest comments are fetched
 
-        ydl_opts = {
-            "getcomments": True,
+        ydl_opts: dict = {
+            "getcomments": get_comments,
             "quiet": True,
         }
 
+        if get_comments and max_comments is not None:
+            ydl_opts["extractor_args"] = {
+                "youtube": {
+                    "comment_sort": ["new"],
+                    "max_comments": [str(max_comments)],
+                }
+            }
+
         video_link = f"https://www.youtube.com/watch?v={video_id}"
 
-        with yt_dlp.YoutubeDL(ydl_opts) as yt:
-            try:
-                data = yt.extract_info(video_link, download=False)
+        if self.pool:
+            data, error = self.pool.run(extract_video, video_link, ydl_opts, True)
+        else:
+            data, error = extract_video(video_link, ydl_opts)
 
-                if filter_video(data):
-                    # todo: what to do when the video's already been added
-                    pass
+        if error is not None:
+            return None, yt_dlp.utils.DownloadError(error)  # idk if this is good way to do this
 
-                return data, None
-            except yt_dlp.utils.DownloadError as e:
-                return None, e  # idk if this is good way to do this
+        assert data
 
+        if filter_video(data):
+            # todo: what to do when the video's already been added
+            pass
+
+        self.format_cache.put(data)
+
+        return data, None
+
+    @metrics.timed("youtube.get_channel_playlists")
     def get_channel_playlists(self, account_id):
         ydl_opts = {
             "quiet": True,
@@ -135,6 +351,7 @@ class YouTubeAPI:
 
             return data["entries"]
 
+    @metrics.timed("youtube.get_playlist")
     def get_playlist(self, playlist_id: str):
         ydl_opts = {
             "quiet": True,
@@ -148,17 +365,35 @@ class YouTubeAPI:
             videos = data.pop("entries")
             return data, videos
 
-    def download(self, channel: dict, video: dict, download_folder: Path) -> DownloadedVideo | None:
-        # returns the downloaded format
+    def _get_reusable_info(self, video: dict) -> dict | None:
+        # info from a recent extraction, either from this process or the one stored in the db, as long as its urls are still good
+        info = self.format_cache.get(video["id"])
+        if info:
+            return info
+
+        expiry = get_formats_expiry(video)
+        if expiry and expiry - FORMAT_EXPIRY_MARGIN > time.time():
+            return {key: value for key, value in video.items() if key != "comments"}
+
+        return None
+
+    @metrics.timed("youtube.fetch")
+    def fetch(self, channel: dict, video: dict, download_folder: Path, job: DownloadJob | None = None) -> dict | None:
+        # downloads the streams into the job dir, for postprocess() to merge. None if it failed
 
         start_progress(channel, video)
 
+        # staged on the same drive as download_folder, so finalize() is just a rename
+        job_dir = get_job_dir("YouTube", video["id"], download_folder)
+
         ydl_opts = {
             "progress_hooks": [progress_hooks],
             "quiet": True,
             "noprogress": True,
             # don't redownload videos
             "nooverwrites": True,
+            # carry on from partial files left by a previous run
+            "continuedl": True,
             # bypass geographic restrictions
             "geo_bypass": True,
             # write mkv files (prevent webm warning, it just uses mkv anyway)
@@ -167,6 +402,55 @@ class YouTubeAPI:
             # 'match_filter': '!is_live',
             "writethumbnail": True,
             "format": "bv*+ba",
+            # output folder
+            "outtmpl": str(job_dir / "%(channel_id)s/%(id)s.f%(format_id)s.%(ext)s"),
+        }
+
+        video_link = f"https://www.youtube.com/watch?v={video['id']}"
+
+        if self.pool:
+            # the hook can't go over to the worker, it gets its own that sends progress back over the pool's queue
+            shared_params = self.pool.shared_params()
+            if job:
+                job.bind(shared_params)
+
+            worker_opts = {key: value for key, value in ydl_opts.items() if key != "progress_hooks"}
+            pool = self.pool
+
+            def attempt(info: dict | None):
+                return pool.run(fetch_video, video_link, worker_opts, info, (pool.progress, shared_params))
+
+        else:
+            if job:
+                job.bind(ydl_opts)
+
+            def attempt(info: dict | None):
+                return fetch_video(video_link, ydl_opts, info)
+
+        try:
+            info = self._get_reusable_info(video)
+            fetched, error = attempt(info)
+
+            if info and error is not None and is_expired_error(error):
+                self._log(f"stream urls expired, re-extracting ({video['id']})")
+                self.format_cache.invalidate(video["id"])
+                fetched, error = attempt(None)
+        finally:
+            finish_progress(video)
+
+        if error is not None or not fetched:
+            self._log(f"failed to download video '{video['title']}', skipping. ({video['id']}): {error}")
+            return None
+
+        fetched["job_dir"] = str(job_dir)
+        return fetched
+
+    @metrics.timed("youtube.postprocess")
+    def postprocess(self, video: dict, fetched: dict) -> dict | None:
+        # merges the streams, then adds metadata and the thumbnail. None if it failed
+        ydl_opts = {
+            "quiet": True,
+            "merge_output_format": "mkv",
             "postprocessors": [
                 {
                     "key": "FFmpegMetadata",
@@ -177,40 +461,42 @@ class YouTubeAPI:
                     "already_have_thumbnail": False,
                 },
             ],
-            # output folder
-            "outtmpl": str(cfg.TEMP_DL_PATH.expanduser() / "%(channel_id)s/%(id)s.f%(format_id)s.%(ext)s"),
         }
 
-        with yt_dlp.YoutubeDL(ydl_opts) as yt:
-            try:
-                data = yt.extract_info(f"https://www.youtube.com/watch?v={video['id']}", download=True)
-            except yt_dlp.utils.DownloadError as e:
-                print(e)
-                self._log(f"failed to download video '{video['title']}', skipping. ({video['id']})")
-                return None
-            finally:
-                finish_progress(video)
+        if self.pool:
+            result, error = self.pool.run(postprocess_video, fetched, ydl_opts)
+        else:
+            result, error = postprocess_video(fetched, ydl_opts)
 
-            self._log("finished download for", video["title"])
+        if error is not None or not result:
+            self._log(f"failed to post-process video '{video['title']}', skipping. ({video['id']}): {error}")
+            return None
 
-            download_data = data["requested_downloads"][0]
+        self._log("finished download for", video["title"])
+        return result
 
-            # get just the download path, not the stuff before it. so c:\...\temp-downloads\channel\video.mkv just becomes channel\video.mkv
-            downloaded_path = Path(download_data["filepath"])
-            video_relative_path = downloaded_path.relative_to(cfg.TEMP_DL_PATH)
+    @metrics.timed("youtube.finalize")
+    def finalize(self, video: dict, fetched: dict, result: dict, download_folder: Path) -> DownloadedVideo:
+        job_dir = Path(fetched["job_dir"])
 
-            # build proper download path
-            final_path = download_folder / video_relative_path
+        # get just the download path, not the stuff before it. so c:\...\temp-downloads\jobs\youtube-id\channel\video.mkv just becomes channel\video.mkv
+        downloaded_path = Path(result["filepath"])
+        video_relative_path = downloaded_path.relative_to(job_dir)
 
-            if final_path.exists():
-                self._log("video already exists? skipping")
-            else:
-                # move completed download
-                final_path.parent.mkdir(parents=True, exist_ok=True)
-                shutil.move(downloaded_path, final_path)
-
-            return DownloadedVideo(
-                path=final_path,
-                video_relative_path=video_relative_path,
-                format=download_data["format_id"],
-            )
+        # build proper download path
+        final_path = download_folder / video_relative_path
+
+        if final_path.exists():
+            self._log("video already exists? skipping")
+        else:
+            # move completed download
+            final_path.parent.mkdir(parents=True, exist_ok=True)
+            finalize_file(downloaded_path, final_path)
+
+        finish_job("YouTube", video["id"])
+
+        return DownloadedVideo(
+            path=final_path,
+            video_relative_path=video_relative_path,
+            format=result["format_id"],
+        )
@@ -1,10 +1,155 @@
-from datetime import datetime, timezone
+from datetime import datetime, timedelta, timezone
 from pathlib import Path
 from typing import Literal
 
 import yt_dlp
 
-from ..base_mongo import db
+from archie.config import CacheOptions, HistoryOptions
+from archie.utils import metrics
+
+from ..base_cache import IdCache
+from ..base_catalog import file_catalog
+from ..base_history import History
+from ..base_mongo import db, iterate_batches, upsert
+from ..base_schedule import AccountQueue, RescanPolicy, due_query
+from ..base_search import search_entry, search_index
+
+channel_cache = IdCache("youtube_channels", "channel.id")
+playlist_cache = IdCache("youtube_playlists", "playlist.id")
+video_cache = IdCache("youtube_videos", "video.id")
+
+channel_history = History("youtube_channel_history", "youtube_channels", "channel")
+playlist_history = History("youtube_playlist_history", "youtube_playlists", "playlist")
+accounts = AccountQueue("youtube_accounts", "youtube_channels", "channel")
+
+
+file_catalog.track_downloads("youtube_video_downloads")
+
+
+# backlog of things that have been found but never properly parsed
+def _count_unparsed(collection: str):
+    return lambda: db[collection].count_documents({"_owner_status": "accepted", "_scan_source": {"$ne": "full"}})
+
+
+metrics.parse_queue.set_function(_count_unparsed("youtube_playlists"), service="youtube", kind="playlist")
+metrics.parse_queue.set_function(_count_unparsed("youtube_videos"), service="youtube", kind="video")
+
+# what counts as activity when deciding how soon to rescan something
+CHANNEL_ACTIVITY_FIELDS = ("video_ids", "playlist_ids")
+VIDEO_ACTIVITY_FIELDS = ("video.title", "video.description", "video.comment_count")
+
+video_history = History(
+    "youtube_video_history",
+    "youtube_videos",
+    "video",
+    # stuff that changes every extraction (stream urls etc.) or is too big to be worth versioning
+    ignored_keys=(
+        "formats",
+        "requested_formats",
+        "requested_downloads",
+        "requested_subtitles",
+        "automatic_captions",
+        "subtitles",
+        "comments",
+        "heatmap",
+        "http_headers",
+        "url",
+        "manifest_url",
+        "epoch",
+        "_format_sort_fields",
+    ),
+)
+
+
+def _channel_search_entries(db_channel: dict | None) -> list[dict]:
+    if not db_channel:
+        return []
+
+    channel = db_channel["channel"]
+    return [
+        search_entry(
+            "youtube",
+            "channel",
+            channel["id"],
+            channel.get("channel") or channel.get("title"),
+            channel.get("description"),
+            channel.get("uploader_id"),
+        )
+    ]
+
+
+def _playlist_search_entries(db_playlist: dict | None) -> list[dict]:
+    if not db_playlist:
+        return []
+
+    playlist = db_playlist["playlist"]
+    return [
+        search_entry(
+            "youtube",
+            "playlist",
+            playlist["id"],
+            playlist.get("title"),
+            playlist.get("description"),
+            playlist.get("channel") or playlist.get("uploader"),
+            playlist.get("channel_id"),
+        )
+    ]
+
+
+def _video_search_entries(db_video: dict | None) -> list[dict]:
+    # error entries only have the id
+    if not db_video or "title" not in db_video["video"]:
+        return []
+
+    video = db_video["video"]
+    entries = [
+        search_entry(
+            "youtube",
+            "video",
+            video["id"],
+            video.get("title"),
+            video.get("description"),
+            video.get("channel") or video.get("uploader"),
+            video.get("channel_id"),
+        )
+    ]
+
+    if search_index.options.index_comments:
+        for comment in video.get("comments") or []:
+            entries.append(
+                search_entry("youtube", "comment", comment["id"], None, comment.get("text"), comment.get("author"), video["id"])
+            )
+
+    return entries
+
+
+def backfill_search():
+    search_index.backfill("youtube_channels", _channel_search_entries)
+    search_index.backfill("youtube_playlists", _playlist_search_entries)
+    search_index.backfill("youtube_videos", _video_search_entries)
+
+
+def configure_caches(options: CacheOptions):
+    # before any thread that stores things starts, see IdCache.configure
+    for cache in (channel_cache, playlist_cache, video_cache):
+        cache.configure(options.id_cache_max_entries, options.id_bloom_capacity, options.id_bloom_error_rate)
+
+
+def warm_caches():
+    for cache in (channel_cache, playlist_cache, video_cache):
+        cache.warm()
+
+
+def configure_history(options: HistoryOptions):
+    for history in (channel_history, playlist_history, video_history):
+        history.configure(options.enabled, options.snapshot_interval)
+
+
+def compact_history(options: HistoryOptions):
+    older_than = datetime.now(timezone.utc) - timedelta(days=options.compact_after_days)
+
+    for history in (channel_history, playlist_history, video_history):
+        history.compact(older_than, timedelta(hours=options.compact_granularity_hours))
 
 
 def update_indexes():
@@ -12,27 +157,94 @@ def update_indexes():
     db["youtube_videos"].create_index("video.id", unique=True)
     db["youtube_playlists"].create_index("playlist.id", unique=True)
     db["youtube_video_downloads"].create_index("video_id")
+    db["youtube_channels"].create_index("_next_scan")
+    db["youtube_channels"].create_index([("_status", 1), ("_id", 1)])
+    db["youtube_videos"].create_index("_next_scan")
+    db["youtube_videos"].create_index([("video.channel_id", 1), ("_id", 1)])
+    db["youtube_videos"].create_index([("_owner_status", 1), ("_id", 1)])
+    db["youtube_videos"].create_index([("_owner_status", 1), ("video.upload_date", -1)])
+    db["youtube_videos"].create_index([("_owner_status", 1), ("video.filesize_approx", 1)])
+    db["youtube_playlists"].create_index([("playlist.channel_id", 1), ("_id", 1)])
+    db["youtube_playlists"].create_index("_owner_status")
+    accounts.update_indexes()
+
+    for history in (channel_history, playlist_history, video_history):
+        history.update_indexes()
+
+
+@metrics.timed("youtube.db.get_channel")
+def get_channel(channel_id: str):
+    db_channel = db["youtube_channels"].find_one({"channel.id": channel_id})
+    if db_channel:
+        channel_cache.set(channel_id, db_channel["_scan_source"], db_channel["_status"])
 
+    return db_channel
+
+
+def get_channel_status(channel_id: str | None) -> str | None:
+    if channel_id is None or channel_cache.contains(channel_id) is False:
+        return None
+
+    status = channel_cache.status(channel_id)
+    if status:
+        return status
+
+    db_channel = db["youtube_channels"].find_one({"channel.id": channel_id}, {"_scan_source": 1, "_status": 1})
+    if not db_channel:
+        return None
+
+    channel_cache.set(channel_id, db_channel["_scan_source"], db_channel["_status"])
+    return db_channel["_status"]
+
+
+def _fan_out_channel_status(channel_id: str, status: str):
+    # videos and playlists keep a copy of their channel's status so the queue queries don't need a $lookup
+    for collection, field in (("youtube_videos", "video"), ("youtube_playlists", "playlist")):
+        db[collection].update_many(
+            {f"{field}.channel_id": channel_id, "_owner_status": {"$ne": status}},
+            {"$set": {"_owner_status": status}},
+        )
 
-def get_channel(channel_id: str):
-    return db["youtube_channels"].find_one({"channel.id": channel_id})
+
+def set_channel_status(channel_id: str, status: Literal["accepted", "queued", "rejected"]):
+    if not db["youtube_channels"].update_one({"channel.id": channel_id}, {"$set": {"_status": status}}).matched_count:
+        return
+
+    channel_cache.invalidate(channel_id)
+    _fan_out_channel_status(channel_id, status)
+
+
+def backfill_owner_status():
+    # documents stored before _owner_status existed
+    for collection, field in (("youtube_videos", "video"), ("youtube_playlists", "playlist")):
+        for channel_id in db[collection].distinct(f"{field}.channel_id", {"_owner_status": {"$exists": False}}):
+            db[collection].update_many(
+                {f"{field}.channel_id": channel_id, "_owner_status": {"$exists": False}},
+                {"$set": {"_owner_status": get_channel_status(channel_id)}},
+            )
 
 
+@metrics.timed("youtube.db.store_channel")
 def store_channel(
     channel: dict,
     videos: list[dict],
     playlists: list[dict],
     scan_source: Literal["full", "comment"],
     status: Literal["accepted", "queued", "rejected"],
+    rescan: RescanPolicy | None = None,
 ):
-    existing_db_channel = get_channel(channel["id"])
+    # already have a full scan stored, no point asking mongo
+    if scan_source != "full" and channel_cache.scan_source(channel["id"]) == "full":
+        return
+
+    existing_db_channel = get_channel(channel["id"]) if channel_cache.contains(channel["id"]) is not False else None
     # check to see if the user has already been added, and has been scanned fully.
     # if we're about to replace it with a partial scan then return.
     # TODO: could potentially update the user component only, since it might have changed, but i'd rather keep it simple for now
     if existing_db_channel and existing_db_channel["_scan_source"] == "full" and scan_source != "full":
         return
 
-    db_channel = {
+    db_channel: dict = {
         "_scan_source": scan_source,
         "_status": status if not existing_db_channel else existing_db_channel["_status"],
         "_scan_time": datetime.now(timezone.utc),
@@ -42,35 +254,78 @@ def store_channel(
     db_channel["video_ids"] = []
     for video in videos:
         db_channel["video_ids"].append(video["id"])
-        store_video(video, "channel")
+        store_video(video, "channel", owner_status=db_channel["_status"])
 
     db_channel["playlist_ids"] = []
     for playlist in playlists:
         db_channel["playlist_ids"].append(playlist["id"])
-        store_playlist(playlist, [], "channel", "queued")
+        store_playlist(playlist, [], "channel", "queued", owner_status=db_channel["_status"])
+
+    if existing_db_channel and existing_db_channel["_scan_source"] == "full" and scan_source == "full":
+        channel_history.record(
+            channel["id"], existing_db_channel["channel"], existing_db_channel["_scan_time"], channel, db_channel["_scan_time"]
+        )
+
+    if scan_source == "full" and rescan:
+        db_channel.update(rescan.schedule(existing_db_channel, db_channel))
+        accounts.set_next_scan(channel["id"], db_channel["_next_scan"])
+
+    upsert("youtube_channels", {"channel.id": channel["id"]}, existing_db_channel, db_channel)
+    search_index.update(_channel_search_entries(db_channel), _channel_search_entries(existing_db_channel))
+
+    channel_cache.set(channel["id"], scan_source, db_channel["_status"])
+
+    if not existing_db_channel:
+        # might have picked up some of its videos/playlists before we knew about it
+        _fan_out_channel_status(channel["id"], db_channel["_status"])
+
+
+def sync_accounts(account_ids: list[str], gap_hours: float):
+    accounts.sync(account_ids, gap_hours)
+
+    # configured accounts are always accepted, even if we came across them some other way first
+    for db_channel in db["youtube_channels"].find(
+        {"channel.id": {"$in": account_ids}, "_status": {"$ne": "accepted"}}, {"channel.id": 1}
+    ):
+        set_channel_status(db_channel["channel"]["id"], "accepted")
 
-    if not db["youtube_channels"].find_one_and_replace({"channel.id": channel["id"]}, db_channel):
-        db["youtube_channels"].insert_one(db_channel)
 
+def get_accounts_to_parse(account_ids: list[str]):
+    return accounts.get_due(account_ids)
 
+
+@metrics.timed("youtube.db.get_playlist")
 def get_playlist(playlist_id: str):
-    return db["youtube_playlists"].find_one({"playlist.id": playlist_id})
+    db_playlist = db["youtube_playlists"].find_one({"playlist.id": playlist_id})
+    if db_playlist:
+        playlist_cache.set(playlist_id, db_playlist["_scan_source"])
+
+    return db_playlist
 
 
+@metrics.timed("youtube.db.store_playlist")
 def store_playlist(
-    playlist: dict, videos: list[dict], scan_source: Literal["full", "channel"], status: Literal["accepted", "queued", "rejected"]
+    playlist: dict,
+    videos: list[dict],
+    scan_source: Literal["full", "channel"],
+    status: Literal["accepted", "queued", "rejected"],
+    owner_status: str | None = None,
 ):
-    existing_db_playlist = get_playlist(playlist["id"])
+    if scan_source != "full" and playlist_cache.scan_source(playlist["id"]) == "full":
+        return
+
+    existing_db_playlist = get_playlist(playlist["id"]) if playlist_cache.contains(playlist["id"]) is not False else None
     # check to see if the user has already been added, and has been scanned fully.
     # if we're about to replace it with a partial scan then return.
     # TODO: could potentially update the user component only, since it might have changed, but i'd rather keep it simple for now
     if existing_db_playlist and existing_db_playlist["_scan_source"] == "full" and scan_source != "full":
         return
 
-    db_playlist = {
+    db_playlist: dict = {
         "_scan_source": scan_source,
         "_status": status if not existing_db_playlist else existing_db_playlist["_status"],
         "_scan_time": datetime.now(timezone.utc),
+        "_owner_status": owner_status or get_channel_status(playlist.get("channel_id")),
         "playlist": playlist,
     }
 
@@ -79,14 +334,31 @@ def store_playlist(
         db_playlist["video_ids"].append(video["id"])
         store_video(video, "playlist")
 
-    if not db["youtube_playlists"].find_one_and_replace({"playlist.id": playlist["id"]}, db_playlist):
-        db["youtube_playlists"].insert_one(db_playlist)
+    if existing_db_playlist and existing_db_playlist["_scan_source"] == "full" and scan_source == "full":
+        playlist_history.record(
+            playlist["id"],
+            existing_db_playlist["playlist"],
+            existing_db_playlist["_scan_time"],
+            playlist,
+            db_playlist["_scan_time"],
+        )
+
+    upsert("youtube_playlists", {"playlist.id": playlist["id"]}, existing_db_playlist, db_playlist)
+    search_index.update(_playlist_search_entries(db_playlist), _playlist_search_entries(existing_db_playlist))
 
+    playlist_cache.set(playlist["id"], scan_source)
 
+
+@metrics.timed("youtube.db.get_video")
 def get_video(video_id: str):
-    return db["youtube_videos"].find_one({"video.id": video_id})
+    db_video = db["youtube_videos"].find_one({"video.id": video_id})
+    if db_video:
+        video_cache.set(video_id, db_video["_scan_source"])
+
+    return db_video
 
 
+@metrics.timed("youtube.db.store_video_error")
 def store_video_error(video_id: str, error: yt_dlp.utils.YoutubeDLError):
     scan_time = datetime.now(timezone.utc)
 
@@ -100,32 +372,52 @@ def store_video_error(video_id: str, error: yt_dlp.utils.YoutubeDLError):
         "error": error.msg,
     }
 
-    if not db["youtube_videos"].find_one_and_update(
-        {"video.id": video_id},
-        {"$set": db_video_fail},
-    ):
-        db["youtube_videos"].insert_one(
-            {
-                **db_video_fail,
-                "video": {"id": video_id},
-            }
-        )
+    # upserting seeds video.id from the filter
+    db["youtube_videos"].update_one({"video.id": video_id}, {"$set": db_video_fail}, upsert=True)
+
+    video_cache.set(video_id, "full")
 
 
-def store_video(video: dict, scan_source: Literal["full", "channel", "playlist"]):
-    existing_db_video = get_video(video["id"])
+@metrics.timed("youtube.db.store_video")
+def store_video(
+    video: dict,
+    scan_source: Literal["full", "channel", "playlist"],
+    rescan: RescanPolicy | None = None,
+    owner_status: str | None = None,
+    comments_count: int | None = None,
+):
+    if scan_source != "full" and video_cache.scan_source(video["id"]) == "full":
+        return
+
+    existing_db_video = get_video(video["id"]) if video_cache.contains(video["id"]) is not False else None
     # check to see if the user has already been added, and has been scanned fully.
     # if we're about to replace it with a partial scan then return.
     # TODO: could potentially update the user component only, since it might have changed, but i'd rather keep it simple for now
     if existing_db_video and existing_db_video["_scan_source"] == "full" and scan_source != "full":
         return
 
-    db_video = {
+    db_video: dict = {
         "_scan_source": scan_source,
         "_scan_time": datetime.now(timezone.utc),
+        "_owner_status": owner_status or get_channel_status(video.get("channel_id")),
         "video": video,
     }
 
+    # comment_count as of when the stored comments were fetched, left as it is if they weren't fetched this time
+    if comments_count is not None:
+        db_video["_comments_count"] = comments_count
+
+    # error entries don't have anything worth versioning
+    if (
+        existing_db_video
+        and existing_db_video["_scan_source"] == "full"
+        and scan_source == "full"
+        and "error" not in existing_db_video
+    ):
+        video_history.record(
+            video["id"], existing_db_video["video"], existing_db_video["_scan_time"], video, db_video["_scan_time"]
+        )
+
     # TODO: store comments in separate collection like soundcloud?
     # if "comments" in video and video["comments"]:
     #     # del db_video["video"]["comments"]
@@ -143,114 +435,91 @@ def store_video(video: dict, scan_source: Literal["full", "channel", "playlist"]
     #             "queued",
     #         )
 
-    if not db["youtube_videos"].find_one_and_replace({"video.id": video["id"]}, db_video):
-        db["youtube_videos"].insert_one(db_video)
+    if scan_source == "full" and rescan:
+        db_video.update(rescan.schedule(existing_db_video, db_video))
+
+    upsert("youtube_videos", {"video.id": video["id"]}, existing_db_video, db_video)
+    search_index.update(_video_search_entries(db_video), _video_search_entries(existing_db_video))
+
+    video_cache.set(video["id"], scan_source)
+
+
+def get_channel_as_of(channel_id: str, time: datetime) -> dict | None:
+    return channel_history.as_of(channel_id, time)
+
+
+def get_playlist_as_of(playlist_id: str, time: datetime) -> dict | None:
+    return playlist_history.as_of(playlist_id, time)
+
+
+def get_video_as_of(video_id: str, time: datetime) -> dict | None:
+    return video_history.as_of(video_id, time)
 
 
 def get_playlist_to_parse(min_update_time: datetime):
-    pipeline = [
+    return db["youtube_playlists"].find(
         {
-            "$match": {
-                "$or": [
-                    {
-                        "_scan_source": {
-                            "$ne": "full",
-                        },
+            "_owner_status": "accepted",
+            "$or": [
+                {
+                    "_scan_source": {
+                        "$ne": "full",
                     },
-                    {
-                        "_scan_time": {
-                            "$lt": min_update_time,
-                        }
-                    },
-                ]
-            }
-        },
-        {
-            "$lookup": {
-                "from": "youtube_channels",
-                "localField": "playlist.channel_id",
-                "foreignField": "channel.id",
-                "as": "channel_info",
-            }
-        },
-        {
-            "$match": {
-                "channel_info._status": "accepted",
-            }
-        },
-    ]
-
-    return db["youtube_playlists"].aggregate(pipeline)
+                },
+                {
+                    "_scan_time": {
+                        "$lt": min_update_time,
+                    }
+                },
+            ],
+        }
+    )
 
 
 def get_video_to_parse(min_update_time: datetime):
-    pipeline = [
+    return iterate_batches(
+        "youtube_videos",
         {
-            "$match": {
-                "error": {
-                    "$exists": False,
-                }
-            }
-        },
-        {
-            "$match": {
-                "$or": [
-                    {
-                        "_scan_source": {
-                            "$ne": "full",
-                        },
-                    },
-                    {
-                        "_scan_time": {
-                            "$lt": min_update_time,
-                        }
-                    },
-                ]
-            }
-        },
-        {
-            "$lookup": {
-                "from": "youtube_channels",
-                "localField": "video.channel_id",
-                "foreignField": "channel.id",
-                "as": "channel_info",
-            }
-        },
-        {
-            "$match": {
-                "channel_info._status": "accepted",
-            }
+            "error": {
+                "$exists": False,
+            },
+            "_owner_status": "accepted",
+            **due_query(min_update_time),
         },
-    ]
+        "youtube_videos_to_parse",
+    )
 
-    return db["youtube_videos"].aggregate(pipeline)
 
+# filesize_approx is yt-dlp's estimate for the format it would pick, from when the video was scanned
+DOWNLOAD_SORTS = {
+    "newest": {"video.upload_date": -1},
+    "smallest": {"video.filesize_approx": 1},
+    "archive": {"video.upload_date": -1},
+}
 
-def get_undownloaded_video(skip_ids: list[str]):
-    pipeline = [
-        {
-            "$match": {
-                "_scan_source": "full",
-                "video.id": {
-                    "$nin": skip_ids,
-                },
-                # "video.duration": {
-                #     "$lt": 130,
-                # },
-            }
+
+@metrics.timed("youtube.db.get_undownloaded_video")
+def get_undownloaded_video(skip_ids: list[str], priority: str = "newest", channel_ids: list | None = None):
+    match: dict = {
+        "_scan_source": "full",
+        "_owner_status": "accepted",
+        "video.id": {
+            "$nin": skip_ids,
         },
+        # "video.duration": {
+        #     "$lt": 130,
+        # },
+    }
+
+    if channel_ids is not None:
+        match["video.channel_id"] = {"$in": channel_ids}
+
+    pipeline = [
         {
-            "$lookup": {
-                "from": "youtube_channels",
-                "localField": "video.channel_id",
-                "foreignField": "channel.id",
-                "as": "channel_info",
-            }
+            "$match": match,
         },
         {
-            "$match": {
-                "channel_info._status": "accepted",
-            }
+            "$sort": DOWNLOAD_SORTS[priority],
         },
         {
             "$lookup": {
@@ -282,20 +551,25 @@ def get_undownloaded_video(skip_ids: list[str]):
     return next(res, None)
 
 
-def store_download(video_id: str, path: Path, relative_video_path: Path, format: str):
+@metrics.timed("youtube.db.store_download")
+def store_download(video_id: str, path: Path, relative_video_path: Path, format: str, node: str | None = None):
     db_download = {
         "_download_time": datetime.now(timezone.utc),
         "video_id": video_id,
         "path": str(path),
         "relative_video_path": str(relative_video_path),
         "format": format,
+        "node": node,
     }
 
     db["youtube_video_downloads"].insert_one(db_download)
 
 
-def get_downloads():
-    for download in db["youtube_video_downloads"].find():
+def get_downloads(node: str | None = None):
+    # node: only the ones that node downloaded (older downloads don't say where they came from, so they're left out)
+    query = {"node": node} if node else {}
+
+    for download in db["youtube_video_downloads"].find(query):
         yield download
 
 
@@ -0,0 +1,354 @@
+import threading
+import time
+import types
+from bisect import bisect_left
+from collections import deque
+from contextlib import contextmanager
+from functools import wraps
+from typing import Callable, Iterator, ParamSpec, TypeVar
+
+from archie.utils import utils
+
+# seconds. covers everything from a mongo lookup to a long download
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300, 1800, 7200)
+
+_registry: list["Metric"] = []
+
+P = ParamSpec("P")
+R = TypeVar("R")
+
+
+def log(*args, **kwargs):
+    utils.module_log("metrics", "cyan", *args, **kwargs)
+
+
+def _escape(value: str):
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names: tuple[str, ...], values: tuple[str, ...], extra: str = ""):
+    labels = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        labels.append(extra)
+
+    return "{" + ",".join(labels) + "}" if labels else ""
+
+
+class Metric:
+    type = ""
+
+    def __init__(self, name: str, help: str, labels: tuple[str, ...] = ()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def _key(self, labels: dict) -> tuple[str, ...]:
+        return tuple(str(labels.get(name, "")) for name in self.labels)
+
+    def _lines(self) -> Iterator[str]:
+        raise NotImplementedError
+
+    def render(self):
+        return "\n".join([f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.type}", *self._lines()])
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def __init__(self, name: str, help: str, labels: tuple[str, ...] = ()):
+        super().__init__(name, help, labels)
+        self._values: dict[tuple[str, ...], float] = {}
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def total(self, **labels) -> float:
+        # summed over every label set, or just the ones matching labels
+        match = [(self.labels.index(name), str(value)) for name, value in labels.items()]
+        with self._lock:
+            return sum(value for key, value in self._values.items() if all(key[index] == want for index, want in match))
+
+    def _lines(self):
+        with self._lock:
+            values = list(self._values.items())
+
+        for key, value in values:
+            yield f"{self.name}{_format_labels(self.labels, key)} {value}"
+
+
+class Gauge(Metric):
+    type = "gauge"
+
+    def __init__(self, name: str, help: str, labels: tuple[str, ...] = ()):
+        super().__init__(name, help, labels)
+        self._values: dict[tuple[str, ...], float | Callable[[], float]] = {}
+
+    def set(self, value: float, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            value = self._values.get(key, 0)
+            assert not callable(value)
+            self._values[key] = value + amount
+
+    def dec(self, amount: float = 1, **labels):
+        self.inc(-amount, **labels)
+
+    def set_function(self, fn: Callable[[], float], **labels):
+        # worked out when scraped, for things that are expensive to keep up to date (e.g. counting documents)
+        with self._lock:
+            self._values[self._key(labels)] = fn
+
+    def _items(self) -> Iterator[tuple[tuple[str, ...], float]]:
+        with self._lock:
+            values = list(self._values.items())
+
+        for key, value in values:
+            if callable(value):
+                try:
+                    value = value()
+                except Exception:
+                    continue
+
+            yield key, value
+
+    def values(self) -> list[dict]:
+        # each label set with its current value, e.g. [{"service": "youtube", "kind": "video", "value": 3}]
+        return [{**dict(zip(self.labels, key)), "value": value} for key, value in self._items()]
+
+    def _lines(self):
+        for key, value in self._items():
+            yield f"{self.name}{_format_labels(self.labels, key)} {value}"
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, name: str, help: str, labels: tuple[str, ...] = (), buckets: tuple[float, ...] = DEFAULT_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = buckets
+        # per label set: count per bucket (plus +Inf), sum, count
+        self._values: dict[tuple[str, ...], tuple[list[int], float, int]] = {}
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            counts, total, count = self._values.get(key) or ([0] * (len(self.buckets) + 1), 0.0, 0)
+            counts[bisect_left(self.buckets, value)] += 1
+            self._values[key] = (counts, total + value, count + 1)
+
+    def totals(self) -> tuple[float, int]:
+        # (sum, count) over every label set
+        with self._lock:
+            return sum(value[1] for value in self._values.values()), sum(value[2] for value in self._values.values())
+
+    def counts(self) -> dict[tuple[str, ...], int]:
+        # observations per label set
+        with self._lock:
+            return {key: value[2] for key, value in self._values.items()}
+
+    def _lines(self):
+        with self._lock:
+            values = [(key, (list(counts), total, count)) for key, (counts, total, count) in self._values.items()]
+
+        for key, (counts, total, count) in values:
+            cumulative = 0
+            for bound, bucket_count in zip([*map(str, self.buckets), "+Inf"], counts):
+                cumulative += bucket_count
+                le = f'le="{bound}"'
+                yield f"{self.name}_bucket{_format_labels(self.labels, key, le)} {cumulative}"
+
+            yield f"{self.name}_sum{_format_labels(self.labels, key)} {total}"
+            yield f"{self.name}_count{_format_labels(self.labels, key)} {count}"
+
+
+def render() -> str:
+    # prometheus text format
+    return "\n\n".join(metric.render() for metric in _registry) + "\n"
+
+
+call_duration = Histogram("archie_call_duration_seconds", "Time spent in instrumented calls", ("call",))
+call_errors = Counter("archie_call_errors_total", "Instrumented calls that raised", ("call",))
+
+mongo_duration = Histogram("archie_mongo_command_duration_seconds", "Mongo command latency", ("command", "collection"))
+mongo_errors = Counter("archie_mongo_command_errors_total", "Mongo commands that failed", ("command", "collection"))
+
+items_parsed = Counter("archie_items_parsed_total", "Items fully parsed", ("service", "kind"))
+parse_failures = Counter("archie_parse_failures_total", "Items that failed to parse", ("service", "kind"))
+parse_queue = Gauge("archie_parse_queue", "Items waiting for their first full parse", ("service", "kind"))
+
+downloads = Counter("archie_downloads_total", "Finished downloads", ("service",))
+download_failures = Counter("archie_download_failures_total", "Failed downloads", ("service",))
+download_bytes = Counter("archie_download_bytes_total", "Size of finished downloads", ("service",))
+download_duration = Histogram("archie_download_duration_seconds", "Time taken per download", ("service",))
+active_downloads = Gauge("archie_active_downloads", "Downloads in progress", ("service",))
+pipeline_queue = Gauge("archie_pipeline_queue", "Downloads waiting for a pipeline stage", ("service", "stage"))
+pipeline_busy = Gauge("archie_pipeline_busy", "Pipeline stage workers busy", ("service", "stage"))
+# method is rename (staged on the same drive, nothing copied, so these are the bytes saved) or copy
+finalize_bytes = Counter("archie_finalize_bytes_total", "Bytes of finished downloads moved into place", ("method",))
+
+# result is hit, miss (fetched) or coalesced (waited for someone else's identical call that was already running)
+api_cache = Counter("archie_api_cache_total", "Cached api lookups", ("call", "result"))
+
+catalog_changes = Counter("archie_catalog_changes_total", "Files/downloads the file catalog found changed", ("change",))
+
+
+class SlowSpans:
+    """
+    The most recent calls that took longer than threshold_ms, kept in a ring buffer so there's something to look at when
+    things slow down without having to log every call.
+    """
+
+    def __init__(self, threshold_ms: float = 1000, max_spans: int = 500):
+        self.threshold = threshold_ms / 1000
+        self._spans: deque[dict] = deque(maxlen=max_spans)
+        self._lock = threading.Lock()
+
+    def configure(self, threshold_ms: float, max_spans: int):
+        with self._lock:
+            self.threshold = threshold_ms / 1000
+            self._spans = deque(self._spans, maxlen=max_spans)
+
+    def record(self, call: str, start: float, duration: float, error: bool = False, **details):
+        # start is a perf_counter() time
+        if duration < self.threshold:
+            return
+
+        span = {
+            "call": call,
+            "thread": threading.current_thread().name,
+            "start": time.time() - (time.perf_counter() - start),
+            "duration_ms": round(duration * 1000, 1),
+            "error": error,
+            **details,
+        }
+
+        with self._lock:
+            self._spans.append(span)
+
+    def snapshot(self, limit: int | None = None, call: str | None = None) -> list[dict]:
+        # newest first, optionally only calls starting with call
+        with self._lock:
+            spans = list(self._spans)
+
+        spans = [span for span in reversed(spans) if not call or span["call"].startswith(call)]
+        return spans[:limit] if limit else spans
+
+
+slow_spans = SlowSpans()
+
+
+def _observe(call: str, start: float, error: bool):
+    duration = time.perf_counter() - start
+
+    if error:
+        call_errors.inc(call=call)
+
+    call_duration.observe(duration, call=call)
+    slow_spans.record(call, start, duration, error)
+
+
+@contextmanager
+def timer(call: str):
+    start = time.perf_counter()
+    error = False
+    try:
+        yield
+    except Exception:
+        error = True
+        raise
+    finally:
+        _observe(call, start, error)
+
+
+def timed(call: str) -> Callable[[Callable[P, R]], Callable[P, R]]:
+    def decorator(fn: Callable[P, R]) -> Callable[P, R]:
+        @wraps(fn)
+        def wrapper(*args: P.args, **kwargs: P.kwargs) -> R:
+            with timer(call):
+                return fn(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def _time_generator(generator: types.GeneratorType, call: str, start: float):
+    # lazy api calls (paginated lists) only do their work while being iterated, so time until they're used up
+    error = False
+    try:
+        yield from generator
+    except Exception:
+        error = True
+        raise
+    finally:
+        _observe(call, start, error)
+
+
+class Instrumented:
+    """
+    Wraps an api client so every method call on it is timed as <prefix>.<method>.
+    """
+
+    def __init__(self, obj, prefix: str):
+        self._obj = obj
+        self._prefix = prefix
+
+    def __getattr__(self, name: str):
+        attr = getattr(self._obj, name)
+        if not callable(attr):
+            return attr
+
+        call = f"{self._prefix}.{name}"
+
+        @wraps(attr)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                result = attr(*args, **kwargs)
+            except Exception:
+                _observe(call, start, True)
+                raise
+
+            if isinstance(result, types.GeneratorType):
+                return _time_generator(result, call, start)
+
+            _observe(call, start, False)
+            return result
+
+        return wrapper
+
+
+def log_summaries(interval_minutes: float):
+    # a line every interval with what happened since the last one
+    def snapshot():
+        return (
+            items_parsed.total(),
+            downloads.total(),
+            download_bytes.total(),
+            *mongo_duration.totals(),
+            call_errors.total() + parse_failures.total() + download_failures.total() + mongo_errors.total(),
+        )
+
+    last = snapshot()
+    while True:
+        time.sleep(interval_minutes * 60)
+
+        current = snapshot()
+        parsed, downloaded, size, mongo_time, mongo_count, errors = (now - then for now, then in zip(current, last))
+        last = current
+
+        mongo_avg = mongo_time / mongo_count * 1000 if mongo_count else 0
+        log(
+            f"last {interval_minutes:g} min: parsed {parsed:.0f} items, downloaded {downloaded:.0f} "
+            f"({size / 1024**2:.1f} MB, {size / 1024**2 / (interval_minutes * 60):.2f} MB/s), "
+            f"{mongo_count:.0f} mongo commands (avg {mongo_avg:.1f}ms), {errors:.0f} errors"
+        )
@@ -0,0 +1,122 @@
+import os
+import re
+import sys
+import threading
+import time
+from collections import Counter
+from pathlib import Path
+from types import FrameType
+
+from archie.utils import utils
+
+
+def log(*args, **kwargs):
+    utils.module_log("profiler", "magenta", *args, **kwargs)
+
+
+def _frame_name(frame: FrameType):
+    # co_qualname (Class.method) is 3.11+
+    code = frame.f_code
+    return f"{frame.f_globals.get('__name__', '?')}:{getattr(code, 'co_qualname', code.co_name)}"
+
+
+def _thread_name(name: str):
+    # Thread-12 (_download_videos) -> Thread (_download_videos), so all the workers of one kind add up to one stack
+    return re.sub(r"-\d+", "", name)
+
+
+class SamplingProfiler:
+    """
+    Samples every thread's stack every interval and counts how often each stack comes up, written out as collapsed stacks
+    (`thread;module:function;... count`, one per line) for flamegraph.pl/speedscope/inferno.
+
+    This is wall clock time, so threads waiting on the network or sleeping show up too - that's usually what you want to see
+    when archie's slow, just look under the thread you care about.
+    """
+
+    def __init__(self):
+        self.output: Path | None = None
+        self.samples = 0
+
+        self._stacks: Counter[str] = Counter()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread: threading.Thread | None = None
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self, output: Path, interval_ms: float = 10, write_interval_seconds: float = 60):
+        self.output = output
+        self._stop.clear()
+        self._thread = threading.Thread(
+            target=self._run, args=(interval_ms / 1000, write_interval_seconds), name="profiler", daemon=True
+        )
+        self._thread.start()
+
+        log(f"sampling every {interval_ms:g}ms, writing collapsed stacks to {output}")
+
+    def stop(self):
+        if not self._thread:
+            return
+
+        self._stop.set()
+        self._thread.join()
+        self._thread = None
+
+        self.write()
+        log(f"wrote {self.samples} samples to {self.output}")
+
+    def _run(self, interval: float, write_interval: float):
+        last_write = time.monotonic()
+
+        while not self._stop.wait(interval):
+            self.sample()
+
+            # written as it goes so there's something to look at even if archie gets killed
+            if time.monotonic() - last_write > write_interval:
+                self.write()
+                last_write = time.monotonic()
+
+    def sample(self):
+        own = threading.get_ident()
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+
+        stacks = []
+        for ident, frame in sys._current_frames().items():
+            if ident == own:
+                continue
+
+            stack = []
+            current: FrameType | None = frame
+            while current:
+                stack.append(_frame_name(current))
+                current = current.f_back
+
+            stack.append(_thread_name(names.get(ident, "unknown")))
+            stacks.append(";".join(reversed(stack)))
+
+        with self._lock:
+            self._stacks.update(stacks)
+            self.samples += 1
+
+    def collapsed(self) -> str:
+        with self._lock:
+            stacks = sorted(self._stacks.items())
+
+        return "".join(f"{stack} {count}\n" for stack, count in stacks)
+
+    def write(self):
+        if not self.output:
+            return
+
+        self.output.parent.mkdir(parents=True, exist_ok=True)
+
+        # replaced in one go so whatever's reading it never sees half a file
+        temp_path = self.output.with_name(self.output.name + ".tmp")
+        temp_path.write_text(self.collapsed())
+        os.replace(temp_path, self.output)
+
+
+profiler = SamplingProfiler()
@@ -1,3 +1,5 @@
+import threading
+from typing import Callable
 from urllib.parse import urlparse
 
 import yaml
@@ -14,6 +16,37 @@ def module_log(module: str, module_style: str | Style | None, *args, **kwargs):
     console.print(f"[{module_style}]\\[{module}][/{module_style}] " + " ".join(map(str, args)), **kwargs)
 
 
+class Lazy:
+    """
+    Stands in for something that's expensive to create (clients that connect somewhere), creating it on first use so
+    importing a module never does any I/O.
+    """
+
+    def __init__(self, factory: Callable):
+        self._factory = factory
+        self._obj = None
+        self._lock = threading.Lock()
+
+    def get(self):
+        if self._obj is None:
+            with self._lock:
+                if self._obj is None:
+                    self._obj = self._factory()
+
+        return self._obj
+
+    def set(self, obj):
+        # use obj instead, e.g. to point the database at a throwaway one before anything has connected
+        with self._lock:
+            self._obj = obj
+
+    def __getattr__(self, name: str):
+        return getattr(self.get(), name)
+
+    def __getitem__(self, key):
+        return self.get()[key]
+
+
 def validate_url(x):
     try:
         result = urlparse(x)
@@ -0,0 +1,372 @@
+"""
+Deterministic stand-ins for `YouTubeAPI` and the `SoundCloud` client, so the services can be run without touching the network.
+
+Everything is generated from the account/track index and a seed, so the same arguments always produce the same data.
+"""
+
+import dataclasses
+import random
+import typing
+from datetime import datetime, timedelta, timezone
+from functools import cache
+
+import soundcloud
+
+EPOCH = datetime(2020, 1, 1, tzinfo=timezone.utc)
+
+WORDS = (
+    "lorem ipsum dolor sit amet consectetur adipiscing elit sed do eiusmod tempor incididunt ut labore et dolore magna".split()
+)
+
+
+def _text(rng: random.Random, words: int):
+    return " ".join(rng.choice(WORDS) for _ in range(words))
+
+
+class FakeYouTubeAPI:
+    """
+    Channels with videos_per_channel videos and playlists_per_channel playlists, each playlist holding videos_per_playlist
+    of the channel's videos. Videos come back with comments_per_video comments. Channel ids come from channel_ids().
+    """
+
+    def __init__(
+        self,
+        videos_per_channel: int = 100,
+        playlists_per_channel: int = 5,
+        videos_per_playlist: int = 20,
+        comments_per_video: int = 20,
+        seed: int = 0,
+    ):
+        self.videos_per_channel = videos_per_channel
+        self.playlists_per_channel = playlists_per_channel
+        self.videos_per_playlist = videos_per_playlist
+        self.comments_per_video = comments_per_video
+        self.seed = seed
+
+    @staticmethod
+    def channel_ids(count: int) -> list[str]:
+        return [f"UC{index:022d}" for index in range(count)]
+
+    @staticmethod
+    def _channel_index(channel_id: str):
+        return int(channel_id.removeprefix("UC"))
+
+    def _video_id(self, channel_index: int, video_index: int):
+        return f"v{channel_index:04d}{video_index:06d}"
+
+    def _playlist_id(self, channel_index: int, playlist_index: int):
+        return f"PL{channel_index:04d}{playlist_index:06d}"
+
+    def _flat_video(self, video_id: str):
+        rng = random.Random(f"{self.seed}:{video_id}")
+        return {
+            "_type": "url",
+            "ie_key": "Youtube",
+            "id": video_id,
+            "url": f"https://www.youtube.com/watch?v={video_id}",
+            "title": _text(rng, 6),
+            "duration": rng.randint(30, 3600),
+            "view_count": rng.randint(0, 1_000_000),
+        }
+
+    def get_channel_id_from_url(self, account_link: str) -> str | None:
+        return account_link.rsplit("/", 1)[-1]
+
+    def get_channel_url_from_id(self, account_id: str):
+        return f"https://youtube.com/channel/{account_id}"
+
+    def get_channel_and_videos(self, account_id, from_spider: bool = False):
+        index = self._channel_index(account_id)
+        rng = random.Random(f"{self.seed}:{account_id}")
+
+        channel = {
+            "id": account_id,
+            "channel": f"channel {index}",
+            "title": f"channel {index} - Videos",
+            "uploader_id": f"@channel{index}",
+            "channel_follower_count": rng.randint(0, 100_000),
+            "description": _text(rng, 40),
+            "tags": [rng.choice(WORDS) for _ in range(5)],
+        }
+        videos = [self._flat_video(self._video_id(index, i)) for i in range(self.videos_per_channel)]
+        return channel, videos
+
+    def get_channel_playlists(self, account_id):
+        index = self._channel_index(account_id)
+        return [
+            {"_type": "url", "id": self._playlist_id(index, i), "title": f"playlist {i}"}
+            for i in range(self.playlists_per_channel)
+        ]
+
+    def get_playlist(self, playlist_id: str):
+        channel_index, playlist_index = int(playlist_id[2:6]), int(playlist_id[6:])
+
+        playlist = {
+            "id": playlist_id,
+            "title": f"playlist {playlist_index}",
+            "channel_id": f"UC{channel_index:022d}",
+            "playlist_count": self.videos_per_playlist,
+        }
+
+        # unlike the channel's videos tab, playlist entries say which channel they're from
+        start = playlist_index * self.videos_per_playlist
+        videos = [
+            {
+                **self._flat_video(self._video_id(channel_index, (start + i) % max(self.videos_per_channel, 1))),
+                "channel_id": playlist["channel_id"],
+            }
+            for i in range(self.videos_per_playlist)
+        ]
+        return playlist, videos
+
+    def get_video_data(self, video_id: str, spider: bool = False, get_comments: bool = True, max_comments: int | None = None):
+        channel_index = int(video_id[1:5])
+        rng = random.Random(f"{self.seed}:{video_id}:full")
+        upload_date = EPOCH + timedelta(days=int(video_id[5:]))
+
+        video = {
+            **self._flat_video(video_id),
+            "channel_id": f"UC{channel_index:022d}",
+            "channel": f"channel {channel_index}",
+            "description": _text(rng, 80),
+            "upload_date": upload_date.strftime("%Y%m%d"),
+            "timestamp": int(upload_date.timestamp()),
+            "like_count": rng.randint(0, 10_000),
+            "comment_count": self.comments_per_video,
+            "tags": [rng.choice(WORDS) for _ in range(10)],
+            "filesize_approx": rng.randint(1, 500) * 1024**2,
+            "formats": [
+                {"format_id": str(format_id), "ext": "mp4", "height": height, "url": f"https://example.invalid/{video_id}"}
+                for format_id, height in ((18, 360), (22, 720), (137, 1080))
+            ],
+        }
+
+        if get_comments:
+            count = self.comments_per_video if max_comments is None else min(max_comments, self.comments_per_video)
+            video["comments"] = [
+                {
+                    "id": f"{video_id}.c{i}",
+                    "text": _text(rng, 15),
+                    "author": f"commenter {i}",
+                    "author_id": f"UC{9999:04d}{i:018d}",
+                    "timestamp": int(upload_date.timestamp()) + i * 60,
+                    "parent": "root",
+                }
+                for i in range(count)
+            ]
+
+        return video, None
+
+
+@cache
+def _hints(cls):
+    return typing.get_type_hints(cls)
+
+
+def build(cls, **values):
+    # fills in every field the test data doesn't care about with an empty value of the right type
+    hints = _hints(cls)
+
+    for field in dataclasses.fields(cls):
+        if field.name in values:
+            continue
+
+        values[field.name] = _empty(hints[field.name])
+
+    return cls(**values)
+
+
+def _empty(hint):
+    origin = typing.get_origin(hint)
+
+    if origin is typing.Union:
+        return None if type(None) in typing.get_args(hint) else _empty(typing.get_args(hint)[0])
+    if origin is tuple:
+        return ()
+    if dataclasses.is_dataclass(hint):
+        return build(hint)
+
+    return {int: 0, str: "", bool: False, float: 0.0, datetime: EPOCH}.get(hint)
+
+
+class FakeSoundCloud:
+    """
+    Users with tracks_per_user tracks, each track with likers_per_track likers and comments_per_track comments. Likers and
+    commenters are drawn from a shared pool of audience_size users so they overlap between tracks like they would on the
+    real site. Account ids come from user_ids().
+    """
+
+    ACCOUNT_OFFSET = 1_000_000
+    # users that aren't being archived but get reposted
+    ARTIST_OFFSET = 1_500_000
+    AUDIENCE_OFFSET = 2_000_000
+
+    def __init__(
+        self,
+        tracks_per_user: int = 50,
+        likers_per_track: int = 20,
+        comments_per_track: int = 10,
+        reposts_per_user: int = 5,
+        audience_size: int = 5_000,
+        seed: int = 0,
+    ):
+        self.tracks_per_user = tracks_per_user
+        self.likers_per_track = likers_per_track
+        self.comments_per_track = comments_per_track
+        self.reposts_per_user = reposts_per_user
+        self.audience_size = audience_size
+        self.seed = seed
+
+    @classmethod
+    def user_ids(cls, count: int) -> list[int]:
+        return [cls.ACCOUNT_OFFSET + index for index in range(count)]
+
+    def _user(self, user_id: int, cls=soundcloud.User):
+        return build(
+            cls,
+            id=user_id,
+            kind="user",
+            username=f"user{user_id}",
+            permalink=f"user{user_id}",
+            permalink_url=f"https://soundcloud.com/user{user_id}",
+            urn=f"soundcloud:users:{user_id}",
+            followers_count=user_id % 1000,
+        )
+
+    def _track_ids(self, user_id: int):
+        base = (user_id - self.ACCOUNT_OFFSET) * self.tracks_per_user
+        return range(base + 1, base + 1 + self.tracks_per_user)
+
+    def _owner(self, track_id: int):
+        return self.ACCOUNT_OFFSET + (track_id - 1) // max(self.tracks_per_user, 1)
+
+    def _audience(self, key: str, count: int):
+        rng = random.Random(f"{self.seed}:{key}")
+        return [self.AUDIENCE_OFFSET + index for index in rng.sample(range(self.audience_size), min(count, self.audience_size))]
+
+    def _track(self, track_id: int):
+        rng = random.Random(f"{self.seed}:track:{track_id}")
+        owner = self._owner(track_id)
+
+        return build(
+            soundcloud.BasicTrack,
+            id=track_id,
+            kind="track",
+            title=_text(rng, 5),
+            description=_text(rng, 30),
+            duration=rng.randint(60_000, 600_000),
+            created_at=EPOCH + timedelta(hours=track_id),
+            permalink_url=f"https://soundcloud.com/user{owner}/track{track_id}",
+            likes_count=self.likers_per_track,
+            comment_count=self.comments_per_track,
+            user_id=owner,
+            user=self._user(owner, soundcloud.BasicUser),
+        )
+
+    def get_user(self, user_id: int):
+        return self._user(user_id)
+
+    def get_user_tracks(self, user_id: int, **kwargs):
+        for track_id in self._track_ids(user_id):
+            yield self._track(track_id)
+
+    def get_user_playlists(self, user_id: int, **kwargs):
+        # one playlist holding the user's first few tracks
+        track_ids = list(self._track_ids(user_id))[:10]
+        if not track_ids:
+            return
+
+        yield build(
+            soundcloud.BasicAlbumPlaylist,
+            id=user_id,
+            kind="playlist",
+            title=f"playlist by user{user_id}",
+            user_id=user_id,
+            user=self._user(user_id, soundcloud.BasicUser),
+            track_count=len(track_ids),
+            tracks=tuple(build(soundcloud.MiniTrack, id=track_id, kind="track") for track_id in track_ids),
+        )
+
+    def get_user_links(self, user_urn: str):
+        return [build(soundcloud.WebProfile, url=f"https://example.invalid/{user_urn}", network="personal", title="site")]
+
+    def get_user_reposts(self, user_id: int, **kwargs):
+        # reposts of other artists' first tracks
+        for index in range(self.reposts_per_user):
+            track_ids = self._track_ids(self.ARTIST_OFFSET + (user_id - self.ACCOUNT_OFFSET) * self.reposts_per_user + index)
+            if not track_ids:
+                continue
+
+            yield build(
+                soundcloud.TrackStreamRepostItem,
+                type="track-repost",
+                uuid=f"{user_id}-{index}",
+                created_at=EPOCH + timedelta(days=index),
+                user=self._user(user_id, soundcloud.BasicUser),
+                track=self._track(track_ids[0]),
+            )
+
+    def get_track(self, track_id: int):
+        return self._track(track_id)
+
+    def get_tracks(self, track_ids: list[int]):
+        return [self._track(track_id) for track_id in track_ids]
+
+    def get_track_albums(self, track_id: int, **kwargs):
+        return iter(())
+
+    def get_track_comments(self, track_id: int, **kwargs):
+        rng = random.Random(f"{self.seed}:comments:{track_id}")
+        for index, user_id in enumerate(self._audience(f"commenters:{track_id}", self.comments_per_track)):
+            yield build(
+                soundcloud.BasicComment,
+                kind="comment",
+                id=track_id * 10_000 + index,
+                body=_text(rng, 12),
+                created_at=EPOCH + timedelta(minutes=index),
+                track_id=track_id,
+                user_id=user_id,
+                user=self._user(user_id, soundcloud.BasicUser),
+            )
+
+    def get_track_likers(self, track_id: int, **kwargs):
+        for user_id in self._audience(f"likers:{track_id}", self.likers_per_track):
+            yield self._user(user_id)
+
+    def get_track_reposters(self, track_id: int, **kwargs):
+        return iter(())
+
+    def get_track_playlists(self, track_id: int, **kwargs):
+        return iter(())
+
+
+def mongomock_client():
+    # an in-memory stand-in for MongoClient, raises ImportError if mongomock isn't installed
+    import mongomock
+    from pymongo import (
+        DeleteMany,
+        DeleteOne,
+        InsertOne,
+        ReplaceOne,
+        UpdateMany,
+        UpdateOne,
+    )
+
+    # mongomock's bulk_write doesn't understand the operations newer pymongo versions build, so apply them one at a time
+    def bulk_write(self, requests, ordered=True, **kwargs):
+        for request in requests:
+            if isinstance(request, UpdateOne):
+                self.update_one(request._filter, request._doc, upsert=request._upsert)
+            elif isinstance(request, UpdateMany):
+                self.update_many(request._filter, request._doc, upsert=request._upsert)
+            elif isinstance(request, ReplaceOne):
+                self.replace_one(request._filter, request._doc, upsert=request._upsert)
+            elif isinstance(request, InsertOne):
+                self.insert_one(request._doc)
+            elif isinstance(request, DeleteOne):
+                self.delete_one(request._filter)
+            elif isinstance(request, DeleteMany):
+                self.delete_many(request._filter)
+
+    mongomock.collection.Collection.bulk_write = bulk_write
+    return mongomock.MongoClient(tz_aware=True)
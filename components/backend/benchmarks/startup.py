@@ -0,0 +1,64 @@
+"""
+Startup benchmark for the cli: imports `archie.cli` and runs `archie --help` under `python -X importtime`, then checks the
+total import time is under budget and that none of the slow/side-effecting modules got pulled in.
+
+    python benchmarks/startup.py [--budget-ms 200] [--runs 5]
+
+Exits with 1 if either check fails.
+"""
+
+import argparse
+import subprocess
+import sys
+
+# these should only ever be imported by the commands that use them
+HEAVY_MODULES = ("yt_dlp", "soundcloud", "scdl", "pymongo", "fastapi", "uvicorn", "pydantic")
+
+SCRIPT = "from archie.cli import archie; archie(['--help'])"
+
+
+def measure() -> tuple[float, set[str]]:
+    # returns the total import time in ms and every module that was imported
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", SCRIPT], check=False, capture_output=True, text=True)
+    if result.returncode:
+        # the import time output is mixed in with the traceback, show all of it
+        sys.exit(f"archie --help failed:\n{result.stderr}")
+
+    total_us = 0
+    modules = set()
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+
+        self_us, _, name = line.removeprefix("import time:").split("|")
+        if not self_us.strip().isdigit():
+            continue  # header
+
+        total_us += int(self_us)
+        modules.add(name.strip())
+
+    return total_us / 1000, modules
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--budget-ms", type=float, default=200)
+    parser.add_argument("--runs", type=int, default=5)
+    args = parser.parse_args()
+
+    # the fastest run is the least noisy
+    runs = [measure() for _ in range(args.runs)]
+    total_ms, modules = min(runs, key=lambda run: run[0])
+
+    heavy = sorted(module for module in HEAVY_MODULES if module in modules)
+
+    print(f"archie --help imports: {total_ms:.1f}ms (budget {args.budget_ms:g}ms), {len(modules)} modules")
+    if heavy:
+        print(f"imported modules that should be lazy: {', '.join(heavy)}")
+
+    if total_ms > args.budget_ms or heavy:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,429 @@
+"""
+Offline benchmark for ingestion, queue claims and download checks. The services run against the fakes in fakes.py instead of
+youtube/soundcloud, and against a throwaway database on a local mongod or mongomock (the default, `pip install mongomock`).
+
+    python benchmarks/suite.py [--mongo-uri mongodb://localhost:27017] [--output results.json] [--compare old.json]
+
+Measures ingest docs/sec for each parse stage, latency of claiming the next download/parse item, _check_downloads files/sec
+and the memory high-water mark after each phase (--tracemalloc also gives the python heap peak per phase, but slows everything
+down). Results are written as json along with the commit they were run on, --compare prints the change from an older run.
+"""
+
+import argparse
+import json
+import resource
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+from typing import cast
+
+from fakes import FakeSoundCloud, FakeYouTubeAPI, mongomock_client
+
+DATABASE_NAME = "archie_benchmark"
+
+# where the services keep their documents, for counting what a phase wrote
+COLLECTIONS = {
+    "youtube": ("youtube_channels", "youtube_playlists", "youtube_videos", "youtube_channel_history", "youtube_video_history"),
+    "soundcloud": ("soundcloud_users", "soundcloud_tracks", "soundcloud_playlists", "soundcloud_comments"),
+}
+
+
+def _mongomock_client():
+    try:
+        return mongomock_client()
+    except ImportError:
+        sys.exit("mongomock isn't installed, install it or pass --mongo-uri to use a real mongod")
+
+
+def connect(mongo_uri: str | None):
+    from pymongo import MongoClient
+
+    from archie.services import base_mongo
+
+    client = (
+        MongoClient(mongo_uri, tz_aware=True, event_listeners=[base_mongo.CommandMetrics()]) if mongo_uri else _mongomock_client()
+    )
+    client.drop_database(DATABASE_NAME)
+
+    # swap in before anything touches them, so nothing ever connects to the real archive
+    base_mongo.use_client(client, DATABASE_NAME)
+
+    return client
+
+
+def make_config(args, download_path: Path):
+    from archie.config import Account, ArchiveConfig, Config, DownloadOptions, Entity
+
+    accounts = [Account(service="YouTube", id=id) for id in FakeYouTubeAPI.channel_ids(args.channels)]
+    accounts += [Account(service="SoundCloud", id=id) for id in FakeSoundCloud.user_ids(args.users)]
+
+    config = Config(
+        archives=[
+            ArchiveConfig(
+                name="benchmark",
+                entities=[Entity(name="benchmark", accounts=accounts)],
+                downloads=DownloadOptions(download_path=str(download_path)),
+            )
+        ]
+    )
+
+    # nothing's going to be downloaded, don't let the disk check get in the way of claiming
+    config.downloads.min_free_space_gb = 0
+    return config
+
+
+def count_documents(service: str) -> int:
+    from archie.services.base_mongo import db
+
+    return sum(db[collection].estimated_document_count() for collection in COLLECTIONS[service])
+
+
+def count_stores(service: str) -> int:
+    # every store_* call writes (at most) one document, including the ones they make for nested items
+    from archie.utils import metrics
+
+    return sum(count for (call,), count in metrics.call_duration.counts().items() if call.startswith(f"{service}.db.store_"))
+
+
+def peak_rss_mb() -> float:
+    # kilobytes on linux, bytes on macos
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 1024**2 if sys.platform == "darwin" else peak / 1024
+
+
+def percentiles(samples: list[float]) -> dict:
+    samples_ms = sorted(sample * 1000 for sample in samples)
+    if not samples_ms:
+        return {"count": 0}
+
+    def at(fraction: float):
+        return round(samples_ms[min(int(len(samples_ms) * fraction), len(samples_ms) - 1)], 3)
+
+    return {
+        "count": len(samples_ms),
+        "mean_ms": round(statistics.fmean(samples_ms), 3),
+        "p50_ms": at(0.5),
+        "p95_ms": at(0.95),
+        "p99_ms": at(0.99),
+        "max_ms": round(samples_ms[-1], 3),
+    }
+
+
+class Results:
+    def __init__(self, trace_memory: bool):
+        self.trace_memory = trace_memory
+        self.phases: dict[str, dict] = {}
+
+    @contextmanager
+    def phase(self, name: str):
+        result: dict = {}
+
+        if self.trace_memory:
+            tracemalloc.start()
+
+        start = time.perf_counter()
+        try:
+            yield result
+        finally:
+            result["seconds"] = round(time.perf_counter() - start, 4)
+
+            if self.trace_memory:
+                result["heap_peak_mb"] = round(tracemalloc.get_traced_memory()[1] / 1024**2, 2)
+                tracemalloc.stop()
+
+            result["rss_high_water_mb"] = round(peak_rss_mb(), 1)
+            self.phases[name] = result
+
+    def log(self, name: str):
+        print(f"{name}: {', '.join(f'{key} {value}' for key, value in self.phases[name].items())}", file=sys.stderr)
+
+
+def ingest(results: Results, name: str, service: str, parse):
+    from archie.utils import metrics
+
+    before = count_documents(service), count_stores(service), metrics.items_parsed.total(service=service)
+
+    with results.phase(name) as result:
+        parse()
+
+    result["new_docs"] = count_documents(service) - before[0]
+    result["docs"] = count_stores(service) - before[1]
+    result["docs_per_sec"] = round(result["docs"] / result["seconds"], 1) if result["seconds"] else 0
+    result["items_parsed"] = int(metrics.items_parsed.total(service=service) - before[2])
+    results.log(name)
+
+
+def claim(results: Results, name: str, get_next, get_id, current: set, count: int):
+    # how workers claim: find the next item, then skip it from then on
+    samples = []
+
+    with results.phase(name) as result:
+        for _ in range(count):
+            start = time.perf_counter()
+            item = get_next()
+            samples.append(time.perf_counter() - start)
+
+            if not item:
+                break
+
+            current.add(get_id(item))
+
+    current.clear()
+    result.update(percentiles(samples))
+    results.log(name)
+
+
+def first_item_latency(results: Results, name: str, get_queue, count: int):
+    # the parse queues are generators, time how long until they hand over their first item
+    from archie.services.base_mongo import db
+
+    samples = []
+
+    with results.phase(name) as result:
+        for _ in range(count):
+            start = time.perf_counter()
+            queue = get_queue()
+            next(queue, None)
+            samples.append(time.perf_counter() - start)
+            queue.close()
+
+    db["queue_checkpoints"].delete_many({})
+    result.update(percentiles(samples))
+    results.log(name)
+
+
+def check_downloads(results: Results, name: str, service, config, downloads: list[tuple], store_download, missing_every: int):
+    # downloads is [(id, relative path)]. every missing_every-th file is left out so removal gets exercised too
+    from archie.services.base_catalog import file_catalog
+
+    root = Path(config.archives[0].downloads.download_path) / service.service_name
+
+    for index, (id, relative_path) in enumerate(downloads):
+        path = root / relative_path
+        if not missing_every or index % missing_every:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            path.write_bytes(b"\0" * 1024)
+
+        store_download(id, path, relative_path, "benchmark")
+
+    # the catalog's first scan is what finds the missing ones now, a rescan with nothing changed should barely register
+    for phase in ("catalog.first_scan", "catalog.rescan"):
+        with results.phase(f"{name}.{phase}") as result:
+            file_catalog.scan([root])
+
+        result["files"] = len(downloads)
+        results.log(f"{name}.{phase}")
+
+    with results.phase(name) as result:
+        service._check_downloads(config)
+
+    result["files"] = len(downloads)
+    result["files_per_sec"] = round(len(downloads) / result["seconds"], 1) if result["seconds"] else 0
+    results.log(name)
+
+
+def run(args) -> dict:
+    import archie
+    import archie.services.soundcloud as soundcloud_service
+    from archie.services.base_download import download_scheduler
+    from archie.services.base_mongo import db
+    from archie.services.soundcloud import SoundCloudService
+    from archie.services.soundcloud import database as soundcloud_db
+    from archie.services.soundcloud.client import CachedSoundCloud
+    from archie.services.youtube import YouTubeService
+    from archie.services.youtube import database as youtube_db
+    from archie.services.youtube.api import YouTubeAPI
+    from archie.utils import metrics
+
+    # the services log every item, which would mostly be measuring the terminal
+    archie.console.quiet = not args.verbose
+
+    client = connect(args.mongo_uri)
+    results = Results(args.tracemalloc)
+
+    youtube = YouTubeService()
+    youtube.api = cast(
+        YouTubeAPI, FakeYouTubeAPI(args.videos, args.playlists, args.playlist_videos, args.video_comments, args.seed)
+    )
+
+    soundcloud = SoundCloudService()
+    soundcloud_service.sc = CachedSoundCloud(
+        FakeSoundCloud(args.tracks, args.likers, args.track_comments, args.reposts, args.audience, args.seed)
+    )
+
+    with tempfile.TemporaryDirectory(prefix="archie-benchmark-") as download_path:
+        config = make_config(args, Path(download_path))
+        download_scheduler.configure(config.downloads)
+
+        channel_ids = FakeYouTubeAPI.channel_ids(args.channels)
+        user_ids = FakeSoundCloud.user_ids(args.users)
+
+        for service_db in (youtube_db, soundcloud_db):
+            service_db.configure_history(config.history)
+            service_db.update_indexes()
+
+        youtube_db.sync_accounts(channel_ids, config.services.youtube.channel_update_gap_hours)
+        soundcloud_db.sync_accounts(user_ids, config.services.soundcloud.user_update_gap_hours)
+
+        # the same loops the services run, a single pass each
+        stages = [
+            ("youtube.ingest.channels", "youtube", lambda: youtube._parse_channels(config, channel_ids)),
+            ("youtube.ingest.playlists", "youtube", lambda: youtube._parse_playlists(config)),
+            ("youtube.ingest.videos", "youtube", lambda: youtube._parse_videos(config)),
+            ("soundcloud.ingest.users", "soundcloud", lambda: soundcloud._parse_users(config, user_ids)),
+            ("soundcloud.ingest.tracks", "soundcloud", lambda: soundcloud._parse_tracks(config)),
+        ]
+        for name, service, parse in stages:
+            ingest(results, name, service, parse)
+
+        claim(
+            results,
+            "youtube.claim.download",
+            lambda: youtube._get_next_download(config),
+            lambda video: video["video"]["id"],
+            youtube._current_downloads,
+            args.claims,
+        )
+        claim(
+            results,
+            "soundcloud.claim.download",
+            lambda: soundcloud._get_next_download(config),
+            lambda track: track["track"]["id"],
+            soundcloud._current_downloads,
+            args.claims,
+        )
+
+        # pretend everything's due again so the queues have something in them
+        everything = datetime.now(timezone.utc) + timedelta(days=365)
+        first_item_latency(results, "youtube.claim.parse", lambda: youtube_db.get_video_to_parse(everything), args.claims)
+        first_item_latency(results, "soundcloud.claim.parse", lambda: soundcloud_db.get_track_to_parse(everything), args.claims)
+
+        videos = db["youtube_videos"].find({"_scan_source": "full"}, {"video.id": 1, "video.channel_id": 1}, limit=args.downloads)
+        check_downloads(
+            results,
+            "youtube.check_downloads",
+            youtube,
+            config,
+            [(video["video"]["id"], Path(video["video"]["channel_id"]) / f"{video['video']['id']}.mp4") for video in videos],
+            youtube_db.store_download,
+            args.missing_every,
+        )
+
+        tracks = db["soundcloud_tracks"].find({"_scan_source": "full"}, {"track.id": 1, "track.user_id": 1}, limit=args.downloads)
+        check_downloads(
+            results,
+            "soundcloud.check_downloads",
+            soundcloud,
+            config,
+            [(track["track"]["id"], Path(str(track["track"]["user_id"])) / f"{track['track']['id']}.mp3") for track in tracks],
+            soundcloud_db.store_download,
+            args.missing_every,
+        )
+
+    mongo_seconds, mongo_commands = metrics.mongo_duration.totals()
+    client.drop_database(DATABASE_NAME)
+
+    return {
+        "commit": _commit(),
+        "time": datetime.now(timezone.utc).isoformat(),
+        "backend": "mongod" if args.mongo_uri else "mongomock",
+        "python": sys.version.split()[0],
+        "params": {key: value for key, value in vars(args).items() if key not in ("output", "compare", "verbose")},
+        "phases": results.phases,
+        # only counted against a real mongod, mongomock doesn't send commands
+        "mongo": {
+            "commands": mongo_commands,
+            "avg_ms": round(mongo_seconds / mongo_commands * 1000, 3) if mongo_commands else None,
+        },
+        "rss_high_water_mb": round(peak_rss_mb(), 1),
+    }
+
+
+def _commit():
+    try:
+        result = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], check=False, capture_output=True, text=True, cwd=Path(__file__).parent
+        )
+        return result.stdout.strip() or None
+    except OSError:
+        return None
+
+
+# which way is better for each measurement
+HIGHER_IS_BETTER = ("docs_per_sec", "files_per_sec")
+LOWER_IS_BETTER = ("seconds", "mean_ms", "p50_ms", "p95_ms", "p99_ms", "max_ms", "heap_peak_mb", "rss_high_water_mb")
+
+
+def compare(old: dict, new: dict):
+    print(f"\n{old.get('commit')} -> {new.get('commit')}")
+
+    if old.get("params") != new.get("params") or old.get("backend") != new.get("backend"):
+        print("note: runs used different parameters/backends, the numbers aren't directly comparable")
+
+    for name, phase in new["phases"].items():
+        old_phase = old["phases"].get(name)
+        if not old_phase:
+            continue
+
+        changes = []
+        for key in (*HIGHER_IS_BETTER, *LOWER_IS_BETTER):
+            if key not in phase or not old_phase.get(key):
+                continue
+
+            change = (phase[key] - old_phase[key]) / old_phase[key] * 100
+            better = change > 0 if key in HIGHER_IS_BETTER else change < 0
+            changes.append(f"{key} {old_phase[key]} -> {phase[key]} ({change:+.1f}%{'' if better or not change else ' worse'})")
+
+        print(f"{name}: {', '.join(changes)}")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--mongo-uri", help="Use this mongod (the benchmark database on it is dropped) instead of mongomock.")
+    parser.add_argument("--output", type=Path, help="Write the results here as well as printing them.")
+    parser.add_argument("--compare", type=Path, help="Results from an earlier run to compare against.")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--verbose", action="store_true", help="Show the services' logs.")
+    parser.add_argument("--tracemalloc", action="store_true", help="Record the python heap peak of each phase.")
+
+    parser.add_argument("--channels", type=int, default=10)
+    parser.add_argument("--videos", type=int, default=100, help="Per channel.")
+    parser.add_argument("--playlists", type=int, default=3, help="Per channel.")
+    parser.add_argument("--playlist-videos", type=int, default=20)
+    parser.add_argument("--video-comments", type=int, default=20)
+
+    parser.add_argument("--users", type=int, default=10)
+    parser.add_argument("--tracks", type=int, default=30, help="Per user.")
+    parser.add_argument("--likers", type=int, default=20, help="Per track.")
+    parser.add_argument("--track-comments", type=int, default=10)
+    parser.add_argument("--reposts", type=int, default=5, help="Per user.")
+    parser.add_argument("--audience", type=int, default=2000, help="Users that likers/commenters are picked from.")
+
+    parser.add_argument("--claims", type=int, default=100, help="Queue claims to time.")
+    parser.add_argument("--downloads", type=int, default=500, help="Downloads per service for _check_downloads.")
+    parser.add_argument("--missing-every", type=int, default=10, help="Every nth download's file is missing.")
+    args = parser.parse_args()
+
+    # read first, it might be the same file as --output
+    previous = json.loads(args.compare.read_text()) if args.compare else None
+
+    results = run(args)
+
+    output = json.dumps(results, indent=2)
+    print(output)
+
+    if args.output:
+        args.output.write_text(output + "\n")
+
+    if previous:
+        compare(previous, results)
+
+
+if __name__ == "__main__":
+    main()
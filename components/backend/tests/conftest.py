@@ -0,0 +1,15 @@
+"""
+The tests run against mongomock rather than a real mongod, `pip install pytest mongomock` then run `pytest` from here.
+"""
+
+import pytest
+from fakes import mongomock_client
+
+from archie.services import base_mongo
+
+
+@pytest.fixture(autouse=True)
+def db():
+    # a fresh in-memory database for every test
+    base_mongo.use_client(mongomock_client())
+    return base_mongo.db
@@ -0,0 +1,86 @@
+from archie.config import ClusterOptions
+from archie.services.base_cache import BloomFilter, IdCache
+from archie.services.base_cluster import cluster
+
+
+def test_bloom_filter_has_no_false_negatives():
+    bloom = BloomFilter(1000, 0.01)
+    for i in range(1000):
+        bloom.add(i)
+
+    assert all(i in bloom for i in range(1000))
+
+
+def test_bloom_filter_false_positive_rate():
+    bloom = BloomFilter(1000, 0.01)
+    for i in range(1000):
+        bloom.add(i)
+
+    false_positives = sum(i in bloom for i in range(1000, 11000))
+    # a few times the target rate, it's probabilistic
+    assert false_positives < 10000 * 0.03
+
+
+def test_unknown_ids_go_to_mongo_until_warm(db):
+    cache = IdCache("things", "thing.id")
+    assert cache.contains(1) is None
+
+    db["things"].insert_one({"thing": {"id": 1}, "_scan_source": "full", "_status": "accepted"})
+    assert cache.exists(1)
+    assert cache.contains(1) is True
+    assert cache.scan_source(1) == "full"
+    assert cache.status(1) == "accepted"
+
+
+def test_warm_loads_ids_and_trusts_bloom_misses(db):
+    db["things"].insert_many([{"thing": {"id": i}, "_scan_source": "channel"} for i in range(10)])
+
+    cache = IdCache("things", "thing.id", bloom_capacity=1000)
+    cache.warm()
+
+    assert all(cache.contains(i) for i in range(10))
+    assert cache.scan_source(3) == "channel"
+    # definitely not there, without asking mongo
+    assert cache.contains(1000) is False
+
+
+def test_evicted_ids_fall_back_to_the_bloom_filter(db):
+    cache = IdCache("things", "thing.id", max_entries=2, bloom_capacity=1000)
+    cache.warm()
+
+    for i in range(3):
+        cache.set(i, "full")
+
+    # 0 was evicted from the lru but the bloom filter still has it, so mongo has to be asked
+    assert cache.contains(0) is None
+    assert cache.contains(2) is True
+
+
+def test_bloom_misses_are_not_trusted_when_clustered(db, monkeypatch):
+    monkeypatch.setattr(cluster, "options", ClusterOptions(enabled=True))
+
+    cache = IdCache("things", "thing.id", bloom_capacity=1000)
+    cache.warm()
+
+    # another node could have stored it
+    db["things"].insert_one({"thing": {"id": 5}, "_scan_source": "full"})
+    assert cache.contains(5) is None
+    assert cache.exists(5)
+
+
+def test_configure_starts_over(db):
+    cache = IdCache("things", "thing.id", bloom_capacity=1000)
+    cache.warm()
+    cache.set(1, "full")
+
+    cache.configure(10, 1000, 0.01)
+    assert cache.contains(1) is None
+
+
+def test_invalidate(db):
+    cache = IdCache("things", "thing.id")
+    cache.set(1, "full")
+    cache.invalidate(1)
+
+    assert cache.contains(1) is None
+    assert not cache.exists(1)
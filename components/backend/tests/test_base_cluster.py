@@ -0,0 +1,136 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+from archie.config import ClusterOptions
+from archie.services.base_cluster import Cluster
+
+
+def make_node(name: str, **options) -> Cluster:
+    node = Cluster()
+    # heartbeats are sent by hand, the thread start() kicks off never gets round to one
+    node.configure(ClusterOptions(enabled=True, node_name=name, heartbeat_seconds=3600, **options))
+    node.start()
+    return node
+
+
+@pytest.fixture
+def nodes(db):
+    return make_node("a"), make_node("b")
+
+
+def test_claims_always_succeed_without_clustering(db):
+    node = Cluster()
+    assert node.claim("track", 1)
+    assert Cluster().claim("track", 1)
+    assert db["cluster_leases"].count_documents({}) == 0
+
+
+def test_only_one_node_gets_a_claim(nodes):
+    a, b = nodes
+
+    assert a.claim("track", 1)
+    assert not b.claim("track", 1)
+    # claiming again is fine for whoever holds it
+    assert a.claim("track", 1)
+
+    a.release("track", 1)
+    assert b.claim("track", 1)
+    assert not a.claim("track", 1)
+
+
+def test_concurrent_claims(nodes):
+    a, b = nodes
+
+    def claim(args):
+        node, id = args
+        return node.claim("track", id)
+
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        attempts = [(node, id) for id in range(50) for node in (a, b, a, b)]
+        won = [args for args, ok in zip(attempts, executor.map(claim, attempts)) if ok]
+
+    # every id went to exactly one node (which may have claimed it more than once)
+    winners = {}
+    for node, id in won:
+        assert winners.setdefault(id, node) is node
+
+    assert sorted(winners) == list(range(50))
+
+
+def test_expired_leases_can_be_taken_over(nodes, db):
+    a, b = nodes
+
+    assert a.claim("track", 1)
+    db["cluster_leases"].update_one({"_id": "track:1"}, {"$set": {"expires": datetime.now(timezone.utc) - timedelta(seconds=1)}})
+
+    assert b.claim("track", 1)
+    assert not a.claim("track", 1)
+
+    # a's late release doesn't drop b's lease
+    a.release("track", 1)
+    assert b.claimed_ids("track") == [1]
+
+
+def test_heartbeat_renews_held_leases(nodes, db):
+    a, b = nodes
+    a.claim("track", 1)
+
+    almost_expired = datetime.now(timezone.utc) + timedelta(seconds=1)
+    db["cluster_leases"].update_one({"_id": "track:1"}, {"$set": {"expires": almost_expired}})
+    a._beat()
+
+    assert db["cluster_leases"].find_one({"_id": "track:1"})["expires"] > almost_expired + timedelta(seconds=60)
+    assert not b.claim("track", 1)
+    assert a.nodes()[0]["leases"] == 1
+
+
+def test_claim_fresh_skips_documents_someone_else_got_to(nodes, db):
+    a, b = nodes
+    db["tracks"].insert_one({"_id": 1, "_scan_time": 1})
+    queued = db["tracks"].find_one({"_id": 1})
+
+    # b parsed it and let go while a's copy was sitting in a batch
+    assert b.claim_fresh("track", 1, "tracks", queued)
+    db["tracks"].update_one({"_id": 1}, {"$set": {"_scan_time": 2}})
+    b.release("track", 1)
+
+    assert not a.claim_fresh("track", 1, "tracks", queued)
+    assert a.claimed_ids("track") == []
+
+
+def test_claim_each_and_claim_batches_hold_leases_until_the_next_item(nodes):
+    a, b = nodes
+    docs = [{"id": i} for i in range(5)]
+    b.claim("track", 3)
+
+    claimed = []
+    for doc in a.claim_each("track", docs, lambda doc: doc["id"]):
+        assert sorted(a.claimed_ids("track")) == sorted({doc["id"], 3})
+        claimed.append(doc["id"])
+
+    assert claimed == [0, 1, 2, 4]
+
+    batches = []
+    for batch in a.claim_batches("track", docs, lambda doc: doc["id"], 2):
+        assert sorted(a.claimed_ids("track")) == sorted({doc["id"] for doc in batch} | {3})
+        batches.append([doc["id"] for doc in batch])
+
+    assert batches == [[0, 1], [2, 4]]
+    assert a.claimed_ids("track") == [3]
+
+
+def test_lapsed_heartbeats_stop_new_claims(db):
+    a = make_node("a", lease_seconds=1)
+    assert a.claim("track", 1)
+
+    # pretend the last heartbeat that got through was a while ago
+    a._last_beat = time.monotonic() - 2
+    assert a.lapsed
+    assert not a.claim("track", 2)
+
+    a._beat()
+    assert not a.lapsed
+    assert a.claim("track", 2)
@@ -0,0 +1,120 @@
+from datetime import datetime, timedelta, timezone
+
+import pytest
+from bson import ObjectId
+
+from archie.services.base_history import History, apply_patch, make_patch
+
+START = datetime(2024, 1, 1, tzinfo=timezone.utc)
+
+
+@pytest.fixture
+def history(db):
+    history = History("thing_history", "things", "thing", ignored_keys=("token",))
+    history.configure(True, 3)
+    history.update_indexes()
+    return history
+
+
+def record_versions(history: History, docs: list[dict], step=timedelta(hours=1)):
+    # records docs as consecutive scans of entity 1, returns when each one was seen
+    times = [START + step * i for i in range(len(docs))]
+    for (previous, previous_time), (current, time) in zip(zip(docs, times), zip(docs[1:], times[1:])):
+        history.record(1, previous, previous_time, current, time)
+
+    return times
+
+
+def test_patches_round_trip():
+    old = {"a": 1, "b": {"c": [1, 2], "d.e": "x"}, "gone": True}
+    new = {"a": 2, "b": {"c": [1, 2, 3], "d.e": "y"}, "new": None}
+
+    assert apply_patch(old, make_patch(old, new)) == new
+
+
+def test_unchanged_documents_write_nothing(history, db):
+    assert not history.record(1, {"id": 1, "token": "a"}, START, {"id": 1, "token": "b"}, START + timedelta(hours=1))
+    assert db["thing_history"].count_documents({}) == 0
+
+
+def test_record_and_versions(history, db):
+    docs = [{"id": 1, "n": i} for i in range(8)]
+    times = record_versions(history, docs)
+
+    assert history.versions(1) == list(zip(times, docs))
+
+    # a snapshot to start with and then every 3 versions, patches in between
+    entries = list(db["thing_history"].find({}, sort=[("version", 1)]))
+    assert ["snapshot" in entry for entry in entries] == [True, False, False, True, False, False, True, False]
+    assert [entry["base_version"] for entry in entries] == [0, 0, 0, 3, 3, 3, 6, 6]
+
+
+def test_as_of(history):
+    docs = [{"id": 1, "n": i} for i in range(8)]
+    times = record_versions(history, docs)
+
+    for time, doc in zip(times, docs):
+        assert history.as_of(1, time) == doc
+        assert history.as_of(1, time + timedelta(minutes=30)) == doc
+
+    assert history.as_of(1, START - timedelta(minutes=1)) is None
+
+
+def test_as_of_without_history_uses_the_live_document(history, db):
+    first_seen = datetime.now(timezone.utc).replace(microsecond=0)
+    db["things"].insert_one({"_id": ObjectId.from_datetime(first_seen), "thing": {"id": 2, "n": 0, "token": "a"}})
+
+    assert history.as_of(2, first_seen + timedelta(days=1)) == {"id": 2, "n": 0}
+    # before we'd ever seen it
+    assert history.as_of(2, first_seen - timedelta(days=1)) is None
+    assert history.as_of(3, first_seen) is None
+
+
+def test_gap_in_history_starts_a_new_chain(history, db):
+    record_versions(history, [{"id": 1, "n": 0}, {"id": 1, "n": 1}])
+
+    # history was off while n went from 1 to 5, so the chain doesn't carry on from what we're diffing against
+    history.record(1, {"id": 1, "n": 5}, START + timedelta(hours=5), {"id": 1, "n": 6}, START + timedelta(hours=6))
+
+    assert [doc["n"] for _, doc in history.versions(1)] == [0, 1, 5, 6]
+    assert history.as_of(1, START + timedelta(hours=5, minutes=30)) == {"id": 1, "n": 5}
+
+
+def test_record_retries_when_another_writer_takes_the_version(history, db, monkeypatch):
+    record_versions(history, [{"id": 1, "n": 0}, {"id": 1, "n": 1}])
+
+    collection = type(db["thing_history"])
+    insert_many = collection.insert_many
+    raced = []
+
+    def racing_insert_many(self, entries, *args, **kwargs):
+        # someone else records n=2 between our read and our write
+        if not raced:
+            raced.append(True)
+            insert_many(self, [history._entry(1, 2, 0, START + timedelta(hours=2), "other", ops=[])])
+
+        return insert_many(self, entries, *args, **kwargs)
+
+    monkeypatch.setattr(collection, "insert_many", racing_insert_many)
+    assert history.record(1, {"id": 1, "n": 1}, START + timedelta(hours=1), {"id": 1, "n": 2}, START + timedelta(hours=2))
+
+    versions = [entry["version"] for entry in db["thing_history"].find({}, sort=[("version", 1)])]
+    assert versions == [0, 1, 2, 3, 4]
+
+
+def test_compact_keeps_the_last_version_per_bucket(history, db):
+    docs = [{"id": 1, "n": i} for i in range(10)]
+    times = record_versions(history, docs)
+
+    # everything before hour 8 is old, keep one version per 4 hours there
+    history.compact(START + timedelta(hours=8), timedelta(hours=4))
+
+    assert history.versions(1) == [(times[3], docs[3]), (times[7], docs[7]), (times[8], docs[8]), (times[9], docs[9])]
+    assert history.as_of(1, times[5]) == docs[3]
+    assert history.as_of(1, times[9]) == docs[9]
+
+    # and it carries on from the compacted chain
+    later = times[9] + timedelta(hours=1)
+    history.record(1, docs[9], times[9], {"id": 1, "n": 10}, later)
+    assert history.as_of(1, later) == {"id": 1, "n": 10}
+    assert len(history.versions(1)) == 5
@@ -0,0 +1,86 @@
+from archie.services.base_mongo import diff_update, iterate_batches, upsert
+
+
+def test_new_document_is_set():
+    assert diff_update(None, {"a": 1}) == {"$set": {"a": 1}}
+
+
+def test_unchanged_document_has_no_update():
+    assert diff_update({"a": 1, "b": [1, 2]}, {"a": 1, "b": [1, 2]}) == {}
+
+
+def test_changed_and_added_fields_are_set():
+    assert diff_update({"a": 1}, {"a": 2, "b": 3}) == {"$set": {"a": 2, "b": 3}}
+
+
+def test_appended_list_is_pushed():
+    assert diff_update({"l": [1, 2]}, {"l": [1, 2, 3, 4]}) == {"$push": {"l": {"$each": [3, 4]}}}
+
+
+def test_prepended_list_is_pushed_to_the_front():
+    assert diff_update({"l": [3, 4]}, {"l": [1, 2, 3, 4]}) == {"$push": {"l": {"$each": [1, 2], "$position": 0}}}
+
+
+def test_set_fields_that_only_gained_items_are_added_to_set():
+    update = diff_update({"ids": [1, 2, 3]}, {"ids": [2, 5, 1, 3]}, set_fields=("ids",))
+    assert update == {"$addToSet": {"ids": {"$each": [5]}}}
+
+
+def test_reordered_list_outside_set_fields_is_set():
+    assert diff_update({"ids": [1, 2, 3]}, {"ids": [2, 5, 1, 3]}) == {"$set": {"ids": [2, 5, 1, 3]}}
+
+
+def test_unhashable_set_field_is_set():
+    update = diff_update({"l": [{"a": 1}]}, {"l": [{"b": 2}, {"a": 1}, {"c": 3}]}, set_fields=("l",))
+    assert update == {"$set": {"l": [{"b": 2}, {"a": 1}, {"c": 3}]}}
+
+
+def test_shrunk_list_is_set():
+    assert diff_update({"l": [1, 2, 3]}, {"l": [1, 2]}) == {"$set": {"l": [1, 2]}}
+
+
+def test_missing_fields_are_unset_except_underscore_ones():
+    assert diff_update({"a": 1, "b": 2, "_owned": 3}, {"a": 1}) == {"$unset": {"b": ""}}
+
+
+def test_upsert_matches_a_replace(db):
+    previous = {"_scan_time": 1, "user": {"id": 1, "name": "a"}, "tracks": [1, 2], "old": True}
+    document = {"_scan_time": 2, "user": {"id": 1, "name": "b"}, "tracks": [1, 2, 3]}
+
+    upsert("users", {"user.id": 1}, None, previous)
+    upsert("users", {"user.id": 1}, previous, document, set_fields=("tracks",))
+
+    stored = db["users"].find_one({"user.id": 1}, {"_id": 0})
+    assert stored == document
+
+
+def test_upsert_skips_unchanged_documents(db):
+    document = {"user": {"id": 1}}
+    upsert("users", {"user.id": 1}, document, document)
+
+    # nothing to write, so it wasn't even inserted
+    assert db["users"].count_documents({}) == 0
+
+
+def test_iterate_batches_resumes_from_its_checkpoint(db):
+    db["things"].insert_many([{"_id": i} for i in range(10)])
+
+    walk = iterate_batches("things", {}, "things", batch_size=3)
+    assert [next(walk)["_id"] for _ in range(5)] == [0, 1, 2, 3, 4]
+    # saved once per batch
+    assert db["queue_checkpoints"].find_one({"_id": "things"})["last_id"] == 2
+
+    # stopping early keeps what was finished, the last one handed out might not have been
+    walk.close()
+    assert db["queue_checkpoints"].find_one({"_id": "things"})["last_id"] == 3
+
+    assert [doc["_id"] for doc in iterate_batches("things", {}, "things", batch_size=3)] == [4, 5, 6, 7, 8, 9]
+    # a full pass starts over next time
+    assert db["queue_checkpoints"].count_documents({}) == 0
+
+
+def test_iterate_batches_keep(db):
+    db["things"].insert_many([{"_id": i} for i in range(10)])
+
+    walk = iterate_batches("things", {"_id": {"$gte": 2}}, "things", batch_size=4, keep=lambda doc: doc["_id"] % 2 == 0)
+    assert [doc["_id"] for doc in walk] == [2, 4, 6, 8]
@@ -0,0 +1,105 @@
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+from archie.config import AdaptiveScanOptions
+from archie.services.base_schedule import (
+    EPOCH,
+    AccountQueue,
+    RescanPolicy,
+    due_query,
+    next_scan_time,
+)
+
+SCANNED = datetime(2024, 1, 1, tzinfo=timezone.utc)
+
+
+@pytest.fixture
+def policy():
+    return RescanPolicy(24, AdaptiveScanOptions(), ["user.track_count"])
+
+
+def scan(time: datetime, track_count: int, source="full", **extra) -> dict:
+    return {"_scan_source": source, "_scan_time": time, "user": {"id": 1, "track_count": track_count}, **extra}
+
+
+def test_next_scan_time():
+    assert next_scan_time(None, 24) == EPOCH
+    # partially scanned things are due straight away
+    assert next_scan_time(scan(SCANNED, 0, "repost"), 24) == EPOCH
+    # scanned before adaptive scheduling existed
+    assert next_scan_time(scan(SCANNED, 0), 24) == SCANNED + timedelta(hours=24)
+    assert next_scan_time(scan(SCANNED, 0, _next_scan=SCANNED + timedelta(hours=3)), 24) == SCANNED + timedelta(hours=3)
+
+
+def test_first_full_scan_uses_the_gap(policy):
+    assert policy.schedule(None, scan(SCANNED, 0)) == {"_scan_interval": 24, "_next_scan": SCANNED + timedelta(hours=24)}
+    # a partial scan doesn't have an interval to adapt
+    assert policy.schedule(scan(SCANNED, 0, "like"), scan(SCANNED, 0))["_scan_interval"] == 24
+
+
+def test_quiet_rescans_back_off_until_the_max(policy):
+    previous = scan(SCANNED, 5, _scan_interval=24)
+    intervals = []
+    for i in range(1, 8):
+        current = scan(SCANNED + timedelta(days=i), 5)
+        current.update(policy.schedule(previous, current))
+        intervals.append(current["_scan_interval"])
+        previous = current
+
+    assert intervals == [48, 96, 192, 384, 384, 384, 384]
+    assert previous["_next_scan"] == previous["_scan_time"] + timedelta(hours=384)
+
+
+def test_activity_shortens_the_interval_until_the_min(policy):
+    previous = scan(SCANNED, 0, _scan_interval=24)
+    intervals = []
+    for i in range(1, 5):
+        current = scan(SCANNED + timedelta(days=i), i)
+        current.update(policy.schedule(previous, current))
+        intervals.append(current["_scan_interval"])
+        previous = current
+
+    assert intervals == [12, 6, 6, 6]
+
+
+def test_disabled_always_uses_the_gap():
+    policy = RescanPolicy(24, AdaptiveScanOptions(enabled=False), ["user.track_count"])
+    assert policy.schedule(scan(SCANNED, 0, _scan_interval=384), scan(SCANNED, 0))["_scan_interval"] == 24
+
+
+def test_account_queue(db):
+    queue = AccountQueue("account_queue", "users", "user")
+    now = datetime.now(timezone.utc)
+
+    db["users"].insert_many(
+        [
+            {**scan(now, 0), "user": {"id": 1}, "_next_scan": now + timedelta(hours=1)},
+            {**scan(now - timedelta(days=2), 0), "user": {"id": 2}},
+        ]
+    )
+
+    # 3 hasn't been scanned at all
+    queue.sync([1, 2, 3, 4], 24)
+    queue.sync([1, 2, 3], 24)
+
+    assert [account["_id"] for account in queue.get_due([1, 2, 3])] == [3, 2]
+
+    queue.set_next_scan(3, now + timedelta(hours=2))
+    assert [account["_id"] for account in queue.get_due([1, 2, 3])] == [2]
+
+
+def test_due_query(db):
+    now = datetime.now(timezone.utc)
+    db["users"].insert_many(
+        [
+            {"_id": "partial", **scan(now, 0, "like")},
+            {"_id": "due", **scan(now, 0, _next_scan=now - timedelta(hours=1))},
+            {"_id": "not due", **scan(now, 0, _next_scan=now + timedelta(hours=1))},
+            {"_id": "old", **scan(now - timedelta(days=2), 0)},
+            {"_id": "recent", **scan(now, 0)},
+        ]
+    )
+
+    due = db["users"].distinct("_id", due_query(now - timedelta(days=1)))
+    assert sorted(due) == ["due", "old", "partial"]
@@ -0,0 +1,73 @@
+import pytest
+
+from archie.config import SearchOptions
+from archie.services.base_search import SearchIndex, search_entry
+
+
+@pytest.fixture
+def index(db):
+    return SearchIndex()
+
+
+@pytest.fixture
+def writes(index, db, monkeypatch):
+    # everything written to the index
+    writes = []
+    collection = type(db[index.collection_name])
+    bulk_write = collection.bulk_write
+
+    def counting_bulk_write(self, requests, *args, **kwargs):
+        writes.extend(requests)
+        return bulk_write(self, requests, *args, **kwargs)
+
+    monkeypatch.setattr(collection, "bulk_write", counting_bulk_write)
+    return writes
+
+
+def test_search_entry():
+    assert search_entry("soundcloud", "track", 5, "title", None, "someone", 2) == {
+        "_id": "soundcloud:track:5",
+        "service": "soundcloud",
+        "kind": "track",
+        "item_id": 5,
+        "parent_id": 2,
+        "title": "title",
+        "author": "someone",
+        "body": "",
+    }
+
+
+def test_update_only_writes_changed_entries(index, writes, db):
+    old = [search_entry("youtube", "video", i, f"video {i}", "", "channel") for i in range(3)]
+    index.update(old)
+    assert len(writes) == 3
+
+    new = [old[0], {**old[1], "title": "renamed"}, old[2], search_entry("youtube", "video", 3, "video 3", "", "channel")]
+    index.update(new, old)
+
+    assert [write._filter["_id"] for write in writes[3:]] == ["youtube:video:1", "youtube:video:3"]
+    assert db[index.collection_name].find_one({"_id": "youtube:video:1"})["title"] == "renamed"
+    assert db[index.collection_name].count_documents({}) == 4
+
+
+def test_disabled_index_writes_nothing(index, db):
+    index.configure(SearchOptions(enabled=False))
+    index.update([search_entry("youtube", "video", 1, "video", "", "channel")])
+
+    assert db[index.collection_name].count_documents({}) == 0
+
+
+def test_backfill_runs_once(index, db):
+    db["videos"].insert_many([{"video": {"id": i, "title": f"video {i}"}} for i in range(5)])
+
+    def entries(doc):
+        return [search_entry("youtube", "video", doc["video"]["id"], doc["video"]["title"], "", None)]
+
+    index.backfill("videos", entries)
+    assert db[index.collection_name].count_documents({}) == 5
+    assert db["search_backfills"].find_one({"_id": "videos"})["count"] == 5
+
+    # finished, so later starts don't go through everything again
+    db["videos"].insert_one({"video": {"id": 5, "title": "video 5"}})
+    index.backfill("videos", entries)
+    assert db[index.collection_name].count_documents({}) == 5